@@ -4,13 +4,18 @@ import asyncio
 import threading
 from typing import List
 
+from syncr_backend.constants import DEFAULT_UPLOAD_QUEUE_SIZE
+from syncr_backend.constants import DEFAULT_UPLOAD_SLOTS
+from syncr_backend.constants import DEFAULT_UPLOAD_SLOTS_PER_PEER
 from syncr_backend.external_interface.dht_util import initialize_dht
 from syncr_backend.external_interface.drop_peer_store import send_drops_to_dps
 from syncr_backend.init import drop_init
 from syncr_backend.init import node_init
 from syncr_backend.metadata.drop_metadata import send_my_pub_key
+from syncr_backend.network.connection_pool import get_connection_pool
 from syncr_backend.network.handle_frontend import setup_frontend_server
 from syncr_backend.network.listen_requests import start_listen_server
+from syncr_backend.network.upload_limiter import configure_upload_limiter
 from syncr_backend.util import crypto_util
 from syncr_backend.util import drop_util
 from syncr_backend.util.fileio_util import load_config_file
@@ -52,6 +57,25 @@ def parser() -> argparse.ArgumentParser:
         type=int,
         help="Set this if the external port is different from the listen port",
     )
+    input_args_parser.add_argument(
+        "--upload_slots",
+        type=int,
+        default=DEFAULT_UPLOAD_SLOTS,
+        help="Number of chunk uploads to run at once",
+    )
+    input_args_parser.add_argument(
+        "--upload_slots_per_peer",
+        type=int,
+        default=DEFAULT_UPLOAD_SLOTS_PER_PEER,
+        help="Number of chunk uploads to run at once to a single peer",
+    )
+    input_args_parser.add_argument(
+        "--upload_queue_size",
+        type=int,
+        default=DEFAULT_UPLOAD_QUEUE_SIZE,
+        help="Number of chunk requests that may wait for an upload slot "
+        "before peers are told this node is busy",
+    )
     input_args_parser.add_argument(
         "--debug_commands",
         type=str,
@@ -90,6 +114,11 @@ def run_backend() -> None:
     loop.create_task(send_my_pub_key())
 
     shutdown_flag = threading.Event()
+    configure_upload_limiter(
+        slots=arguments.upload_slots,
+        slots_per_peer=arguments.upload_slots_per_peer,
+        queue_size=arguments.upload_queue_size,
+    )
     listen_server = loop.run_until_complete(
         start_listen_server(arguments.ip[0], arguments.port[0]),
     )
@@ -120,6 +149,7 @@ def run_backend() -> None:
         frontend_server.close()
         dps_send.cancel()
         sync_processor.cancel()
+        get_connection_pool().close()
         loop.run_until_complete(loop.shutdown_asyncgens())
         loop.stop()
         loop.close()
@@ -36,19 +36,43 @@ DEFAULT_PKS_CONFIG_FILE = "PublicKeyStore.config"
 DEFAULT_DPS_CONFIG_FILE = "DropPeerStore.config"
 #: Location of metadata lookup dir (in init dir)
 DEFAULT_METADATA_LOOKUP_LOCATION = "drops"
+#: Sync job table file name (in init dir)
+DEFAULT_SYNC_JOBS_FILE = "sync_jobs"
+#: Hash cache file name (in init dir)
+DEFAULT_HASH_CACHE_FILE = "hash_cache"
 
 # file_metadata constants
 DEFAULT_CHUNK_SIZE = 2**23  #: Default chunk size. Don't change this
+#: Size of the blocks a partly downloaded chunk is split into, so the rest of
+#: it can be fetched with block requests
+DEFAULT_BLOCK_SIZE = 2**20
+#: Bytes read at a time when hashing a file.  Each file being hashed uses one
+#: buffer this big
+HASH_BLOCK_SIZE = 2**20
+#: Files modified less than this many seconds before they are hashed aren't
+#: put in the hash cache, since another change in the same timestamp tick
+#: wouldn't change their stat signature
+HASH_CACHE_MIN_AGE = 2
 #: directory of file metadata files in the drop
 DEFAULT_FILE_METADATA_LOCATION = os.path.join(DEFAULT_INIT_DIR, "files")
 #: directory of drop metadata files in the drop
 DEFAULT_DROP_METADATA_LOCATION = os.path.join(DEFAULT_INIT_DIR, "drop")
+#: directory of the journals of which chunks of each file are downloaded
+DEFAULT_CHUNK_JOURNAL_LOCATION = os.path.join(DEFAULT_INIT_DIR, "chunks")
 
 #: Default set of files/folders to ignore when creating/updating a drop
 DEFAULT_IGNORE = [DEFAULT_INIT_DIR]
 
 # File constants
 DEFAULT_INCOMPLETE_EXT = ".part"  #: Extension to add to incomplete files
+#: Most drop files to keep open for reading and writing chunks.  The least
+#: recently used one is closed when another is opened
+MAX_OPEN_FILES = 64
+#: Memory map the drop files that are kept open, so chunks are read and
+#: hashed straight from the page cache without being copied.  Meant for
+#: seeding nodes.  A mapped file that is truncated by something other than
+#: the node crashes it with SIGBUS when that part is read
+USE_MMAP = False
 
 # Request types
 # TODO: make an enum
@@ -57,24 +81,142 @@ REQUEST_TYPE_FILE_METADATA = 2
 REQUEST_TYPE_CHUNK_LIST = 3
 REQUEST_TYPE_CHUNK = 4
 REQUEST_TYPE_NEW_DROP_METADATA = 5
+#: Like REQUEST_TYPE_CHUNK, but answered with a header frame followed by the
+#: raw chunk bytes.  Only valid on framed connections
+REQUEST_TYPE_RAW_CHUNK = 6
+#: Chunk availability bitmaps for every (or some) file in a drop
+REQUEST_TYPE_DROP_CHUNK_BITMAPS = 7
+#: Seconds to wait for a drop chunk bitmaps response.  Older nodes may never
+#: answer the request at all
+DROP_CHUNK_BITMAPS_TIMEOUT = 10
+#: A run of consecutive raw chunks, answered with a header frame holding the
+#: count followed by a RAW_CHUNK response per chunk.  Only valid on framed
+#: connections
+REQUEST_TYPE_RAW_CHUNK_RANGE = 8
+#: Most chunks that will be sent in response to one range request.  A peer
+#: answers the requests on a connection in order, so ranges go on a pooled
+#: connection of their own rather than holding up other requests
+MAX_CHUNKS_PER_RANGE = 64
+#: Part of a raw chunk, answered like REQUEST_TYPE_RAW_CHUNK.  Only valid on
+#: framed connections
+REQUEST_TYPE_RAW_BLOCK = 9
 
 #: The protocol version; not currently well used
 PROTOCOL_VERSION = 1
 
+# Request deadlines
+#: Seconds to wait for a peer to accept a connection
+PEER_CONNECT_TIMEOUT = 5
+#: Seconds to wait for the response to a small (bencoded) request, counted
+#: from when the requests ahead of it on the connection have been answered
+PEER_READ_TIMEOUT = 20
+#: Seconds a peer may go without sending anything while streaming chunks,
+#: which can take much longer than PEER_READ_TIMEOUT as a whole
+PEER_STALL_TIMEOUT = 20
+#: Seconds a hedged request waits on a peer before also asking the next one
+HEDGE_REQUEST_DELAY = 0.5
+#: Most peers a hedged request is sent to at once
+MAX_HEDGED_REQUESTS = 2
+
+# Framed (persistent) connections
+#: Sent by a client to switch a connection to length framed requests.  Can't
+#: start with ``d``, which is how every one-shot bencoded request starts
+FRAMED_PROTOCOL_MAGIC = b'5YNCR-FRAMED-1'
+#: Largest frame that will be accepted from a peer, in bytes
+MAX_FRAME_SIZE = 2**26
+#: Seconds to wait for a peer to acknowledge the framed protocol before
+#: falling back to one-shot requests
+FRAMED_HANDSHAKE_TIMEOUT = 5
+#: Seconds an idle pooled connection is kept open by the client
+POOLED_CONNECTION_IDLE_TIMEOUT = 60
+#: Seconds an idle framed connection is kept open by the listen server.  Must
+#: be larger than POOLED_CONNECTION_IDLE_TIMEOUT so clients close first
+FRAMED_CONNECTION_IDLE_TIMEOUT = 120
+#: Most bytes of a raw chunk to read off a connection and write at a time.
+#: Also the read buffer limit of pooled connections, which bounds the memory
+#: used per in-flight chunk
+STREAM_BLOCK_SIZE = 2**20
+
 # Errnos
 # TODO: make an enum
 ERR_NEXIST = 0
 ERR_INCOMPAT = 1
 ERR_INVINPUT = 2
 ERR_EXCEPTION = 3
+#: The node has no upload slots free; try another peer
+ERR_BUSY = 4
 
 # Concurrency
-#: Maximum number of files to download at once
+#: Maximum number of drops to sync at once
+MAX_CONCURRENT_DROP_SYNCS = 4
+#: Maximum number of files per drop to download at once
 MAX_CONCURRENT_FILE_DOWNLOADS = 4
 #: Maximum number of chunks to download from a peer before trying another
 MAX_CHUNKS_PER_PEER = 8
-#: Maximum number of chunks to download at a time per file
-MAX_CONCURRENT_CHUNK_DOWNLOADS = 8
+#: Maximum number of chunk downloads to run at once, across every drop and
+#: file being synced
+MAX_TRANSFERS = 16
+#: Maximum number of bytes of chunks to have requested from peers and not
+#: yet received, across every drop and file.  Chunks fetched whole are held
+#: in memory until they are written, so this also bounds the memory they use
+MAX_TRANSFER_BYTES = 2**30
+#: Chunks more peers than this have are all treated as equally common when
+#: picking the rarest chunks to download first
+RAREST_FIRST_MAX_COUNT = 8
+#: When this few chunks of a file are left, fetch each of them from several
+#: peers at once and keep the first copy that arrives
+ENDGAME_CHUNKS = 4
+#: Most peers each chunk is fetched from at once at the end of a file
+ENDGAME_PEERS_PER_CHUNK = 3
+#: Seconds without any download of a file finishing before its last chunks
+#: are fetched from several peers at once
+ENDGAME_DELAY = 1
+
+# Sync jobs
+#: Priority of syncs a user asked for.  Lower priorities run first
+SYNC_PRIORITY_USER = 0
+#: Priority of syncs the node started on its own
+SYNC_PRIORITY_BACKGROUND = 1
+#: Seconds to wait before the first retry of a sync that didn't finish.  The
+#: wait doubles with each attempt after that
+SYNC_RETRY_BASE_DELAY = 5
+#: Most seconds to wait before retrying a sync
+SYNC_RETRY_MAX_DELAY = 3600
+#: Fraction of each retry wait that is random, so syncs that failed together
+#: don't all retry together
+SYNC_RETRY_JITTER = 0.5
+
+# Peer scoring
+#: Weight of each new sample in a peer's moving averages
+PEER_SCORE_ALPHA = 0.3
+#: Seconds after its last sample that what is known about a peer is forgotten
+PEER_SCORE_TTL = 600
+#: Fewest and most times MAX_CHUNKS_PER_PEER chunks a peer is given at once,
+#: depending on how fast it is compared to the other peers
+MIN_PEER_CHUNK_SHARE = 0.25
+MAX_PEER_CHUNK_SHARE = 4
+
+# Upload admission control
+#: Default number of chunk uploads the listen server runs at once
+DEFAULT_UPLOAD_SLOTS = 8
+#: Default number of chunk uploads the listen server runs at once to one peer
+DEFAULT_UPLOAD_SLOTS_PER_PEER = 2
+#: Default number of chunk requests that may wait for an upload slot
+DEFAULT_UPLOAD_QUEUE_SIZE = 16
+#: Seconds a chunk request waits for an upload slot before a busy response
+UPLOAD_QUEUE_TIMEOUT = 5
+#: Seconds to wait before trying peers that were busy again
+BUSY_RETRY_DELAY = 1
+#: Seconds a peer that was busy is put after the others when picking peers
+#: to download chunks from
+BUSY_PEER_TTL = 10
+
+# Bandwidth shaping
+#: Most bytes sent or received at a time when a bandwidth limit applies.
+#: Smaller is smoother but costs more CPU
+BANDWIDTH_QUANTUM = 2**16
+#: How many seconds worth of bytes a bandwidth limit lets through at once
+BANDWIDTH_BURST_TIME = 0.1
 
 
 # Frontend action types
@@ -90,6 +232,7 @@ ACTION_DELETE_DROP = 'delete_drop'
 ACTION_UNSUBSCRIBE = 'unsubscribe'
 ACTION_NEW_VERSION = 'new_version'
 ACTION_PENDING_CHANGES = 'get_pending_changes'
+ACTION_SET_BANDWIDTH_LIMITS = 'set_bandwidth_limits'
 
 # Frontend connection settings
 #: TCP address for frontend communication
@@ -1,5 +1,6 @@
 """Functions for initializing or adding a new drop"""
 import os
+from typing import Callable
 from typing import Dict
 from typing import List
 from typing import Optional  # noqa
@@ -15,6 +16,7 @@ from syncr_backend.metadata.drop_metadata import save_drop_location
 from syncr_backend.metadata.file_metadata import FileMetadata
 from syncr_backend.util import crypto_util
 from syncr_backend.util import fileio_util
+from syncr_backend.util.hash_cache_util import HashCache
 from syncr_backend.util.log_util import get_logger
 
 
@@ -59,28 +61,36 @@ async def make_drop_metadata(
     owner: bytes,
     other_owners: Dict[bytes, int]={},
     ignore: List[str]=[],
-    drop_id: Optional[bytes]=None
+    drop_id: Optional[bytes]=None,
+    progress: Optional[Callable[[int, int], None]]=None,
+    hash_cache: Optional[HashCache]=None,
 ) -> Tuple[DropMetadata, Dict[str, FileMetadata]]:
     """
-    Makes drop metadata and file metadatas from a directory
+    Makes drop metadata and file metadatas from a directory.  The files are
+    hashed in parallel, see `file_metadata.make_files_metadata`
 
     :param path: The directory to make metadata from
     :param name: The name of the drop to create
     :param drop_id: The drop id of the drop metadata, must match the owner
     :param owner: The owner, must match the drop id
     :param other_owners: Other owners, may be empty
+    :param progress: Called with the bytes hashed so far and the total bytes \
+            as files are hashed
+    :param hash_cache: If given, files that haven't changed since they were \
+            put in it aren't hashed again
     :return: A tuple of the drop metadata, and a dict from file names to file \
              metadata
     """
     logger.info("creating drop metadata for drop name %s", drop_name)
     if drop_id is None:
         drop_id = drop_metadata.gen_drop_id(owner)
-    files = {}
-    for (dirpath, filename) in fileio_util.walk_with_ignore(path, ignore):
-        full_name = os.path.join(dirpath, filename)
-        files[full_name] = await file_metadata.make_file_metadata(
-            full_name, drop_id,
-        )
+    file_names = [
+        os.path.join(dirpath, filename)
+        for (dirpath, filename) in fileio_util.walk_with_ignore(path, ignore)
+    ]
+    files = await file_metadata.make_files_metadata(
+        file_names, drop_id, progress=progress, hash_cache=hash_cache,
+    )
 
     file_hashes = {
         os.path.relpath(name, path): m.file_id for (name, m) in files.items()
@@ -21,6 +21,7 @@ from syncr_backend.init import node_init
 from syncr_backend.init.node_init import get_full_init_directory
 from syncr_backend.init.node_init import load_private_key_from_disk
 from syncr_backend.util import crypto_util
+from syncr_backend.util import fileio_util
 from syncr_backend.util.async_util import async_cache
 from syncr_backend.util.crypto_util import load_public_key
 from syncr_backend.util.crypto_util import node_id_from_private_key
@@ -55,6 +56,9 @@ class DropVersion(object):
             return self.version == other.version and self.nonce == other.nonce
         return False
 
+    def __hash__(self) -> int:
+        return hash((self.version, self.nonce))
+
     def __lt__(self, other: object) -> bool:
         if not isinstance(other, DropVersion):
             raise TypeError(other)
@@ -226,6 +230,7 @@ class DropMetadata(object):
         self.unsubscribe()
         drop_loc = await get_drop_location(self.id)
         self.log.debug("deleteing drop folder: %s", self.id)
+        fileio_util.get_file_handle_cache().clear()
         shutil.rmtree(drop_loc)
 
     @staticmethod
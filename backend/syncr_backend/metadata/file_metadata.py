@@ -1,23 +1,38 @@
 """The file metadata object and related functions"""
+import asyncio
 import hashlib
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from math import ceil
+from typing import Callable
+from typing import Dict  # noqa
+from typing import Iterable
 from typing import List
 from typing import Optional
-from typing import Set  # noqa
+from typing import Tuple
 
 import aiofiles  # type: ignore
 import bencode  # type: ignore
 
+from syncr_backend.constants import DEFAULT_BLOCK_SIZE
+from syncr_backend.constants import DEFAULT_CHUNK_JOURNAL_LOCATION
 from syncr_backend.constants import DEFAULT_CHUNK_SIZE
 from syncr_backend.constants import DEFAULT_DROP_METADATA_LOCATION
 from syncr_backend.constants import DEFAULT_FILE_METADATA_LOCATION
+from syncr_backend.constants import DEFAULT_INCOMPLETE_EXT
+from syncr_backend.constants import HASH_BLOCK_SIZE
+from syncr_backend.constants import HASH_CACHE_MIN_AGE
 from syncr_backend.metadata import drop_metadata
 from syncr_backend.metadata.drop_metadata import DropMetadata
 from syncr_backend.util import crypto_util
 from syncr_backend.util import fileio_util
 from syncr_backend.util.async_util import async_cache
+from syncr_backend.util.bitmap_util import ChunkBitmap
+from syncr_backend.util.fileio_util import ChunkWriteGuard
+from syncr_backend.util.hash_cache_util import HashCache
+from syncr_backend.util.hash_cache_util import stat_signature
 from syncr_backend.util.log_util import get_logger
 
 
@@ -38,7 +53,16 @@ class FileMetadata(object):
         self.file_length = file_length
         self.chunk_size = chunk_size
         self._protocol_version = protocol_version
-        self._downloaded_chunks = None  # type: Optional[Set[int]]
+        self._downloaded_chunks = None  # type: Optional[ChunkBitmap]
+        #: Blocks written so far of chunks that are partly downloaded
+        self._partial_chunks = {}  # type: Dict[int, ChunkBitmap]
+        self._write_guard = None  # type: Optional[ChunkWriteGuard]
+        #: Where the chunk journal and the file are, once they are known
+        self._journal_path = None  # type: Optional[str]
+        self._full_name = None  # type: Optional[str]
+        self._journal_saving = False
+        self._journal_dirty = False
+        self.block_size = DEFAULT_BLOCK_SIZE
         self.num_chunks = ceil(file_length / chunk_size)
         self.drop_id = drop_id
         self._save_dir = None  # type: Optional[str]
@@ -148,9 +172,12 @@ class FileMetadata(object):
             )
         return self._save_dir
 
-    async def _calculate_downloaded_chunks(self) -> Set[int]:
+    async def _calculate_downloaded_chunks(self) -> ChunkBitmap:
         """Figure out what chunks are complete, similar to "hashing" in some
-        bittorrent clients
+        bittorrent clients.  If the chunk journal was saved since the file
+        last changed, it is used instead of hashing every chunk.  If the file
+        was written to since (say, by downloads that were cut short), only the
+        chunks in the journal are hashed, to check they are still intact
 
         :return: A set of chunk ids already downloaded
         """
@@ -163,14 +190,32 @@ class FileMetadata(object):
             ),
         )
         if dm is None:
-            return set()
+            return ChunkBitmap()
         if self.file_name is None:
             file_name = dm.get_file_name_from_id(self.file_id)
         else:
             file_name = self.file_name
         full_name = os.path.join((await self.save_dir), file_name)
-        downloaded_chunks = set()  # type: Set[int]
-        for chunk_idx in range(self.num_chunks):
+        self._full_name = full_name
+        self._journal_path = chunk_journal_path(
+            (await self.save_dir), self.file_id, file_name,
+        )
+
+        loop = asyncio.get_event_loop()
+        journaled = await loop.run_in_executor(
+            None, _read_chunk_journal, self._journal_path, full_name,
+            self.file_length,
+        )
+        to_check = range(self.num_chunks)  # type: Iterable[int]
+        if journaled is not None:
+            journaled_chunks, unchanged = journaled
+            if unchanged:
+                self.log.debug("read downloaded chunks from journal")
+                return journaled_chunks
+            to_check = journaled_chunks
+
+        downloaded_chunks = ChunkBitmap()
+        for chunk_idx in to_check:
             try:
                 _, h = await fileio_util.read_chunk(
                     filepath=full_name,
@@ -178,14 +223,41 @@ class FileMetadata(object):
                     chunk_size=self.chunk_size,
                 )
             except FileNotFoundError:
-                return set()
+                return ChunkBitmap()
             if h == self.hashes[chunk_idx]:
                 downloaded_chunks.add(chunk_idx)
         self.log.debug("calculated downloaded chunks: %s", downloaded_chunks)
+        self._downloaded_chunks = downloaded_chunks
+        await self.save_journal()
         return downloaded_chunks
 
+    async def save_journal(self) -> None:
+        """Save the downloaded chunks to the chunk journal, along with the
+        size and modification time the file has now.  Saves that are asked
+        for while one is running are folded into one more save after it.
+        Also call this once writes to the file stop, so the journal has the
+        modification time of the last one
+        """
+        self._journal_dirty = True
+        journal_path, full_name = self._journal_path, self._full_name
+        if self._journal_saving or journal_path is None or full_name is None:
+            return
+        self._journal_saving = True
+        loop = asyncio.get_event_loop()
+        try:
+            while self._journal_dirty:
+                self._journal_dirty = False
+                await loop.run_in_executor(
+                    None, _write_chunk_journal, journal_path, full_name,
+                    (await self.downloaded_chunks).copy(),
+                )
+        except OSError as e:
+            self.log.warning("could not save chunk journal: %s", e)
+        finally:
+            self._journal_saving = False
+
     @property
-    async def downloaded_chunks(self) -> Set[int]:
+    async def downloaded_chunks(self) -> ChunkBitmap:
         """Property of which chunks are downloaded
         Note: does not automatically update, call `finish_chunk` to do that
 
@@ -196,12 +268,12 @@ class FileMetadata(object):
         return self._downloaded_chunks
 
     @property
-    async def needed_chunks(self) -> Set[int]:
+    async def needed_chunks(self) -> ChunkBitmap:
         """The oposite of downloaded chunks, what chunks are needed
 
         :return: A set of chunk ids that are needed
         """
-        all_chunks = {x for x in range(self.num_chunks)}
+        all_chunks = ChunkBitmap.full(self.num_chunks)
         return all_chunks - (await self.downloaded_chunks)
 
     @property
@@ -221,7 +293,84 @@ class FileMetadata(object):
         :param chunk_id: The chunk that's done
         """
         self.log.debug("finishing chunk %s", chunk_id)
+        self._partial_chunks.pop(chunk_id, None)
         (await self.downloaded_chunks).add(chunk_id)
+        await self.save_journal()
+
+    def chunk_length(self, chunk_id: int) -> int:
+        """The length of a chunk, which is less than chunk_size for the last
+
+        :param chunk_id: The chunk
+        :return: The length in bytes
+        """
+        remaining = self.file_length - chunk_id * self.chunk_size
+        return max(0, min(self.chunk_size, remaining))
+
+    @property
+    def partial_chunks(self) -> ChunkBitmap:
+        """The chunks that have some, but not all, blocks written
+
+        :return: A ChunkBitmap of chunk ids
+        """
+        return ChunkBitmap(self._partial_chunks)
+
+    def needed_blocks(self, chunk_id: int) -> ChunkBitmap:
+        """The blocks of a chunk that haven't been written yet
+
+        :param chunk_id: The chunk
+        :return: A ChunkBitmap of block ids.  Block i starts at byte \
+        i * block_size of the chunk
+        """
+        num_blocks = ceil(self.chunk_length(chunk_id) / self.block_size)
+        written = self._partial_chunks.get(chunk_id, ChunkBitmap())
+        return ChunkBitmap.full(num_blocks) - written
+
+    @property
+    def write_guard(self) -> ChunkWriteGuard:
+        """The guard chunks of this file are streamed in under, so a chunk
+        can be taken over by another download of it
+
+        :return: The ChunkWriteGuard
+        """
+        if self._write_guard is None:
+            self._write_guard = ChunkWriteGuard()
+        return self._write_guard
+
+    def finish_blocks(self, chunk_id: int, blocks: Iterable[int]) -> None:
+        """Mark blocks of a chunk written.  The chunk itself isn't finished
+        until it has been verified, see `finish_chunk`.  Does nothing if the
+        chunk was taken over, since its blocks weren't written
+
+        :param chunk_id: The chunk
+        :param blocks: The block ids
+        """
+        if chunk_id in self.write_guard.taken:
+            return
+        written = self._partial_chunks.setdefault(chunk_id, ChunkBitmap())
+        written |= ChunkBitmap(blocks)
+
+    def finish_chunk_prefix(self, chunk_id: int, length: int) -> None:
+        """Mark the blocks of a chunk covered by its first length bytes
+        written, for when a transfer of the whole chunk breaks part way
+
+        :param chunk_id: The chunk
+        :param length: How many bytes from the start of the chunk are written
+        """
+        if length >= self.chunk_length(chunk_id):
+            blocks = ceil(length / self.block_size)
+        else:
+            blocks = length // self.block_size
+        if blocks:
+            self.finish_blocks(chunk_id, range(blocks))
+
+    def discard_blocks(self, chunk_id: int) -> None:
+        """Forget the written blocks of a chunk, ie after it fails
+        verification
+
+        :param chunk_id: The chunk
+        """
+        self.log.debug("discarding blocks of chunk %s", chunk_id)
+        self._partial_chunks.pop(chunk_id, None)
 
     def __eq__(self, other: object) -> bool:
         """
@@ -244,43 +393,79 @@ class FileMetadata(object):
             return True
 
 
-async def file_hashes(
-    f: aiofiles.threadpool.AsyncBufferedReader,
-    chunk_size: int=DEFAULT_CHUNK_SIZE,
-) -> List[bytes]:
-    """Given an open file in mode 'rb', hash its chunks and return a list of
-    the hashes
+def chunk_journal_path(save_dir: str, file_id: bytes, file_name: str) -> str:
+    """Where the chunk journal of a file in a drop is saved
 
-    :param f: open file
-    :param chunk_size: the chunk size to use, probably don't change this
-    :return: list of hashes
+    :param save_dir: where the drop is saved
+    :param file_id: the file id
+    :param file_name: the file's name in the drop
+    :return: the path of the journal
     """
-    hashes = []
-
-    b = await f.read(chunk_size)
-    while len(b) > 0:
-        hashes.append(await crypto_util.hash(b))
+    return os.path.join(
+        save_dir, DEFAULT_CHUNK_JOURNAL_LOCATION,
+        crypto_util.b64encode(
+            hashlib.sha256(file_id + file_name.encode()).digest(),
+        ).decode('utf-8'),
+    )
 
-        b = await f.read(chunk_size)
 
-    return hashes
+def _stat_file(full_name: str) -> os.stat_result:
+    """Stat the file, or its incomplete version if it isn't done"""
+    if not fileio_util.is_complete(full_name):
+        full_name += DEFAULT_INCOMPLETE_EXT
+    return os.stat(full_name)
 
 
-async def hash_file(
-    f: aiofiles.threadpool.AsyncBufferedReader,
-) -> bytes:
-    """Hash a file
+def _read_chunk_journal(
+    journal_path: str, full_name: str, file_length: int,
+) -> Optional[Tuple[ChunkBitmap, bool]]:
+    """Read a chunk journal saved by `_write_chunk_journal`
 
-    :param f: An open file, seeked to 0
-    :return: The hash bytes
+    :return: The downloaded chunks, and whether the file is unchanged since \
+            they were saved.  None if there is no journal, or the file isn't \
+            the size it was when it was saved
     """
-    sha = hashlib.sha256()
-    while True:
-        data = await f.read()
-        if not data:
-            break
-        sha.update(data)
-    return sha.digest()
+    try:
+        with open(journal_path, 'rb') as f:
+            journal = bencode.decode(f.read())
+        stat = _stat_file(full_name)
+    except OSError:
+        return None
+    except Exception as e:
+        logger.warning("unreadable chunk journal %s: %s", journal_path, e)
+        return None
+    if (
+        stat.st_size != file_length or
+        journal.get('length') != stat.st_size
+    ):
+        logger.info("file %s changed size since its chunk journal", full_name)
+        return None
+    unchanged = journal.get('mtime') == stat.st_mtime_ns
+    if not unchanged:
+        logger.info("file %s written to since its chunk journal", full_name)
+    chunks = journal['chunks']
+    # bencode decodes byte strings that happen to be utf-8 to str
+    if isinstance(chunks, str):
+        chunks = chunks.encode('utf-8')
+    return ChunkBitmap.from_bytes(chunks), unchanged
+
+
+def _write_chunk_journal(
+    journal_path: str, full_name: str, chunks: ChunkBitmap,
+) -> None:
+    """Save which chunks of a file are downloaded, with the file's size and
+    modification time to tell if it has changed since"""
+    stat = _stat_file(full_name)
+    journal = {
+        'length': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'chunks': chunks.to_bytes(),
+    }
+    os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+    temp_path = journal_path + DEFAULT_INCOMPLETE_EXT
+    with open(temp_path, 'wb') as f:
+        f.write(bencode.encode(journal))
+    os.replace(temp_path, journal_path)
 
 
 async def make_file_metadata(filename: str, drop_id: bytes) -> FileMetadata:
@@ -290,15 +475,134 @@ async def make_file_metadata(filename: str, drop_id: bytes) -> FileMetadata:
     :return: FileMetadata object
     """
     size = os.path.getsize(filename)
-    async with aiofiles.open(filename, 'rb') as f:
-
-        hashes = await file_hashes(f)
-        await f.seek(0)
-        file_id = await hash_file(f)
+    loop = asyncio.get_event_loop()
+    hashes, file_id = await loop.run_in_executor(
+        None, _hash_file_contents, filename,
+    )
 
     return FileMetadata(hashes, file_id, size, drop_id)
 
 
+def _hash_file_contents(
+    filename: str, chunk_size: int=DEFAULT_CHUNK_SIZE,
+    block_size: int=HASH_BLOCK_SIZE,
+) -> Tuple[List[bytes], bytes]:
+    """Hash the chunks of a file and the whole file in one pass.  Every block
+    read goes into the same reused buffer, and is fed to both the hash of its
+    chunk and the hash of the file, so memory use doesn't grow with the file
+    or chunk size.  Blocks, so it should be run in an executor
+
+    :param filename: The file to hash
+    :param chunk_size: the chunk size to use, probably don't change this
+    :param block_size: How much to read at a time
+    :return: A tuple of the chunk hashes and the file id
+    """
+    hashes = []
+    file_sha = hashlib.sha256()
+    view = memoryview(bytearray(min(block_size, chunk_size)))
+    with open(filename, 'rb', buffering=0) as f:
+        while True:
+            chunk_sha = hashlib.sha256()
+            chunk_read = 0
+            while chunk_read < chunk_size:
+                n = f.readinto(view[:chunk_size - chunk_read])
+                if not n:
+                    break
+                chunk_sha.update(view[:n])
+                file_sha.update(view[:n])
+                chunk_read += n
+            if chunk_read:
+                hashes.append(chunk_sha.digest())
+            if chunk_read < chunk_size:
+                break
+    return hashes, file_sha.digest()
+
+
+async def make_files_metadata(
+    filenames: List[str], drop_id: bytes, workers: Optional[int]=None,
+    progress: Optional[Callable[[int, int], None]]=None,
+    hash_cache: Optional[HashCache]=None,
+) -> Dict[str, FileMetadata]:
+    """Make FileMetadata objects for many files at once, hashing them on a
+    pool of threads (hashlib lets go of the GIL while it hashes, so they use
+    every core).  Each thread reads into one HASH_BLOCK_SIZE buffer, so
+    memory use is bounded by the number of threads
+
+    :param filenames: The names of the files to open and read
+    :param drop_id: The drop the files are in
+    :param workers: How many files to hash at once, otherwise one per CPU
+    :param progress: Called with the bytes hashed so far and the total bytes \
+            each time a file is done
+    :param hash_cache: If given, files it has hashes for that haven't changed \
+            since aren't hashed again (or counted in the progress), and the \
+            files that are hashed are added to it
+    :return: file name -> FileMetadata object, in the order of filenames
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    stats = {name: os.stat(name) for name in filenames}
+    sizes = {name: stat.st_size for (name, stat) in stats.items()}
+    cached = {}  # type: Dict[str, Tuple[List[bytes], bytes]]
+    if hash_cache is not None:
+        await hash_cache.load()
+        for name in filenames:
+            hit = hash_cache.get(name, stats[name])
+            if hit is not None:
+                cached[name] = hit
+        logger.debug("%s of %s files are cached", len(cached), len(filenames))
+    to_hash = [name for name in filenames if name not in cached]
+    total = sum(sizes[name] for name in to_hash)
+    hashed = 0
+
+    loop = asyncio.get_event_loop()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = {
+        loop.run_in_executor(executor, _hash_file_contents, name): name
+        for name in to_hash
+    }
+    try:
+        pending = set(futures)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED,
+            )
+            for future in done:
+                future.result()
+                hashed += sizes[futures[future]]
+            logger.debug("hashed %s of %s bytes", hashed, total)
+            if progress is not None:
+                progress(hashed, total)
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+    for future, name in futures.items():
+        cached[name] = future.result()
+        if hash_cache is not None and _can_cache(name, stats[name]):
+            hash_cache.put(name, stats[name], *cached[name])
+    if hash_cache is not None:
+        await hash_cache.save()
+
+    files = {}
+    for name in filenames:
+        hashes, file_id = cached[name]
+        files[name] = FileMetadata(hashes, file_id, sizes[name], drop_id)
+    return files
+
+
+def _can_cache(filename: str, stat: os.stat_result) -> bool:
+    """Whether a file's hashes can be cached under the stat it had before it
+    was hashed: it didn't change while it was hashed, and wasn't changed so
+    recently that another change could leave the stat the same"""
+    if time.time() - stat.st_mtime < HASH_CACHE_MIN_AGE:
+        return False
+    try:
+        return stat_signature(os.stat(filename)) == stat_signature(stat)
+    except OSError:
+        return False
+
+
 async def get_file_metadata_from_drop_id(
     drop_id: bytes, file_id: bytes,
 ) -> Optional[FileMetadata]:
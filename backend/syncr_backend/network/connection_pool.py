@@ -0,0 +1,421 @@
+"""Persistent, pipelined connections to peers"""
+import asyncio
+import time
+from collections import Counter
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import MutableMapping  # noqa
+from typing import Optional
+from typing import Tuple
+
+import bencode  # type: ignore
+from cachetools import TTLCache  # type: ignore
+
+from syncr_backend.constants import FRAMED_HANDSHAKE_TIMEOUT
+from syncr_backend.constants import FRAMED_PROTOCOL_MAGIC
+from syncr_backend.constants import PEER_CONNECT_TIMEOUT
+from syncr_backend.constants import POOLED_CONNECTION_IDLE_TIMEOUT
+from syncr_backend.constants import STREAM_BLOCK_SIZE
+from syncr_backend.constants import TRACKER_DROP_AVAILABILITY_TTL
+from syncr_backend.util import network_util
+from syncr_backend.util.log_util import get_logger
+
+
+logger = get_logger(__name__)
+
+#: Reads one response off a connection
+ResponseReader = Callable[[network_util.ResponseStream], Awaitable[Any]]
+
+
+async def read_bencoded_frame(reader: network_util.FrameReader) -> Any:
+    """Read a frame and bdecode it.  The default ResponseReader
+
+    :param reader: The stream to read from
+    :return: The decoded frame
+    """
+    return bencode.decode(await network_util.read_frame(reader))
+
+
+async def open_connection(
+    ip: str, port: int,
+) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """asyncio.open_connection, giving up after PEER_CONNECT_TIMEOUT
+
+    :param ip: Peer ip
+    :param port: Peer port
+    :raises PeerTimeoutException: If the peer doesn't accept the connection \
+            in time
+    :return: The reader and writer of the connection
+    """
+    try:
+        return await asyncio.wait_for(
+            asyncio.open_connection(ip, port, limit=STREAM_BLOCK_SIZE),
+            PEER_CONNECT_TIMEOUT,
+        )
+    except asyncio.TimeoutError as e:
+        logger.info("connecting to %s:%s timed out", ip, port)
+        raise network_util.PeerTimeoutException() from e
+
+
+class PeerConnection(object):
+    """A framed connection to a peer.  Requests may be pipelined: they are
+    written in order, and the server answers them in the same order, so each
+    request waits for the one before it to read its response before reading
+    its own.
+
+    If anything goes wrong mid request the connection is closed, since the
+    stream can no longer be trusted to be at a frame boundary.  A cancelled
+    request on a shared connection is the exception: whatever is left of its
+    response is read and thrown away in the background (see
+    `network_util.ResponseStream`), so the requests after it are not
+    disturbed
+    """
+
+    def __init__(
+        self, ip: str, port: int, reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter, shared: bool=True,
+    ) -> None:
+        self.ip = ip
+        self.port = port
+        self.shared = shared
+        self.closed = False
+        self.pending = 0
+        self.last_used = time.monotonic()
+        self._reader = reader
+        self._writer = writer
+        self._write_lock = asyncio.Lock()
+        self._last_turn = None  # type: Optional[asyncio.Future]
+
+    @staticmethod
+    async def open(
+        ip: str, port: int, shared: bool=True,
+    ) -> Optional['PeerConnection']:
+        """Connect to a peer and switch the connection to the framed protocol
+
+        :param ip: Peer ip
+        :param port: Peer port
+        :param shared: Whether requests will be pipelined on the connection. \
+                If not, it is closed when a request is cancelled rather than \
+                the response being skipped
+        :raises PeerTimeoutException: If the peer doesn't accept the \
+                connection within PEER_CONNECT_TIMEOUT
+        :return: The connection, or None if the peer only speaks the one-shot \
+                protocol
+        """
+        reader, writer = await open_connection(ip, port)
+        writer.write(FRAMED_PROTOCOL_MAGIC)
+        try:
+            await writer.drain()
+            ack = await asyncio.wait_for(
+                reader.readexactly(len(FRAMED_PROTOCOL_MAGIC)),
+                FRAMED_HANDSHAKE_TIMEOUT,
+            )
+        except (
+            asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError,
+        ):
+            ack = b''
+        if ack != FRAMED_PROTOCOL_MAGIC:
+            writer.close()
+            return None
+        return PeerConnection(ip, port, reader, writer, shared)
+
+    def is_idle(self) -> bool:
+        """Whether this connection has sat unused for long enough to close
+
+        :return: True if there are no pending requests and the connection \
+                has not been used for POOLED_CONNECTION_IDLE_TIMEOUT
+        """
+        idle_for = time.monotonic() - self.last_used
+        return not self.pending and idle_for > POOLED_CONNECTION_IDLE_TIMEOUT
+
+    def close(self) -> None:
+        """Close the connection.  Pending requests will fail"""
+        if not self.closed:
+            logger.debug("closing connection to %s:%s", self.ip, self.port)
+            self.closed = True
+            self._writer.close()
+
+    async def request(
+        self, request: Dict[str, Any],
+        read_response: ResponseReader=read_bencoded_frame,
+        timeout: Optional[float]=None, stall_timeout: Optional[float]=None,
+    ) -> Any:
+        """Send a request and read its response
+
+        :param request: The request dict
+        :param read_response: Reads the response off the stream it is \
+                given.  Must consume exactly one response, and should only \
+                raise if the connection can't be used any more.  If the \
+                request is cancelled, the rest of the response is skipped \
+                without it, or the connection closed if it isn't shared
+        :param timeout: (optional) Seconds read_response may take, counted \
+                from when the requests ahead of this one have been answered
+        :param stall_timeout: (optional) Seconds read_response may wait with \
+                nothing arriving.  Unlike timeout, this suits responses that \
+                take a long time to stream
+        :raises ConnectionClosedException: If the connection is or becomes \
+                unusable
+        :raises PeerTimeoutException: If read_response takes longer than \
+                timeout, or stalls for stall_timeout.  The connection is \
+                closed
+        :return: Whatever read_response returns
+        """
+        if self.closed:
+            raise network_util.ConnectionClosedException()
+        turn = asyncio.get_event_loop().create_future()
+        previous = None  # type: Optional[asyncio.Future]
+        stream = network_util.ResponseStream(
+            self._reader, request.get('request_type'), stall_timeout,
+        )
+        sent = False
+        self.pending += 1
+        try:
+            async with self._write_lock:
+                previous = self._last_turn
+                self._last_turn = turn
+                self._writer.write(
+                    network_util.encode_frame(bencode.encode(request)),
+                )
+                sent = True
+                await self._writer.drain()
+            await self._wait_turn(previous)
+            response = await asyncio.wait_for(read_response(stream), timeout)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            self._fail(turn)
+            raise network_util.ConnectionClosedException() from e
+        except asyncio.TimeoutError as e:
+            logger.info("%s:%s did not respond in time", self.ip, self.port)
+            self._fail(turn)
+            raise network_util.PeerTimeoutException() from e
+        except network_util.PeerTimeoutException:
+            logger.info("%s:%s stopped sending", self.ip, self.port)
+            self._fail(turn)
+            raise
+        except asyncio.CancelledError:
+            if not self.shared:
+                self._fail(turn)
+            elif sent:
+                self.pending += 1
+                asyncio.ensure_future(
+                    self._skip_response(previous, turn, stream),
+                )
+            raise
+        except BaseException:
+            self._fail(turn)
+            raise
+        finally:
+            self.pending -= 1
+        self.last_used = time.monotonic()
+        turn.set_result(True)
+        return response
+
+    async def _wait_turn(self, previous: Optional[asyncio.Future]) -> None:
+        if previous is not None:
+            await asyncio.wait([previous])
+            if not previous.result():
+                raise network_util.ConnectionClosedException()
+
+    async def _skip_response(
+        self, previous: Optional[asyncio.Future], turn: asyncio.Future,
+        stream: network_util.ResponseStream,
+    ) -> None:
+        """Read and throw away the rest of the response of a cancelled
+        request, once its turn comes, so the connection stays at a frame
+        boundary for the requests after it"""
+        try:
+            await self._wait_turn(previous)
+            await stream.skip()
+        except Exception as e:
+            logger.debug("could not skip a cancelled response: %s", e)
+            self._fail(turn)
+        else:
+            self.last_used = time.monotonic()
+            turn.set_result(True)
+        finally:
+            self.pending -= 1
+
+    def _fail(self, turn: asyncio.Future) -> None:
+        self.close()
+        if not turn.done():
+            turn.set_result(False)
+
+
+#: Identifies a pooled connection: (ip, port, bulk)
+ConnectionKey = Tuple[str, int, bool]
+
+
+class ConnectionPool(object):
+    """Keeps framed connections open per (ip, port), and remembers which
+    peers only speak the one-shot protocol.  Each peer gets two: one for
+    chunk transfers and one for everything else, since the peer answers the
+    requests on a connection one at a time, and a range of chunks would
+    otherwise hold up small requests like metadata and chunk lists for as
+    long as it takes to send"""
+
+    def __init__(self) -> None:
+        self._connections = {}  # type: Dict[ConnectionKey, PeerConnection]
+        # only kept while a connection is being looked up or opened
+        self._open_locks = {}  # type: Dict[ConnectionKey, asyncio.Lock]
+        self._open_lock_users = Counter()  # type: Counter[ConnectionKey]
+        self._oneshot_peers = TTLCache(
+            maxsize=1024, ttl=TRACKER_DROP_AVAILABILITY_TTL,
+        )  # type: MutableMapping[Tuple[str, int], bool]
+
+    async def get_connection(
+        self, ip: str, port: int, bulk: bool=False,
+    ) -> Optional[PeerConnection]:
+        """Get an open connection to a peer, connecting if there isn't one
+
+        :param ip: Peer ip
+        :param port: Peer port
+        :param bulk: Whether to get the connection for chunk transfers
+        :return: A connection, or None if the peer only speaks the one-shot \
+                protocol
+        """
+        key = (ip, port, bulk)
+        if (ip, port) in self._oneshot_peers:
+            return None
+        conn = self._connections.get(key)
+        if conn is not None and not (conn.closed or conn.is_idle()):
+            return conn
+        lock = self._open_locks.get(key)
+        if lock is None:
+            lock = self._open_locks[key] = asyncio.Lock()
+        self._open_lock_users[key] += 1
+        try:
+            async with lock:
+                conn = self._connections.get(key)
+                if conn is not None and (conn.closed or conn.is_idle()):
+                    conn.close()
+                    del self._connections[key]
+                    conn = None
+                if conn is None:
+                    self._drop_stale()
+                    conn = await PeerConnection.open(ip, port)
+                    if conn is None:
+                        logger.info(
+                            "%s:%s does not support framed requests",
+                            ip, port,
+                        )
+                        self._oneshot_peers[(ip, port)] = True
+                        return None
+                    self._connections[key] = conn
+                return conn
+        finally:
+            self._open_lock_users[key] -= 1
+            if not self._open_lock_users[key]:
+                del self._open_lock_users[key]
+                del self._open_locks[key]
+
+    def _drop_stale(self) -> None:
+        """Forget connections that are closed or idle, so ones to peers that
+        aren't asked again don't pile up"""
+        for key, conn in list(self._connections.items()):
+            if conn.closed or conn.is_idle():
+                conn.close()
+                del self._connections[key]
+
+    async def request(
+        self, ip: str, port: int, request: Dict[str, Any],
+        read_response: ResponseReader=read_bencoded_frame,
+        timeout: Optional[float]=None, stall_timeout: Optional[float]=None,
+        bulk: bool=False,
+    ) -> Any:
+        """Send a request over a pooled connection to a peer.  If that
+        connection turns out to be broken (for example, closed by the peer
+        while idle), retry once on a new one
+
+        :param ip: Peer ip
+        :param port: Peer port
+        :param request: The request dict
+        :param read_response: Reads the response off the connection
+        :param timeout: (optional) Seconds to wait for the response, see \
+                PeerConnection.request
+        :param stall_timeout: (optional) Seconds the response may stall, see \
+                PeerConnection.request
+        :param bulk: Whether to send it on the connection for chunk \
+                transfers
+        :raises FramingNotSupportedException: If the peer only speaks the \
+                one-shot protocol
+        :raises ConnectionClosedException: If the retry fails too
+        :raises PeerTimeoutException: If the peer doesn't connect or respond \
+                in time
+        :return: Whatever read_response returns
+        """
+        retried = False
+        while True:
+            conn = await self.get_connection(ip, port, bulk)
+            if conn is None:
+                raise network_util.FramingNotSupportedException()
+            try:
+                return await conn.request(
+                    request, read_response, timeout, stall_timeout,
+                )
+            except network_util.ConnectionClosedException:
+                if retried:
+                    raise
+                retried = True
+                logger.debug(
+                    "connection to %s:%s broke, reconnecting", ip, port,
+                )
+
+    async def request_dedicated(
+        self, ip: str, port: int, request: Dict[str, Any],
+        read_response: ResponseReader=read_bencoded_frame,
+        timeout: Optional[float]=None, stall_timeout: Optional[float]=None,
+    ) -> Any:
+        """Send a request over a connection of its own, which is closed once
+        the request is answered or cancelled.  For requests that are likely
+        to be given up on part way, so they neither wait behind the pooled
+        connections nor have the rest of their response read when cancelled
+
+        :param ip: Peer ip
+        :param port: Peer port
+        :param request: The request dict
+        :param read_response: Reads the response off the connection
+        :param timeout: (optional) Seconds to wait for the response, see \
+                PeerConnection.request
+        :param stall_timeout: (optional) Seconds the response may stall, see \
+                PeerConnection.request
+        :raises FramingNotSupportedException: If the peer only speaks the \
+                one-shot protocol
+        :raises ConnectionClosedException: If the connection breaks
+        :raises PeerTimeoutException: If the peer doesn't connect or respond \
+                in time
+        :return: Whatever read_response returns
+        """
+        if (ip, port) in self._oneshot_peers:
+            raise network_util.FramingNotSupportedException()
+        conn = await PeerConnection.open(ip, port, shared=False)
+        if conn is None:
+            self._oneshot_peers[(ip, port)] = True
+            raise network_util.FramingNotSupportedException()
+        try:
+            return await conn.request(
+                request, read_response, timeout, stall_timeout,
+            )
+        finally:
+            conn.close()
+
+    def close(self) -> None:
+        """Close every pooled connection"""
+        for conn in self._connections.values():
+            conn.close()
+        self._connections.clear()
+
+
+_pool_instance = None  # type: Optional[ConnectionPool]
+
+
+def get_connection_pool() -> ConnectionPool:
+    """
+    Get the connection pool shared by all outgoing requests
+
+    :return: The ConnectionPool
+    """
+    global _pool_instance
+    if _pool_instance is None:
+        _pool_instance = ConnectionPool()
+    return _pool_instance
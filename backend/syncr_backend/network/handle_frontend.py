@@ -20,6 +20,7 @@ from syncr_backend.constants import ACTION_INPUT_DROP_TO_SUBSCRIBE_TO
 from syncr_backend.constants import ACTION_NEW_VERSION
 from syncr_backend.constants import ACTION_PENDING_CHANGES
 from syncr_backend.constants import ACTION_REMOVE_OWNER
+from syncr_backend.constants import ACTION_SET_BANDWIDTH_LIMITS
 from syncr_backend.constants import ACTION_SHARE_DROP
 from syncr_backend.constants import ACTION_UNSUBSCRIBE
 from syncr_backend.constants import DEFAULT_DROP_METADATA_LOCATION
@@ -27,11 +28,15 @@ from syncr_backend.constants import ERR_EXCEPTION
 from syncr_backend.constants import ERR_INVINPUT
 from syncr_backend.constants import FRONTEND_TCP_ADDRESS
 from syncr_backend.constants import FRONTEND_UNIX_ADDRESS
+from syncr_backend.constants import SYNC_PRIORITY_USER
 from syncr_backend.init.drop_init import initialize_drop
 from syncr_backend.init.node_init import get_full_init_directory
 from syncr_backend.metadata.drop_metadata import DropMetadata
 from syncr_backend.metadata.drop_metadata import get_drop_location
 from syncr_backend.util import crypto_util
+from syncr_backend.util.bandwidth_util import DOWNLOAD
+from syncr_backend.util.bandwidth_util import get_bandwidth_shaper
+from syncr_backend.util.bandwidth_util import UPLOAD
 from syncr_backend.util.drop_util import check_for_changes
 from syncr_backend.util.drop_util import check_for_update
 from syncr_backend.util.drop_util import do_metadata_request
@@ -69,6 +74,7 @@ async def handle_frontend_request(
         ACTION_UNSUBSCRIBE: handle_unsubscribe,
         ACTION_NEW_VERSION: handle_make_new_version,
         ACTION_PENDING_CHANGES: handle_pending_changes,
+        ACTION_SET_BANDWIDTH_LIMITS: handle_set_bandwidth_limits,
     }  # type: Dict[str, Callable[[Dict[str, Any], asyncio.StreamWriter], Awaitable[None]]]  # noqa
 
     action = request['action']
@@ -369,7 +375,7 @@ async def handle_input_subscribe_drop(
         full_path = os.path.join(file_path, name)
 
         try:
-            await queue_sync(drop_id, full_path)
+            await queue_sync(drop_id, full_path, priority=SYNC_PRIORITY_USER)
             response = {
                 'status': 'ok',
                 'result': 'success',
@@ -510,6 +516,51 @@ async def handle_share_drop(
     await send_response(conn, response)
 
 
+async def handle_set_bandwidth_limits(
+    request: Dict[str, Any], conn: asyncio.StreamWriter,
+) -> None:
+    """
+    Handling function to limit upload and download rates, for the whole node
+    or for one drop.  Responds with all the limits now set
+
+    :param request: { \
+    "action": string, \
+    "drop_id": string (optional, limit all drops if left out), \
+    "upload": int (optional, bytes per second, 0 for no limit), \
+    "download": int (optional, bytes per second, 0 for no limit), \
+    }
+    :param conn: socket.accept() connection
+    :return: None
+    """
+    limits = {
+        direction: request.get(direction) for direction in (UPLOAD, DOWNLOAD)
+    }
+    if any(
+        rate is not None and (not isinstance(rate, int) or rate < 0)
+        for rate in limits.values()
+    ):
+        response = {
+            'status': 'error',
+            'error': ERR_INVINPUT,
+        }
+    else:
+        drop_id = None
+        if request.get('drop_id') is not None:
+            drop_id = crypto_util.b64decode(request['drop_id'])
+        shaper = get_bandwidth_shaper()
+        for direction, rate in limits.items():
+            if rate is not None:
+                shaper.set_limit(direction, rate, drop_id)
+        response = {
+            'status': 'ok',
+            'result': 'success',
+            'message': 'bandwidth limits set',
+            'limits': shaper.get_limits(),
+        }
+
+    await send_response(conn, response)
+
+
 async def handle_unsubscribe(
     request: Dict[str, Any], conn: asyncio.StreamWriter,
 ) -> None:
@@ -1,41 +1,67 @@
 """The recieve side of network communication"""
 import asyncio
+import functools
 import os
 import sys
 import threading
 from asyncio import AbstractEventLoop
-from typing import Optional  # noqa
+from typing import Optional
 
 import bencode  # type: ignore
 
+from syncr_backend.constants import DEFAULT_CHUNK_SIZE
 from syncr_backend.constants import DEFAULT_DROP_METADATA_LOCATION
+from syncr_backend.constants import ERR_BUSY
 from syncr_backend.constants import ERR_EXCEPTION
+from syncr_backend.constants import ERR_INCOMPAT
+from syncr_backend.constants import ERR_INVINPUT
 from syncr_backend.constants import ERR_NEXIST
+from syncr_backend.constants import FRAMED_CONNECTION_IDLE_TIMEOUT
+from syncr_backend.constants import FRAMED_PROTOCOL_MAGIC
+from syncr_backend.constants import MAX_CHUNKS_PER_RANGE
 from syncr_backend.constants import REQUEST_TYPE_CHUNK
 from syncr_backend.constants import REQUEST_TYPE_CHUNK_LIST
+from syncr_backend.constants import REQUEST_TYPE_DROP_CHUNK_BITMAPS
 from syncr_backend.constants import REQUEST_TYPE_DROP_METADATA
 from syncr_backend.constants import REQUEST_TYPE_FILE_METADATA
 from syncr_backend.constants import REQUEST_TYPE_NEW_DROP_METADATA
+from syncr_backend.constants import REQUEST_TYPE_RAW_BLOCK
+from syncr_backend.constants import REQUEST_TYPE_RAW_CHUNK
+from syncr_backend.constants import REQUEST_TYPE_RAW_CHUNK_RANGE
 from syncr_backend.metadata.drop_metadata import DropMetadata
 from syncr_backend.metadata.drop_metadata import DropVersion
 from syncr_backend.metadata.drop_metadata import get_drop_location
 from syncr_backend.metadata.file_metadata import get_file_metadata_from_drop_id
-from syncr_backend.util.fileio_util import read_chunk
+from syncr_backend.network.upload_limiter import get_upload_limiter
+from syncr_backend.util.bandwidth_util import get_bandwidth_shaper
+from syncr_backend.util.bandwidth_util import UPLOAD
+from syncr_backend.util.fileio_util import open_chunk
+from syncr_backend.util.fileio_util import read_chunk_bytes
 from syncr_backend.util.log_util import get_logger
+from syncr_backend.util.network_util import FramedWriter
+from syncr_backend.util.network_util import read_frame
+from syncr_backend.util.network_util import ResponseWriter
+from syncr_backend.util.network_util import send_raw_file_response
+from syncr_backend.util.network_util import send_raw_response
 from syncr_backend.util.network_util import send_response
+from syncr_backend.util.network_util import SyncrNetworkException
+from syncr_backend.util.network_util import Throttle
 
 
 logger = get_logger(__name__)
 
 
 async def request_dispatcher(
-    request: dict, writer: asyncio.StreamWriter,
+    request: dict, writer: ResponseWriter,
 ) -> None:
     """
-    Handle and dispatch requests
+    Handle and dispatch requests.  An upload request on a framed connection
+    is answered with ERR_BUSY at once if there's no upload slot free, since
+    the requests pipelined behind it would wait for the slot too
 
     :param request: dict containing request data
-    :param writer: StreamWriter to pass to the handle function
+    :param writer: StreamWriter or FramedWriter to pass to the handle \
+    function
     :return: None
     """
     function_map = {
@@ -43,11 +69,32 @@ async def request_dispatcher(
         REQUEST_TYPE_FILE_METADATA: handle_request_file_metadata,
         REQUEST_TYPE_CHUNK_LIST: handle_request_chunk_list,
         REQUEST_TYPE_CHUNK: handle_request_chunk,
+        REQUEST_TYPE_RAW_CHUNK: handle_request_raw_chunk,
+        REQUEST_TYPE_RAW_CHUNK_RANGE: handle_request_raw_chunk_range,
+        REQUEST_TYPE_RAW_BLOCK: handle_request_raw_block,
+        REQUEST_TYPE_DROP_CHUNK_BITMAPS: handle_request_drop_chunk_bitmaps,
         REQUEST_TYPE_NEW_DROP_METADATA: handle_request_new_drop_metadata,
     }
     req_type = request['request_type']
     logger.info("incomming request type: %s", req_type)
-    handle_function = function_map[req_type]
+    handle_function = function_map.get(req_type)
+
+    if handle_function is None:
+        logger.warning("unknown request type %s", req_type)
+        await send_response(writer, {'status': 'error', 'error': ERR_INVINPUT})
+        return
+
+    peer = None  # type: Optional[str]
+    limiter = get_upload_limiter()
+    if req_type in UPLOAD_REQUEST_TYPES:
+        peer = _peer_ip(writer)
+        if isinstance(writer, FramedWriter):
+            acquired = limiter.try_acquire(peer)
+        else:
+            acquired = await limiter.acquire(peer)
+        if not acquired:
+            await send_response(writer, {'status': 'error', 'error': ERR_BUSY})
+            return
 
     try:
         await handle_function(request, writer)
@@ -58,29 +105,97 @@ async def request_dispatcher(
             'message': 'unknown error',
         }
         await send_response(writer, response)
+    finally:
+        if peer is not None:
+            limiter.release(peer)
+
+
+#: Requests that send chunk data, and so need an upload slot
+UPLOAD_REQUEST_TYPES = frozenset([
+    REQUEST_TYPE_CHUNK,
+    REQUEST_TYPE_RAW_CHUNK,
+    REQUEST_TYPE_RAW_CHUNK_RANGE,
+    REQUEST_TYPE_RAW_BLOCK,
+])
+
+
+def _peer_ip(writer: ResponseWriter) -> str:
+    """
+    :param writer: StreamWriter or FramedWriter
+    :return: The ip of the other end of the connection
+    """
+    if isinstance(writer, FramedWriter):
+        writer = writer.writer
+    peername = writer.get_extra_info('peername')
+    if not peername:
+        return ''
+    return peername[0]
 
 
 async def async_handle_request(
     reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
 ) -> None:
-    """Handle a request by reading the data and passing it to dispatcher
+    """Handle a connection.  If it starts with FRAMED_PROTOCOL_MAGIC, serve
+    framed requests until the client closes it, otherwise read a single
+    one-shot request and pass it to the dispatcher
 
     :param reader: StreamReader
     :param writer: StreamWriter
     """
-    request = b''
-    while 1:
-        data = await reader.read()
-        if not data:
-            break
-        else:
-            request += data
-        logger.info('Data received')
+    try:
+        first = await reader.readexactly(1)
+    except asyncio.IncompleteReadError:
+        writer.close()
+        return
+
+    if first == FRAMED_PROTOCOL_MAGIC[:1]:
+        await handle_framed_requests(reader, writer)
+        return
+
+    request = first + await reader.read()
+    logger.info('Data received')
     await request_dispatcher(bencode.decode(request), writer)
 
 
+async def handle_framed_requests(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+) -> None:
+    """Acknowledge the framed protocol, then handle requests in order until
+    the connection is closed or idle for FRAMED_CONNECTION_IDLE_TIMEOUT.  The
+    first byte of FRAMED_PROTOCOL_MAGIC must already have been read
+
+    :param reader: StreamReader
+    :param writer: StreamWriter
+    """
+    try:
+        rest = await reader.readexactly(len(FRAMED_PROTOCOL_MAGIC) - 1)
+    except asyncio.IncompleteReadError:
+        writer.close()
+        return
+    if rest != FRAMED_PROTOCOL_MAGIC[1:]:
+        logger.warning("bad framed protocol handshake, closing")
+        writer.close()
+        return
+    writer.write(FRAMED_PROTOCOL_MAGIC)
+
+    framed_writer = FramedWriter(writer)
+    while True:
+        try:
+            request = await asyncio.wait_for(
+                read_frame(reader), FRAMED_CONNECTION_IDLE_TIMEOUT,
+            )
+        except (
+            asyncio.TimeoutError, asyncio.IncompleteReadError,
+            ConnectionError, SyncrNetworkException,
+        ):
+            break
+        logger.info('Framed data received')
+        await request_dispatcher(bencode.decode(request), framed_writer)
+    writer.close()
+
+
 async def handle_request_drop_metadata(
-    request: dict, writer: asyncio.StreamWriter,
+    request: dict, writer: ResponseWriter,
 ) -> None:
     """
     Handle a drop metadata request
@@ -93,7 +208,7 @@ async def handle_request_drop_metadata(
     "version": string (optional), \
     "nonce": string (optional) \
     }
-    :param writer: StreamWriter
+    :param writer: StreamWriter or FramedWriter
     :return: None
     """
     file_location = await get_drop_location(request['drop_id'])
@@ -127,7 +242,7 @@ async def handle_request_drop_metadata(
 
 
 async def handle_request_file_metadata(
-    request: dict, writer: asyncio.StreamWriter,
+    request: dict, writer: ResponseWriter,
 ) -> None:
     """
     Handles a request for a file metadata
@@ -139,7 +254,7 @@ async def handle_request_file_metadata(
     "file_id": string, \
     'drop_id": string \
     }
-    :param writer: StreamWriter
+    :param writer: StreamWriter or FramedWriter
     :return: None
     """
     request_file_metadata = await get_file_metadata_from_drop_id(
@@ -164,7 +279,7 @@ async def handle_request_file_metadata(
 
 
 async def handle_request_chunk_list(
-    request: dict, writer: asyncio.StreamWriter,
+    request: dict, writer: ResponseWriter,
 ) -> None:
     """
     Handles a request for a file chunk list avaiable on this node
@@ -174,9 +289,11 @@ async def handle_request_chunk_list(
     "protocol_version": int, \
     "request_type": CHUNK_LIST (int), \
     'drop_id": string, \
-    "file_id": string \
+    "file_id": string, \
+    "bitmap": int (optional, if true respond with a ChunkBitmap's bytes \
+    instead of a list) \
     }
-    :param writer: StreamWriter
+    :param writer: StreamWriter or FramedWriter
     :return: None
     """
     request_file_metadata = await get_file_metadata_from_drop_id(
@@ -195,29 +312,80 @@ async def handle_request_chunk_list(
         logger.info("sending chunk list")
         response = {
             'status': 'ok',
-            'response': list(chunks),
+            'response': (
+                chunks.to_bytes() if request.get('bitmap') else list(chunks)
+            ),
         }
 
     await send_response(writer, response)
 
 
-async def handle_request_chunk(
-    request: dict, writer: asyncio.StreamWriter,
+async def handle_request_drop_chunk_bitmaps(
+    request: dict, writer: ResponseWriter,
 ) -> None:
     """
-    Handles a request for a chunk that is avaliable on this chunk
+    Handles a request for which chunks of every file in a drop are avaiable
+    on this node.  The response is a list of [file_id, bitmap] pairs, with
+    bitmaps made by ``ChunkBitmap.to_bytes``.  Files this node has no
+    metadata for are left out
 
     :param request: \
     { \
     "protocol_version": int, \
-    "request_type": CHUNK (int), \
-    "file_id": string, \
-    'drop_id": string \
-    "index": string, \
+    "request_type": DROP_CHUNK_BITMAPS (int), \
+    'drop_id": string, \
+    "file_ids": list of strings (optional, defaults to every file) \
     }
-    :param writer: StreamWriter
+    :param writer: StreamWriter or FramedWriter
     :return: None
     """
+    drop_location = await get_drop_location(request['drop_id'])
+    request_drop_metadata = await DropMetadata.read_file(
+        id=request['drop_id'],
+        metadata_location=os.path.join(
+            drop_location, DEFAULT_DROP_METADATA_LOCATION,
+        ),
+    )
+
+    if request_drop_metadata is None:
+        logger.info("drop metadata not found, sending error")
+        response = {
+            'status': 'error',
+            'error': ERR_NEXIST,
+        }
+        await send_response(writer, response)
+        return
+
+    file_ids = request.get('file_ids')
+    if file_ids is None:
+        file_ids = request_drop_metadata.files.values()
+
+    bitmaps = []
+    for file_id in set(file_ids):
+        request_file_metadata = await get_file_metadata_from_drop_id(
+            request['drop_id'], file_id,
+        )
+        if request_file_metadata is None:
+            continue
+        chunks = await request_file_metadata.downloaded_chunks
+        bitmaps.append([file_id, chunks.to_bytes()])
+
+    logger.info("sending chunk bitmaps for %s files", len(bitmaps))
+    response = {
+        'status': 'ok',
+        'response': bitmaps,
+    }
+    await send_response(writer, response)
+
+
+async def _find_chunk_file(request: dict) -> Optional[str]:
+    """
+    Find the file a chunk request is for
+
+    :param request: A CHUNK, RAW_CHUNK, RAW_CHUNK_RANGE or RAW_BLOCK request
+    :return: The full path of the file (without DEFAULT_INCOMPLETE_EXT), or \
+    None if the file or drop metadata is not found
+    """
     request_file_metadata = await get_file_metadata_from_drop_id(
         request['drop_id'],
         request['file_id'],
@@ -231,20 +399,43 @@ async def handle_request_chunk(
     )
 
     if request_file_metadata is None or request_drop_metadata is None:
+        return None
+    file_name = request_drop_metadata.get_file_name_from_id(
+        request['file_id'],
+    )
+    return os.path.join(drop_location, file_name)
+
+
+async def handle_request_chunk(
+    request: dict, writer: ResponseWriter,
+) -> None:
+    """
+    Handles a request for a chunk that is avaliable on this chunk
+
+    :param request: \
+    { \
+    "protocol_version": int, \
+    "request_type": CHUNK (int), \
+    "file_id": string, \
+    'drop_id": string \
+    "index": string, \
+    }
+    :param writer: StreamWriter or FramedWriter
+    :return: None
+    """
+    file_path = await _find_chunk_file(request)
+    throttle = None  # type: Optional[Throttle]
+
+    if file_path is None:
         logger.info("chunk not found")
         response = {
             'status': 'error',
             'error': ERR_NEXIST,
         }
     else:
-        file_name = request_drop_metadata.get_file_name_from_id(
-            request['file_id'],
-        )
-        chunk = (await read_chunk(
-            os.path.join(
-                drop_location, file_name,
-            ), request['index'],
-        ))[0]
+        chunk = await read_chunk_bytes(file_path, request['index'])
+        # sent a quantum at a time, so the chunk doesn't go out in one burst
+        throttle = _upload_throttle(request)
         logger.info("sending chunk")
         logger.debug("chunk len: %s", len(chunk))
         response = {
@@ -252,11 +443,243 @@ async def handle_request_chunk(
             'response': chunk,
         }
 
-    await send_response(writer, response)
+    await send_response(writer, response, throttle)
+
+
+async def handle_request_raw_chunk(
+    request: dict, writer: ResponseWriter,
+) -> None:
+    """
+    Handles a request for a chunk that is avaliable on this node, sending a
+    header frame of {"status": "ok", "length": int} followed by the raw chunk
+    bytes.  Errors are sent as normal responses
+
+    :param request: \
+    { \
+    "protocol_version": int, \
+    "request_type": RAW_CHUNK (int), \
+    "file_id": string, \
+    'drop_id": string \
+    "index": string, \
+    }
+    :param writer: FramedWriter.  RAW_CHUNK requests on one-shot \
+    connections get an ERR_INCOMPAT response
+    :return: None
+    """
+    if not isinstance(writer, FramedWriter):
+        logger.info("raw chunk requested on a one-shot connection")
+        await send_response(writer, {'status': 'error', 'error': ERR_INCOMPAT})
+        return
+
+    file_path = await _find_chunk_file(request)
+
+    if file_path is None:
+        logger.info("chunk not found")
+        response = {
+            'status': 'error',
+            'error': ERR_NEXIST,
+        }
+        await send_response(writer, response)
+        return
+
+    try:
+        await _send_raw_chunk(
+            writer, file_path, request['index'],
+            throttle=_upload_throttle(request),
+        )
+    except Exception:
+        # the header has already been sent, so an error response now would
+        # be read as part of the chunk
+        logger.exception("failed sending raw chunk, closing connection")
+        writer.writer.close()
+
+
+async def handle_request_raw_chunk_range(
+    request: dict, writer: ResponseWriter,
+) -> None:
+    """
+    Handles a request for a run of consecutive chunks, sending a header
+    frame of {"status": "ok", "response": count} followed by a RAW_CHUNK style
+    response for each chunk in order.  A chunk that can't be read gets an
+    error response in its place
+
+    :param request: \
+    { \
+    "protocol_version": int, \
+    "request_type": RAW_CHUNK_RANGE (int), \
+    "file_id": string, \
+    'drop_id": string \
+    "index": int (the first chunk), \
+    "count": int (at most MAX_CHUNKS_PER_RANGE) \
+    }
+    :param writer: FramedWriter.  RAW_CHUNK_RANGE requests on one-shot \
+    connections get an ERR_INCOMPAT response
+    :return: None
+    """
+    if not isinstance(writer, FramedWriter):
+        logger.info("raw chunk range requested on a one-shot connection")
+        await send_response(writer, {'status': 'error', 'error': ERR_INCOMPAT})
+        return
+
+    start = request['index']
+    count = request['count']
+    if start < 0 or not 0 < count <= MAX_CHUNKS_PER_RANGE:
+        logger.info("invalid chunk range %s+%s", start, count)
+        await send_response(writer, {'status': 'error', 'error': ERR_INVINPUT})
+        return
+
+    file_path = await _find_chunk_file(request)
+
+    if file_path is None:
+        logger.info("chunk not found")
+        response = {
+            'status': 'error',
+            'error': ERR_NEXIST,
+        }
+        await send_response(writer, response)
+        return
+
+    logger.info("sending %s raw chunks from %s", count, start)
+    await send_response(writer, {'status': 'ok', 'response': count})
+    throttle = _upload_throttle(request)
+    try:
+        for index in range(start, start + count):
+            await _send_raw_chunk(writer, file_path, index, throttle=throttle)
+    except Exception:
+        # the client is partway through reading the range, so an error
+        # response now would be read as a chunk
+        logger.exception("failed sending chunk range, closing connection")
+        writer.writer.close()
+
+
+async def handle_request_raw_block(
+    request: dict, writer: ResponseWriter,
+) -> None:
+    """
+    Handles a request for part of a chunk, sending a header frame of
+    {"status": "ok", "length": int} followed by the raw bytes.  The response
+    is cut short if the chunk ends before offset + length
+
+    :param request: \
+    { \
+    "protocol_version": int, \
+    "request_type": RAW_BLOCK (int), \
+    "file_id": string, \
+    'drop_id": string \
+    "index": int, \
+    "offset": int (where the block starts within the chunk), \
+    "length": int \
+    }
+    :param writer: FramedWriter.  RAW_BLOCK requests on one-shot \
+    connections get an ERR_INCOMPAT response
+    :return: None
+    """
+    if not isinstance(writer, FramedWriter):
+        logger.info("raw block requested on a one-shot connection")
+        await send_response(writer, {'status': 'error', 'error': ERR_INCOMPAT})
+        return
+
+    offset = request['offset']
+    length = request['length']
+    if offset < 0 or length <= 0 or offset + length > DEFAULT_CHUNK_SIZE:
+        logger.info("invalid block %s+%s", offset, length)
+        await send_response(writer, {'status': 'error', 'error': ERR_INVINPUT})
+        return
+
+    file_path = await _find_chunk_file(request)
+
+    if file_path is None:
+        logger.info("chunk not found")
+        response = {
+            'status': 'error',
+            'error': ERR_NEXIST,
+        }
+        await send_response(writer, response)
+        return
+
+    try:
+        await _send_raw_chunk(
+            writer, file_path, request['index'], offset=offset,
+            length=length, throttle=_upload_throttle(request),
+        )
+    except Exception:
+        # the header has already been sent, so an error response now would
+        # be read as part of the block
+        logger.exception("failed sending raw block, closing connection")
+        writer.writer.close()
+
+
+def _upload_throttle(request: dict) -> Optional[Throttle]:
+    """
+    :param request: A CHUNK, RAW_CHUNK, RAW_CHUNK_RANGE or RAW_BLOCK request
+    :return: A throttle that takes from the upload limits that apply to the \
+    request's drop, or None if there are none
+    """
+    drop_id = request['drop_id']
+    if isinstance(drop_id, str):
+        # bencode decodes byte strings that happen to be utf-8 to str
+        drop_id = drop_id.encode('utf-8')
+    shaper = get_bandwidth_shaper()
+    if not shaper.is_limited(UPLOAD, drop_id):
+        return None
+    return functools.partial(shaper.take, UPLOAD, drop_id=drop_id)
+
+
+async def _send_raw_chunk(
+    writer: FramedWriter, file_path: str, index: int, offset: int=0,
+    length: Optional[int]=None, throttle: Optional[Throttle]=None,
+) -> None:
+    """
+    Send one RAW_CHUNK response, or an ERR_NEXIST response if the chunk can't
+    be read
+
+    :param writer: FramedWriter
+    :param file_path: The full path of the file (without \
+    DEFAULT_INCOMPLETE_EXT)
+    :param index: The chunk index
+    :param offset: Only send the part of the chunk from offset
+    :param length: Send at most length bytes, or to the end of the chunk if \
+    None
+    :param throttle: Passed on to limit the upload rate
+    :return: None
+    """
+    not_found = {'status': 'error', 'error': ERR_NEXIST}
+    if not hasattr(asyncio.get_event_loop(), 'sendfile'):
+        # no loop.sendfile before python 3.7
+        try:
+            chunk = await read_chunk_bytes(file_path, index)
+        except OSError:
+            logger.info("chunk %s could not be read", index)
+            await send_response(writer, not_found)
+            return
+        end = len(chunk) if length is None else offset + length
+        chunk = chunk[offset:end]
+        logger.info("sending raw chunk")
+        logger.debug("chunk len: %s", len(chunk))
+        await send_raw_response(writer, chunk, throttle)
+        return
+
+    try:
+        f, chunk_offset, chunk_length = await open_chunk(file_path, index)
+    except OSError:
+        logger.info("chunk %s could not be read", index)
+        await send_response(writer, not_found)
+        return
+    send_length = max(0, chunk_length - offset)
+    if length is not None:
+        send_length = min(send_length, length)
+    try:
+        logger.info("sending raw chunk with sendfile")
+        logger.debug("chunk len: %s", send_length)
+        await send_raw_file_response(
+            writer, f, chunk_offset + offset, send_length, throttle,
+        )
+    finally:
+        f.close()
 
 
 async def handle_request_new_drop_metadata(
-    request: dict, writer: asyncio.StreamWriter,
+    request: dict, writer: ResponseWriter,
 ) -> None:
     """
     :param request: \
@@ -266,7 +689,7 @@ async def handle_request_new_drop_metadata(
     "latest_version_id": int, \
     "latest_version_nonce": int \
     }
-    :param writer: StreamWriter
+    :param writer: StreamWriter or FramedWriter
     :return: None
     """
     logger.warning("tried and failed to accept a new_drop_metadata request")
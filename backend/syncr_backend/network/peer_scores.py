@@ -0,0 +1,176 @@
+"""Keeps track of how fast and reliable peers have been lately"""
+from statistics import median
+from typing import List
+from typing import MutableMapping  # noqa
+from typing import Optional
+from typing import Tuple
+
+from cachetools import TTLCache  # type: ignore
+
+from syncr_backend.constants import MAX_PEER_CHUNK_SHARE
+from syncr_backend.constants import MIN_PEER_CHUNK_SHARE
+from syncr_backend.constants import PEER_SCORE_ALPHA
+from syncr_backend.constants import PEER_SCORE_TTL
+
+
+#: An (ip, port) pair
+Peer = Tuple[str, int]
+
+
+def _ewma(average: Optional[float], sample: float) -> float:
+    if average is None:
+        return sample
+    return average + PEER_SCORE_ALPHA * (sample - average)
+
+
+class PeerStats(object):
+    """Exponentially weighted moving averages of how a peer has done.  The
+    throughput and rtt are None until there has been a sample of them"""
+
+    def __init__(self) -> None:
+        #: Bytes per second of chunk transfers
+        self.throughput = None  # type: Optional[float]
+        #: Seconds small requests took to be answered
+        self.rtt = None  # type: Optional[float]
+        #: Fraction of requests that failed, from 0 to 1
+        self.failure_rate = 0.0
+
+    @property
+    def success_rate(self) -> float:
+        """
+        :return: Fraction of requests that succeeded, at least 0.05 so that \
+                scores stay finite
+        """
+        return max(0.05, 1 - self.failure_rate)
+
+
+class PeerScoreboard(object):
+    """PeerStats for every peer talked to lately, and ways to order peers by
+    them.  Peers nothing is known about count as average, so they still get
+    tried"""
+
+    def __init__(self) -> None:
+        self._stats = TTLCache(
+            maxsize=4096, ttl=PEER_SCORE_TTL,
+        )  # type: MutableMapping[Peer, PeerStats]
+
+    def get(self, peer: Peer) -> Optional[PeerStats]:
+        """
+        :param peer: The peer
+        :return: What is known about the peer, or None if nothing is
+        """
+        return self._stats.get(peer)
+
+    def _update(self, peer: Peer) -> PeerStats:
+        stats = self._stats.get(peer)
+        if stats is None:
+            stats = PeerStats()
+        # set it again so it's forgotten PEER_SCORE_TTL after the last sample
+        self._stats[peer] = stats
+        return stats
+
+    def record_response(self, peer: Peer, seconds: float) -> None:
+        """Record how long a small request to a peer took
+
+        :param peer: The peer
+        :param seconds: How long the request took
+        """
+        stats = self._update(peer)
+        stats.rtt = _ewma(stats.rtt, seconds)
+        stats.failure_rate = _ewma(stats.failure_rate, 0)
+
+    def record_transfer(self, peer: Peer, nbytes: int, seconds: float) -> None:
+        """Record a chunk transfer from a peer
+
+        :param peer: The peer
+        :param nbytes: How many bytes were transferred
+        :param seconds: How long it took
+        """
+        stats = self._update(peer)
+        if nbytes > 0 and seconds > 0:
+            stats.throughput = _ewma(stats.throughput, nbytes / seconds)
+        stats.failure_rate = _ewma(stats.failure_rate, 0)
+
+    def record_failure(self, peer: Peer) -> None:
+        """Record a request to a peer that failed
+
+        :param peer: The peer
+        """
+        stats = self._update(peer)
+        stats.failure_rate = _ewma(stats.failure_rate, 1)
+
+    def _rtts(self, peers: List[Peer]) -> List[Optional[float]]:
+        return [
+            None if stats is None or stats.rtt is None
+            else stats.rtt / stats.success_rate
+            for stats in map(self.get, peers)
+        ]
+
+    def _goodputs(self, peers: List[Peer]) -> List[Optional[float]]:
+        return [
+            None if stats is None or stats.throughput is None
+            else stats.throughput * stats.success_rate
+            for stats in map(self.get, peers)
+        ]
+
+    def by_latency(self, peers: List[Peer]) -> List[Peer]:
+        """Order peers by how soon they can be expected to answer a small
+        request, counting the requests that fail.  Peers that score the same
+        keep their order
+
+        :param peers: The peers
+        :return: A new list of the peers, quickest first
+        """
+        rtts = _fill_unknown(self._rtts(peers))
+        order = sorted(range(len(peers)), key=lambda i: rtts[i])
+        return [peers[i] for i in order]
+
+    def by_throughput(self, peers: List[Peer]) -> List[Peer]:
+        """Order peers by how fast they can be expected to send chunks,
+        counting the requests that fail.  Peers that score the same keep their
+        order
+
+        :param peers: The peers
+        :return: A new list of the peers, fastest first
+        """
+        goodputs = _fill_unknown(self._goodputs(peers))
+        order = sorted(range(len(peers)), key=lambda i: -goodputs[i])
+        return [peers[i] for i in order]
+
+    def chunk_share(self, peer: Peer, peers: List[Peer]) -> float:
+        """How many times its fair share of chunks to give a peer, going by
+        how fast it is compared to peers
+
+        :param peer: The peer
+        :param peers: The peers chunks are being shared between
+        :return: A factor from MIN_PEER_CHUNK_SHARE to MAX_PEER_CHUNK_SHARE, \
+                1 if the peers' speeds aren't known
+        """
+        goodputs = _fill_unknown(self._goodputs([peer] + peers))
+        average = sum(goodputs[1:]) / len(peers) if peers else 0
+        if not average:
+            return 1.0
+        share = goodputs[0] / average
+        return min(MAX_PEER_CHUNK_SHARE, max(MIN_PEER_CHUNK_SHARE, share))
+
+
+def _fill_unknown(values: List[Optional[float]]) -> List[float]:
+    """Replace unknown values with the median of the known ones (or 0)"""
+    known = [v for v in values if v is not None]
+    default = median(known) if known else 0.0
+    return [default if v is None else v for v in values]
+
+
+_scoreboard_instance = None  # type: Optional[PeerScoreboard]
+
+
+def get_peer_scoreboard() -> PeerScoreboard:
+    """
+    Get the scoreboard shared by all outgoing requests
+
+    :return: The PeerScoreboard
+    """
+    global _scoreboard_instance
+    if _scoreboard_instance is None:
+        _scoreboard_instance = PeerScoreboard()
+    return _scoreboard_instance
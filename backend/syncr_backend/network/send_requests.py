@@ -1,5 +1,6 @@
 """The send side of network communications"""
 import asyncio
+import functools
 from typing import Any
 from typing import Awaitable
 from typing import Callable
@@ -8,18 +9,39 @@ from typing import List
 from typing import Optional
 from typing import Tuple
 from typing import TypeVar
+from typing import Union
 
 import bencode  # type: ignore
 
+from syncr_backend.constants import BUSY_RETRY_DELAY
+from syncr_backend.constants import DEFAULT_CHUNK_SIZE
+from syncr_backend.constants import MAX_HEDGED_REQUESTS
+from syncr_backend.constants import PEER_READ_TIMEOUT
+from syncr_backend.constants import PEER_STALL_TIMEOUT
 from syncr_backend.constants import PROTOCOL_VERSION
 from syncr_backend.constants import REQUEST_TYPE_CHUNK
 from syncr_backend.constants import REQUEST_TYPE_CHUNK_LIST
+from syncr_backend.constants import REQUEST_TYPE_DROP_CHUNK_BITMAPS
 from syncr_backend.constants import REQUEST_TYPE_DROP_METADATA
 from syncr_backend.constants import REQUEST_TYPE_FILE_METADATA
+from syncr_backend.constants import REQUEST_TYPE_RAW_BLOCK
+from syncr_backend.constants import REQUEST_TYPE_RAW_CHUNK
+from syncr_backend.constants import REQUEST_TYPE_RAW_CHUNK_RANGE
+from syncr_backend.constants import STREAM_BLOCK_SIZE
 from syncr_backend.metadata.drop_metadata import DropMetadata
 from syncr_backend.metadata.drop_metadata import DropVersion
 from syncr_backend.metadata.file_metadata import FileMetadata
+from syncr_backend.network.connection_pool import get_connection_pool
+from syncr_backend.network.connection_pool import open_connection
+from syncr_backend.network.connection_pool import read_bencoded_frame
+from syncr_backend.network.peer_scores import get_peer_scoreboard
+from syncr_backend.util import crypto_util
+from syncr_backend.util import fileio_util
 from syncr_backend.util import network_util
+from syncr_backend.util.bandwidth_util import DOWNLOAD
+from syncr_backend.util.bandwidth_util import get_bandwidth_shaper
+from syncr_backend.util.bitmap_util import ChunkBitmap
+from syncr_backend.util.fileio_util import ChunkWriteGuard
 from syncr_backend.util.log_util import get_logger
 from syncr_backend.util.network_util import raise_network_error
 
@@ -33,31 +55,43 @@ async def do_request(
     request_fun: Callable[..., Awaitable[R]],
     peers: List[Tuple[str, int]],
     fun_args: Dict[str, Any],
+    hedge_after: Optional[float]=None,
 ) -> R:
     """Helper function for sending a request to many peers.  Will try calling
-    request_fun with fun_args for peers in peers until one succeeds
+    request_fun with fun_args for peers in peers until one succeeds.  Peers
+    that are busy are tried again after the rest, after BUSY_RETRY_DELAY
+
+    Peers are tried quickest first, going by how they have done lately.
+    Small requests can be hedged: if a peer hasn't answered after \
+    hedge_after seconds, the next peer is asked too (up to \
+    MAX_HEDGED_REQUESTS at once), the first answer is used and the other \
+    requests are cancelled.  Only hedge requests that are cheap to answer \
+    and safe to send twice
 
     :param request_fun: The request function.  Must take an ip, port, and \
     some number of kwargs
     :param peers: A list of peers to try to talk to
     :param fun_args: The arguments to pass to request_fun for each peer
+    :param hedge_after: (optional) Seconds to wait on a peer before also \
+    asking the next one.  Peers are asked one at a time if None
     :raises network_util.NoPeersException: If no peers are provided
     :return: The result of a successful call to request_fun
     """
-    result = None
-    last_err = Exception("This shouldn't happen")
     if not peers:
         logger.error("no peers provided to do_request")
         raise network_util.NoPeersException("no peers provided to do_request")
+    peers = get_peer_scoreboard().by_latency(peers)
 
-    for (ip, port) in peers:
-        try:
-            result = await request_fun(ip, port, **fun_args)
-        except (TimeoutError, network_util.SyncrNetworkException) as e:
-            last_err = e
-            pass
-        else:
-            break
+    result, busy_peers, last_err = await _try_peers(
+        request_fun, peers, fun_args, hedge_after,
+    )
+
+    if result is None and busy_peers:
+        logger.debug("retrying %s busy peers", len(busy_peers))
+        await asyncio.sleep(BUSY_RETRY_DELAY)
+        result, _, last_err = await _try_peers(
+            request_fun, busy_peers, fun_args, hedge_after,
+        )
 
     if result is None:
         logger.error("no good results from peers")
@@ -66,6 +100,78 @@ async def do_request(
     return result
 
 
+async def _try_peers(
+    request_fun: Callable[..., Awaitable[R]],
+    peers: List[Tuple[str, int]],
+    fun_args: Dict[str, Any],
+    hedge_after: Optional[float],
+) -> Tuple[Optional[R], List[Tuple[str, int]], Exception]:
+    """One pass of do_request over peers
+
+    :return: The first result (or None if every peer failed), the peers \
+    that were busy, and the last error
+    """
+    last_err = Exception("This shouldn't happen")
+    busy_peers = []  # type: List[Tuple[str, int]]
+    waiting = list(peers)
+    running = {}  # type: Dict[asyncio.Future, Tuple[str, int]]
+    max_running = 1 if hedge_after is None else MAX_HEDGED_REQUESTS
+    try:
+        while waiting or running:
+            if waiting and len(running) < max_running:
+                peer = waiting.pop(0)
+                running[
+                    asyncio.ensure_future(
+                        _timed_request(request_fun, peer, fun_args),
+                    )
+                ] = peer
+            can_hedge = bool(waiting) and len(running) < max_running
+            done, _ = await asyncio.wait(
+                list(running), timeout=hedge_after if can_hedge else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                logger.debug("no answer after %ss, hedging", hedge_after)
+            for task in done:
+                peer = running.pop(task)
+                try:
+                    return task.result(), busy_peers, last_err
+                except network_util.BusyException as e:
+                    last_err = e
+                    busy_peers.append(peer)
+                except (OSError, network_util.SyncrNetworkException) as e:
+                    last_err = e
+    finally:
+        for task in running:
+            task.cancel()
+    return None, busy_peers, last_err
+
+
+async def _timed_request(
+    request_fun: Callable[..., Awaitable[R]],
+    peer: Tuple[str, int],
+    fun_args: Dict[str, Any],
+) -> R:
+    """Call request_fun for peer, and record how it went on the peer
+    scoreboard"""
+    scoreboard = get_peer_scoreboard()
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    try:
+        result = await request_fun(*peer, **fun_args)
+    except network_util.BusyException:
+        raise
+    except asyncio.CancelledError:
+        # another peer answered first, so this one is at least this slow
+        scoreboard.record_response(peer, loop.time() - start)
+        raise
+    except (OSError, network_util.SyncrNetworkException):
+        scoreboard.record_failure(peer)
+        raise
+    scoreboard.record_response(peer, loop.time() - start)
+    return result
+
+
 async def send_drop_metadata_request(
     ip: str,
     port: int,
@@ -140,7 +246,7 @@ async def send_chunk_list_request(
     drop_id: bytes,
     file_id: bytes,
     protocol_version: Optional[int]=PROTOCOL_VERSION,
-) -> List[int]:
+) -> ChunkBitmap:
     """
     Sends chunk list request to node at ip and port
 
@@ -149,22 +255,72 @@ async def send_chunk_list_request(
     :param drop_id: the drop id
     :param file_id: file_id of the requested chunk list
     :param protocol_version: protocol_version of the request
-    :return: List[int] of indexes of the file
+    :return: ChunkBitmap of indexes of the file
     """
     request_dict = {
         'protocol_version': protocol_version,
         'request_type': REQUEST_TYPE_CHUNK_LIST,
         'file_id': file_id,
         'drop_id': drop_id,
+        'bitmap': 1,
     }
 
-    chunk_index_list = await send_request_to_node(
+    chunks = await send_request_to_node(
         request_dict,
         ip,
         port,
     )
     logger.debug("recieved chunk list")
-    return chunk_index_list
+    # older nodes ignore 'bitmap' and send a list of indexes
+    if isinstance(chunks, list):
+        return ChunkBitmap(chunks)
+    return ChunkBitmap.from_bytes(_as_bytes(chunks))
+
+
+async def send_drop_chunk_bitmaps_request(
+    ip: str,
+    port: int,
+    drop_id: bytes,
+    file_ids: Optional[List[bytes]]=None,
+    protocol_version: Optional[int]=PROTOCOL_VERSION,
+) -> Dict[bytes, ChunkBitmap]:
+    """
+    Sends drop chunk bitmaps request to node at ip and port, getting which
+    chunks of many files it has in one round trip
+
+    :param ip: ip address of node
+    :param port: port of the node
+    :param drop_id: the drop id
+    :param file_ids: the files to ask about, or None for every file
+    :param protocol_version: protocol_version of the request
+    :return: Dict from file_id to the chunks the node has. \
+    Files the node doesn't have are not included
+    """
+    request_dict = {
+        'protocol_version': protocol_version,
+        'request_type': REQUEST_TYPE_DROP_CHUNK_BITMAPS,
+        'drop_id': drop_id,
+    }  # type: Dict[str, Any]
+    if file_ids is not None:
+        request_dict['file_ids'] = file_ids
+
+    bitmaps = await send_request_to_node(
+        request_dict,
+        ip,
+        port,
+    )
+    logger.debug("recieved chunk bitmaps for %s files", len(bitmaps))
+    return {
+        _as_bytes(file_id): ChunkBitmap.from_bytes(_as_bytes(bitmap))
+        for file_id, bitmap in bitmaps
+    }
+
+
+def _as_bytes(b: Union[str, bytes]) -> bytes:
+    # bencode decodes byte strings that happen to be utf-8 to str
+    if isinstance(b, str):
+        return b.encode('utf-8')
+    return b
 
 
 async def send_chunk_request(
@@ -174,6 +330,7 @@ async def send_chunk_request(
     file_id: bytes,
     file_index: int,
     protocol_version: Optional[int]=PROTOCOL_VERSION,
+    dedicated: bool=False,
 ) -> bytes:
     """
     Sends chunk request to node at ip and port
@@ -184,6 +341,8 @@ async def send_chunk_request(
     :param file_id: file_id of the requested chunk
     :param file_index: index of the file for the chunk
     :param protocol_version: protocol_version of the request
+    :param dedicated: Whether to send it on a connection of its own, that is \
+    closed if the request is cancelled
     :return: bytes of the actual chunk
     """
     request_dict = {
@@ -194,20 +353,381 @@ async def send_chunk_request(
         'index': file_index,
     }
 
+    # a whole chunk can take longer than PEER_READ_TIMEOUT on a slow link
     chunk = await send_request_to_node(
         request_dict,
         ip,
         port,
+        timeout=None,
+        stall_timeout=PEER_STALL_TIMEOUT,
+        bulk=True,
+        dedicated=dedicated,
     )
     logger.debug("recieved chunk")
     if type(chunk) == str:
-        return chunk.encode('utf-8')
-    else:
-        return chunk
+        chunk = chunk.encode('utf-8')
+    # the chunk arrives in one frame, so it is charged once it is here
+    await get_bandwidth_shaper().take(DOWNLOAD, len(chunk), drop_id)
+    return chunk
+
+
+async def send_raw_chunk_request(
+    ip: str,
+    port: int,
+    drop_id: bytes,
+    file_id: bytes,
+    file_index: int,
+    filepath: str,
+    chunk_hash: bytes,
+    chunk_size: int=DEFAULT_CHUNK_SIZE,
+    protocol_version: Optional[int]=PROTOCOL_VERSION,
+) -> None:
+    """
+    Sends raw chunk request to node at ip and port, and streams the chunk
+    straight into its place in the file as it arrives.  Falls back to
+    send_chunk_request and write_chunk if the node only supports one-shot
+    requests
+
+    :param ip: ip address of node
+    :param port: port of the node
+    :param drop_id: the drop id
+    :param file_id: file_id of the requested chunk
+    :param file_index: index of the file for the chunk
+    :param filepath: the path of the file to write to
+    :param chunk_hash: the expected hash of the chunk
+    :param chunk_size: the chunk size of the file
+    :param protocol_version: protocol_version of the request
+    :raises crypto_util.VerificationException: When the chunk does not match \
+            chunk_hash
+    :return: None
+    """
+    request_dict = {
+        'protocol_version': protocol_version,
+        'request_type': REQUEST_TYPE_RAW_CHUNK,
+        'file_id': file_id,
+        'drop_id': drop_id,
+        'index': file_index,
+    }
+
+    async def read_response(
+        reader: network_util.ResponseStream,
+    ) -> Tuple[Dict[str, Any], Optional[Exception]]:
+        header = await read_bencoded_frame(reader)
+        if header['status'] != 'ok':
+            return header, None
+        try:
+            await fileio_util.write_chunk_from_stream(
+                filepath=filepath,
+                position=file_index,
+                reader=get_bandwidth_shaper().reader(reader, drop_id),
+                length=header['length'],
+                chunk_hash=chunk_hash,
+                chunk_size=chunk_size,
+            )
+        except ConnectionError:
+            raise
+        except (OSError, crypto_util.VerificationException) as e:
+            # the whole chunk was still read, so the connection is fine
+            return header, e
+        return header, None
+
+    try:
+        header, error = await get_connection_pool().request(
+            ip, port, request_dict, read_response,
+            stall_timeout=PEER_STALL_TIMEOUT, bulk=True,
+        )
+    except network_util.FramingNotSupportedException:
+        chunk = await send_chunk_request(
+            ip=ip,
+            port=port,
+            drop_id=drop_id,
+            file_id=file_id,
+            file_index=file_index,
+            protocol_version=protocol_version,
+        )
+        await fileio_util.write_chunk(
+            filepath=filepath,
+            position=file_index,
+            contents=chunk,
+            chunk_hash=chunk_hash,
+            chunk_size=chunk_size,
+        )
+        return
+
+    if header['status'] != 'ok':
+        raise_network_error(header['error'])
+    if error is not None:
+        raise error
+    logger.debug("recieved raw chunk")
+
+
+async def send_raw_chunk_range_request(
+    ip: str,
+    port: int,
+    drop_id: bytes,
+    file_id: bytes,
+    start: int,
+    count: int,
+    filepath: str,
+    hashes: List[bytes],
+    chunk_size: int=DEFAULT_CHUNK_SIZE,
+    progress: Optional[Callable[[int, int], None]]=None,
+    chunk_done: Optional[Callable[[int], Awaitable[None]]]=None,
+    guard: Optional[ChunkWriteGuard]=None,
+    protocol_version: Optional[int]=PROTOCOL_VERSION,
+) -> ChunkBitmap:
+    """
+    Sends a raw chunk range request to node at ip and port, for count chunks
+    starting at start.  Each chunk is streamed into its place in the file and
+    checked against its hash as it arrives, so one request keeps the
+    connection busy for the whole run.  Falls back to a chunk request per
+    chunk if the node only supports one-shot requests
+
+    :param ip: ip address of node
+    :param port: port of the node
+    :param drop_id: the drop id
+    :param file_id: file_id of the requested chunks
+    :param start: index of the first chunk
+    :param count: number of chunks, at most MAX_CHUNKS_PER_RANGE
+    :param filepath: the path of the file to write to
+    :param hashes: the hashes of every chunk in the file
+    :param chunk_size: the chunk size of the file
+    :param progress: (optional) called with a chunk index and how many bytes \
+            of it have been written, as they are written
+    :param chunk_done: (optional) awaited with each chunk index as soon as \
+            the chunk is written and verified
+    :param guard: (optional) the guard of the file, so chunks can be taken \
+            over by another download of them
+    :param protocol_version: protocol_version of the request
+    :return: The chunks that were written and verified.  Chunks that failed \
+            (missing on the node, or not matching their hash) or were taken \
+            over are left out
+    """
+    request_dict = {
+        'protocol_version': protocol_version,
+        'request_type': REQUEST_TYPE_RAW_CHUNK_RANGE,
+        'file_id': file_id,
+        'drop_id': drop_id,
+        'index': start,
+        'count': count,
+    }
+
+    async def read_response(
+        reader: network_util.ResponseStream,
+    ) -> Tuple[Dict[str, Any], ChunkBitmap]:
+        done = ChunkBitmap()
+        header = await read_bencoded_frame(reader)
+        if header['status'] != 'ok':
+            return header, done
+        body = get_bandwidth_shaper().reader(reader, drop_id)
+        for index in range(start, start + header['response']):
+            chunk_header = await read_bencoded_frame(reader)
+            if chunk_header['status'] != 'ok':
+                logger.debug(
+                    "chunk %s not sent: %s", index, chunk_header['error'],
+                )
+                continue
+            try:
+                written = await fileio_util.write_chunk_from_stream(
+                    filepath=filepath,
+                    position=index,
+                    reader=body,
+                    length=chunk_header['length'],
+                    chunk_hash=hashes[index],
+                    chunk_size=chunk_size,
+                    progress=(
+                        None if progress is None
+                        else functools.partial(progress, index)
+                    ),
+                    guard=guard,
+                )
+            except ConnectionError:
+                raise
+            except (OSError, crypto_util.VerificationException) as e:
+                # the whole chunk was still read, so carry on with the next
+                logger.warning("chunk %s from %s failed: %s", index, ip, e)
+                continue
+            if written:
+                done.add(index)
+                if chunk_done is not None:
+                    await chunk_done(index)
+        return header, done
+
+    try:
+        header, done = await get_connection_pool().request(
+            ip, port, request_dict, read_response,
+            stall_timeout=PEER_STALL_TIMEOUT, bulk=True,
+        )
+    except network_util.FramingNotSupportedException:
+        done = ChunkBitmap()
+        for index in range(start, start + count):
+            if guard is not None and index in guard.taken:
+                continue
+            try:
+                chunk = await send_chunk_request(
+                    ip=ip,
+                    port=port,
+                    drop_id=drop_id,
+                    file_id=file_id,
+                    file_index=index,
+                    protocol_version=protocol_version,
+                )
+                await fileio_util.write_chunk(
+                    filepath=filepath,
+                    position=index,
+                    contents=chunk,
+                    chunk_hash=hashes[index],
+                    chunk_size=chunk_size,
+                )
+            except (
+                crypto_util.VerificationException,
+                network_util.SyncrNetworkException,
+            ) as e:
+                logger.warning("chunk %s from %s failed: %s", index, ip, e)
+                continue
+            done.add(index)
+            if chunk_done is not None:
+                await chunk_done(index)
+        return done
+
+    if header['status'] != 'ok':
+        raise_network_error(header['error'])
+    logger.debug("recieved %s of %s raw chunks", len(done), count)
+    return done
+
+
+async def send_raw_block_request(
+    ip: str,
+    port: int,
+    drop_id: bytes,
+    file_id: bytes,
+    file_index: int,
+    offset: int,
+    length: int,
+    filepath: str,
+    chunk_size: int=DEFAULT_CHUNK_SIZE,
+    guard: Optional[ChunkWriteGuard]=None,
+    protocol_version: Optional[int]=PROTOCOL_VERSION,
+) -> None:
+    """
+    Sends raw block request to node at ip and port, and streams the block
+    into its place in the file.  Blocks aren't verified; check the chunk once
+    all of its blocks are written
+
+    :param ip: ip address of node
+    :param port: port of the node
+    :param drop_id: the drop id
+    :param file_id: file_id of the requested chunk
+    :param file_index: index of the chunk the block is in
+    :param offset: where the block starts within the chunk
+    :param length: the length of the block
+    :param filepath: the path of the file to write to
+    :param chunk_size: the chunk size of the file
+    :param guard: (optional) the guard of the file, so the chunk can be \
+            taken over by another download of it
+    :param protocol_version: protocol_version of the request
+    :raises FramingNotSupportedException: If the node only supports one-shot \
+            requests, which can't ask for blocks
+    :raises NotExistException: If the node sent less than length bytes
+    :return: None
+    """
+    request_dict = {
+        'protocol_version': protocol_version,
+        'request_type': REQUEST_TYPE_RAW_BLOCK,
+        'file_id': file_id,
+        'drop_id': drop_id,
+        'index': file_index,
+        'offset': offset,
+        'length': length,
+    }
+
+    async def read_response(
+        reader: network_util.ResponseStream,
+    ) -> Tuple[Dict[str, Any], Optional[Exception]]:
+        header = await read_bencoded_frame(reader)
+        if header['status'] != 'ok':
+            return header, None
+        try:
+            await fileio_util.write_block_from_stream(
+                filepath=filepath,
+                position=file_index,
+                offset=offset,
+                reader=get_bandwidth_shaper().reader(reader, drop_id),
+                length=header['length'],
+                chunk_size=chunk_size,
+                guard=guard,
+            )
+        except ConnectionError:
+            raise
+        except (OSError, ValueError) as e:
+            return header, e
+        return header, None
+
+    header, error = await get_connection_pool().request(
+        ip, port, request_dict, read_response,
+        stall_timeout=PEER_STALL_TIMEOUT, bulk=True,
+    )
+    if header['status'] != 'ok':
+        raise_network_error(header['error'])
+    if error is not None:
+        raise error
+    if header['length'] != length:
+        raise network_util.NotExistException(
+            "block cut short at %s of %s bytes" % (header['length'], length),
+        )
+    logger.debug("recieved raw block")
 
 
 async def send_request_to_node(
     request: Dict[str, Any], ip: str, port: int,
+    timeout: Optional[float]=PEER_READ_TIMEOUT,
+    stall_timeout: Optional[float]=None,
+    bulk: bool=False,
+    dedicated: bool=False,
+) -> Any:
+    """
+    Sends a request to a node over a pooled, framed connection and returns
+    the response.  Falls back to a one-shot connection if the node does not
+    support framed requests
+
+    :param port: port where node is serving
+    :param ip: ip of node
+    :param request: Dictionary of a request as specified in the Spec Document
+    :param timeout: Seconds to wait for the response, or None to wait as \
+    long as it takes
+    :param stall_timeout: Seconds the node may go without sending anything, \
+    or None to only go by timeout
+    :param bulk: Whether the request is for chunk data, which goes on its own \
+    connection so it doesn't hold up other requests
+    :param dedicated: Whether to send it on a connection of its own, that \
+    isn't pooled and is closed once the request is answered or cancelled
+    :raises network_util.PeerTimeoutException: If the node doesn't connect \
+    or respond in time
+    :return: node response
+    """
+    try:
+        if dedicated:
+            response = await get_connection_pool().request_dedicated(
+                ip, port, request, timeout=timeout,
+                stall_timeout=stall_timeout,
+            )
+        else:
+            response = await get_connection_pool().request(
+                ip, port, request, timeout=timeout,
+                stall_timeout=stall_timeout, bulk=bulk,
+            )
+    except network_util.FramingNotSupportedException:
+        # one-shot reads are already timed block by block
+        return await send_oneshot_request_to_node(
+            request, ip, port,
+            timeout if stall_timeout is None else stall_timeout,
+        )
+    return unpack_response(response)
+
+
+async def send_oneshot_request_to_node(
+    request: Dict[str, Any], ip: str, port: int,
+    timeout: Optional[float]=PEER_READ_TIMEOUT,
 ) -> Any:
     """
     Creates a connection a node and sends a given request to the
@@ -216,23 +736,43 @@ async def send_request_to_node(
     :param port: port where node is serving
     :param ip: ip of node
     :param request: Dictionary of a request as specified in the Spec Document
+    :param timeout: Seconds the node may go without sending anything, or \
+    None to wait as long as it takes
+    :raises network_util.PeerTimeoutException: If the node doesn't connect \
+    or respond in time
     :return: node response
     """
-    reader, writer = await asyncio.open_connection(ip, port)
-
-    writer.write(bencode.encode(request))
-    writer.write_eof()
-    await writer.drain()
-
-    data = b''
-    while 1:
-        sockdata = await reader.read()
-        if not sockdata:
-            break
-        data += sockdata
-    reader.feed_eof()
+    reader, writer = await open_connection(ip, port)
+
+    try:
+        writer.write(bencode.encode(request))
+        writer.write_eof()
+        await writer.drain()
+
+        blocks = []
+        while True:
+            block = await asyncio.wait_for(
+                reader.read(STREAM_BLOCK_SIZE), timeout,
+            )
+            if not block:
+                break
+            blocks.append(block)
+    except asyncio.TimeoutError as e:
+        logger.info("%s:%s did not respond in time", ip, port)
+        raise network_util.PeerTimeoutException() from e
+    finally:
+        writer.close()
+
+    return unpack_response(bencode.decode(b''.join(blocks)))
+
+
+def unpack_response(response: Dict[str, Any]) -> Any:
+    """
+    Get the body of a response, or raise the error it contains
 
-    response = bencode.decode(data)
+    :param response: A decoded response dict
+    :return: The response body
+    """
     if (response['status'] == 'ok'):
         logger.debug("sending OK")
         return response['response']
@@ -0,0 +1,145 @@
+"""Node wide scheduling of chunk downloads from peers"""
+import asyncio
+from collections import deque
+from collections import OrderedDict
+from typing import Deque  # noqa
+from typing import Optional  # noqa
+from typing import Tuple  # noqa
+
+from syncr_backend.constants import MAX_TRANSFER_BYTES
+from syncr_backend.constants import MAX_TRANSFERS
+from syncr_backend.util.log_util import get_logger
+
+
+logger = get_logger(__name__)
+
+
+class TransferScheduler(object):
+    """Every chunk download the node makes takes a transfer from here first,
+    so the totals across every drop and file stay under a cap on transfers
+    and on requested bytes no matter how many syncs run at once.
+
+    Waiting transfers are granted round robin, first between drops, then
+    between the files of a drop, so a drop with many files (or a file with
+    many peers) doesn't crowd out the others.  A transfer that doesn't fit
+    holds up the ones after it, so large transfers aren't starved by small
+    ones.  A transfer larger than max_bytes is let through once nothing else
+    is running
+
+    :param max_transfers: Transfers allowed at once
+    :param max_bytes: Bytes allowed to be requested at once
+    """
+
+    def __init__(
+        self, max_transfers: int=MAX_TRANSFERS,
+        max_bytes: int=MAX_TRANSFER_BYTES,
+    ) -> None:
+        self.max_transfers = max_transfers
+        self.max_bytes = max_bytes
+        self.transfers = 0
+        self.bytes = 0
+        # drop id -> file id -> waiting (bytes, future), each in the order
+        # they are next served
+        self._waiting = OrderedDict()  # type: OrderedDict[bytes, OrderedDict[bytes, Deque[Tuple[int, asyncio.Future]]]]  # noqa
+
+    def _fits(self, nbytes: int) -> bool:
+        if self.transfers >= self.max_transfers:
+            return False
+        return not self.transfers or self.bytes + nbytes <= self.max_bytes
+
+    def _take(self, nbytes: int) -> None:
+        self.transfers += 1
+        self.bytes += nbytes
+
+    async def acquire(
+        self, drop_id: bytes, file_id: bytes, nbytes: int,
+    ) -> None:
+        """Take a transfer, waiting for its turn if the caps are reached
+
+        :param drop_id: The drop being downloaded
+        :param file_id: The file being downloaded
+        :param nbytes: How many bytes will be requested
+        """
+        if not self._waiting and self._fits(nbytes):
+            self._take(nbytes)
+            return
+
+        waiter = (nbytes, asyncio.get_event_loop().create_future())
+        files = self._waiting.setdefault(drop_id, OrderedDict())
+        files.setdefault(file_id, deque()).append(waiter)
+        self._grant()
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            if waiter[1].done() and not waiter[1].cancelled():
+                # granted just as it was cancelled
+                self.release(nbytes)
+            else:
+                self._forget(drop_id, file_id, waiter)
+            raise
+
+    def release(self, nbytes: int) -> None:
+        """Give back a transfer taken with `acquire`, and grant waiting ones
+        that now fit
+
+        :param nbytes: The bytes it was taken with
+        """
+        self.transfers -= 1
+        self.bytes -= nbytes
+        self._grant()
+
+    def _grant(self) -> None:
+        while self._waiting:
+            drop_id, files = next(iter(self._waiting.items()))
+            file_id, waiters = next(iter(files.items()))
+            nbytes, future = waiters[0]
+            if future.done():
+                # cancelled, and about to be forgotten
+                waiters.popleft()
+            elif not self._fits(nbytes):
+                return
+            else:
+                waiters.popleft()
+                self._take(nbytes)
+                future.set_result(None)
+            # the drop and file go to the back of their lines
+            if waiters:
+                files.move_to_end(file_id)
+            else:
+                del files[file_id]
+            if files:
+                self._waiting.move_to_end(drop_id)
+            else:
+                del self._waiting[drop_id]
+
+    def _forget(
+        self, drop_id: bytes, file_id: bytes,
+        waiter: Tuple[int, asyncio.Future],
+    ) -> None:
+        files = self._waiting.get(drop_id)
+        if files is None or file_id not in files:
+            return
+        waiters = files[file_id]
+        if waiter in waiters:
+            waiters.remove(waiter)
+        if not waiters:
+            del files[file_id]
+        if not files:
+            del self._waiting[drop_id]
+        # whatever was held up behind it may fit now
+        self._grant()
+
+
+_scheduler_instance = None  # type: Optional[TransferScheduler]
+
+
+def get_transfer_scheduler() -> TransferScheduler:
+    """
+    Get the scheduler every chunk download goes through
+
+    :return: The TransferScheduler
+    """
+    global _scheduler_instance
+    if _scheduler_instance is None:
+        _scheduler_instance = TransferScheduler()
+    return _scheduler_instance
@@ -0,0 +1,158 @@
+"""Admission control for requests that upload chunks to peers"""
+import asyncio
+from collections import Counter
+from collections import deque
+from typing import Deque  # noqa
+from typing import Optional  # noqa
+from typing import Tuple  # noqa
+
+from syncr_backend.constants import DEFAULT_UPLOAD_QUEUE_SIZE
+from syncr_backend.constants import DEFAULT_UPLOAD_SLOTS
+from syncr_backend.constants import DEFAULT_UPLOAD_SLOTS_PER_PEER
+from syncr_backend.constants import UPLOAD_QUEUE_TIMEOUT
+from syncr_backend.util.log_util import get_logger
+
+
+logger = get_logger(__name__)
+
+
+class UploadLimiter(object):
+    """Limits how many uploads run at once, in total and per peer.  Requests
+    over the limit wait in a bounded queue for up to UPLOAD_QUEUE_TIMEOUT
+    seconds, and are turned away if the queue is full or the wait runs out,
+    so the peer can try someone else instead of waiting on a busy node.
+    Requests that mustn't wait use `try_acquire`
+
+    :param slots: Uploads allowed at once
+    :param slots_per_peer: Uploads allowed at once to one peer
+    :param queue_size: Requests allowed to wait for a slot
+    """
+
+    def __init__(
+        self, slots: int=DEFAULT_UPLOAD_SLOTS,
+        slots_per_peer: int=DEFAULT_UPLOAD_SLOTS_PER_PEER,
+        queue_size: int=DEFAULT_UPLOAD_QUEUE_SIZE,
+    ) -> None:
+        self.slots = slots
+        self.slots_per_peer = slots_per_peer
+        self.queue_size = queue_size
+        self.in_use = 0
+        self._per_peer = Counter()  # type: Counter[str]
+        self._waiters = deque()  # type: Deque[Tuple[str, asyncio.Future]]
+
+    def _can_take(self, peer: str) -> bool:
+        return (
+            self.in_use < self.slots and
+            self._per_peer[peer] < self.slots_per_peer
+        )
+
+    def _take(self, peer: str) -> None:
+        self.in_use += 1
+        self._per_peer[peer] += 1
+
+    def try_acquire(self, peer: str) -> bool:
+        """Take an upload slot if one is free, without queueing for it
+
+        :param peer: The peer being uploaded to (its ip)
+        :return: True if a slot was taken, and must be given back with \
+                `release`.  False if the node is too busy
+        """
+        if self._can_take(peer):
+            self._take(peer)
+            return True
+        logger.info("no upload slot free for %s", peer)
+        return False
+
+    async def acquire(
+        self, peer: str, timeout: float=UPLOAD_QUEUE_TIMEOUT,
+    ) -> bool:
+        """Take an upload slot, waiting in the queue if there isn't one free.
+        Freed slots are handed straight to the waiters in order, so new
+        callers can't take them first
+
+        :param peer: The peer being uploaded to (its ip)
+        :param timeout: How long to wait in the queue
+        :return: True if a slot was taken, and must be given back with \
+                `release`.  False if the node is too busy
+        """
+        if self._can_take(peer):
+            self._take(peer)
+            return True
+        if len(self._waiters) >= self.queue_size:
+            logger.info("upload queue full, turning away %s", peer)
+            return False
+
+        waiter = (peer, asyncio.get_event_loop().create_future())
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait([waiter[1]], timeout=timeout)
+        except asyncio.CancelledError:
+            if waiter[1].done():
+                # handed a slot just as it was cancelled
+                self.release(peer)
+            else:
+                self._waiters.remove(waiter)
+            raise
+        if not waiter[1].done():
+            self._waiters.remove(waiter)
+            logger.info("no upload slot free in time for %s", peer)
+            return False
+        return True
+
+    def release(self, peer: str) -> None:
+        """Give back a slot taken with `acquire`, and hand it to the first
+        waiter that can use it
+
+        :param peer: The peer that was being uploaded to
+        """
+        self.in_use -= 1
+        self._per_peer[peer] -= 1
+        if not self._per_peer[peer]:
+            del self._per_peer[peer]
+        self._grant()
+
+    def _grant(self) -> None:
+        for waiter in list(self._waiters):
+            waiting_peer, future = waiter
+            if self._can_take(waiting_peer):
+                self._waiters.remove(waiter)
+                self._take(waiting_peer)
+                future.set_result(None)
+
+
+_limiter_instance = None  # type: Optional[UploadLimiter]
+
+
+def get_upload_limiter() -> UploadLimiter:
+    """
+    Get the upload limiter used by the listen server
+
+    :return: The UploadLimiter
+    """
+    global _limiter_instance
+    if _limiter_instance is None:
+        _limiter_instance = UploadLimiter()
+    return _limiter_instance
+
+
+def configure_upload_limiter(
+    slots: int=DEFAULT_UPLOAD_SLOTS,
+    slots_per_peer: int=DEFAULT_UPLOAD_SLOTS_PER_PEER,
+    queue_size: int=DEFAULT_UPLOAD_QUEUE_SIZE,
+) -> UploadLimiter:
+    """
+    Change the limits of the upload limiter.  Uploads already running keep
+    their slots
+
+    :param slots: Uploads allowed at once
+    :param slots_per_peer: Uploads allowed at once to one peer
+    :param queue_size: Requests allowed to wait for a slot
+    :return: The UploadLimiter
+    """
+    limiter = get_upload_limiter()
+    limiter.slots = slots
+    limiter.slots_per_peer = slots_per_peer
+    limiter.queue_size = queue_size
+    # hand out any slots the new limits free up
+    limiter._grant()
+    return limiter
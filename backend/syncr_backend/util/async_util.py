@@ -1,8 +1,7 @@
 import asyncio
 import functools
+from collections import deque
 from collections import namedtuple
-from concurrent.futures import ALL_COMPLETED
-from concurrent.futures import FIRST_COMPLETED
 from functools import _make_key  # type: ignore
 
 from cachetools import LRUCache
@@ -13,16 +12,23 @@ from syncr_backend.util.log_util import get_logger
 logger = get_logger(__name__)
 
 
-async def limit_gather(fs, n, task_timeout=0):
+#: Metrics of a WorkerPool.  wait_time and run_time are the mean seconds
+#: awaitables have waited for a worker and run for
+PoolStats = namedtuple(
+    "PoolStats", ["queued", "running", "completed", "wait_time", "run_time"],
+)
+
+
+class WorkerPool(object):
     """
-    Gathers the tasks in fs, but only allows n at a time to be pending.
-    If task_timeout is greater than 0, allows each task that long to complete
-    before trying the next.
+    Runs awaitables on at most n workers at a time, in the order they are
+    submitted.  Tasks are let go of as soon as they finish, so a pool can run
+    for as long as the node does.
 
-    Useful a large list of tasks need to be completed, but running too many may
+    Useful when a lot of tasks need to be completed, but running too many may
     cause side effects (ie, sockets timing out).
 
-    >>> from syncr_backend.util.async_util import limit_gather
+    >>> from syncr_backend.util.async_util import WorkerPool
     >>> import asyncio
     >>>
     >>> async def coro(n: int) -> None:
@@ -31,8 +37,9 @@ async def limit_gather(fs, n, task_timeout=0):
     ...     return n
     >>>
     >>> loop = asyncio.get_event_loop()
+    >>> pool = WorkerPool(3)
     >>> coros = [coro(5), coro(3), coro(1), coro(2), coro(4)]
-    >>> results = loop.run_until_complete(limit_gather(coros, 3))
+    >>> results = loop.run_until_complete(pool.gather(coros))
     done sleeping for 1 seconds
     done sleeping for 3 seconds
     done sleeping for 2 seconds
@@ -40,101 +47,129 @@ async def limit_gather(fs, n, task_timeout=0):
     done sleeping for 4 seconds
     >>> print(results)
     [5, 3, 1, 2, 4]
+    >>> pool.stats().completed
+    5
 
-
-    :param fs: A list of awaitable objects to run
-    :param n: The maximum number to allow to be pending at a time
-    :param task_timeout: Give each task this long before trying the next
-    :return: A list of what is returned by the tasks in fs
+    :param n: The maximum number to allow to be running at a time
     """
-    tasks = []
-
-    for f in fs:
-        tasks.append(asyncio.ensure_future(f))
 
-        done, pending = await asyncio.wait(
-            tasks, timeout=task_timeout, return_when=ALL_COMPLETED,
+    def __init__(self, n):
+        self.n = n
+        # (awaitable, result future, when it was submitted)
+        self._queue = deque()
+        self._running = set()
+        self._started = 0
+        self._completed = 0
+        self._wait_time = 0.0
+        self._run_time = 0.0
+
+    @property
+    def queued(self):
+        """
+        :return: How many awaitables are waiting for a worker
+        """
+        return len(self._queue)
+
+    @property
+    def running(self):
+        """
+        :return: How many awaitables are running
+        """
+        return len(self._running)
+
+    def stats(self):
+        """
+        :return: A PoolStats of the pool so far
+        """
+        return PoolStats(
+            queued=len(self._queue),
+            running=len(self._running),
+            completed=self._completed,
+            wait_time=self._wait_time / max(1, self._started),
+            run_time=self._run_time / max(1, self._completed),
         )
-        while len(pending) >= n:
-            done, pending = await asyncio.wait(
-                pending, return_when=FIRST_COMPLETED,
-            )
-
-    while pending:
-        done, pending = await asyncio.wait(tasks, return_when=ALL_COMPLETED)
-
-    return [t.exception() or t.result() for t in tasks]
 
-
-async def process_queue_with_limit(queue, n, done_queue, task_timeout=0):
-    """
-    Processses up to n tasks from queue at a time, putting the results in
-    done_queue.
-
-    Otherwise similar to limit_gather.
-
-    This function does not return, and should be cancled when queue.join()
-    returns, everything from done_queue has been processed, and there is
-    nothing left to add.
-
-    >>> from syncr_backend.util.async_util import process_queue_with_limit
-    >>> import asyncio
-    >>>
-    >>> async def coro(n: int) -> None:
-    ...     await asyncio.sleep(n)
-    ...     return n*n
-    >>>
-    >>> in_queue = asyncio.Queue()
-    >>> out_queue = asyncio.Queue()
-    >>>
-    >>> loop = asyncio.get_event_loop()
-    >>> processor = asyncio.ensure_future(
-    ...     process_queue_with_limit(in_queue, 3, out_queue),
-    ... )
-    >>>
-    >>> for n in [1, 2, 3, 4]:
-    ...     loop.run_until_complete(in_queue.put(coro(n)))
-    >>>
-    >>> loop.run_until_complete(in_queue.join())
-    >>> r = []
-    >>> while not out_queue.empty():
-    ...     result = loop.run_until_complete(out_queue.get())
-    ...     r.append(result)
-    >>>
-    >>> r
-    [1, 4, 9, 16]
-    >>> processor.cancel()
-    True
-
-    :param queue: The queue of input tasks
-    :param n: The max number of pending tasks at a time
-    :param done_queue: Queue to add results to
-    :param task_timeout: Allow tasks to take up to this long before running \
-    another
-    """
-    tasks = []
-    try:
-        while True:
-            task = asyncio.ensure_future(await queue.get())
+    def submit(self, aw):
+        """
+        Add an awaitable to run once a worker is free
+
+        :param aw: The awaitable
+        :return: A future of its result.  Cancelling it cancels the awaitable
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._queue.append((aw, future, loop.time()))
+        self._start()
+        return future
+
+    async def gather(self, fs):
+        """
+        Run awaitables on the pool, and wait for all of them
+
+        :param fs: The awaitables
+        :return: A list of what is returned by the awaitables in fs, in \
+                order, with the exception raised in place of the result of \
+                any that raised
+        """
+        futures = [self.submit(f) for f in fs]
+        if not futures:
+            return []
+        try:
+            await asyncio.wait(futures)
+        except asyncio.CancelledError:
+            for future in futures:
+                future.cancel()
+            raise
+        return [f.exception() or f.result() for f in futures]
+
+    def cancel(self):
+        """Cancel everything waiting and running"""
+        while self._queue:
+            aw, future, _ = self._queue.popleft()
+            future.cancel()
+            if asyncio.iscoroutine(aw):
+                aw.close()
+        for task in list(self._running):
+            task.cancel()
+
+    def _start(self):
+        loop = asyncio.get_event_loop()
+        while self._queue and len(self._running) < self.n:
+            aw, future, submitted = self._queue.popleft()
+            if future.done():
+                # cancelled while it waited
+                if asyncio.iscoroutine(aw):
+                    aw.close()
+                continue
+            started = loop.time()
+            self._started += 1
+            self._wait_time += started - submitted
+            task = asyncio.ensure_future(aw)
+            self._running.add(task)
             task.add_done_callback(
-                lambda future: done_queue.put_nowait(
-                    future.exception() or future.result(),
-                ),
+                functools.partial(self._finished, future, started),
             )
-            task.add_done_callback(
-                lambda _: queue.task_done(),
+            future.add_done_callback(
+                functools.partial(_cancel_task, task),
             )
-            tasks.append(task)
 
-            done, pending = await asyncio.wait(
-                tasks, timeout=task_timeout, return_when=ALL_COMPLETED,
-            )
-            while len(pending) >= n:
-                done, pending = await asyncio.wait(
-                    pending, return_when=FIRST_COMPLETED,
-                )
-    except asyncio.CancelledError:
-        return
+    def _finished(self, future, started, task):
+        self._running.discard(task)
+        self._completed += 1
+        self._run_time += asyncio.get_event_loop().time() - started
+        if not future.done():
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+        self._start()
+
+
+def _cancel_task(task, future):
+    if future.cancelled():
+        task.cancel()
 
 
 #: Cache info for async_cache
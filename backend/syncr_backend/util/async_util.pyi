@@ -1,6 +1,6 @@
 from typing import Callable, Awaitable, Any, Generic, TypeVar, Dict, List, \
     NamedTuple, Optional, Union
-from asyncio import Queue
+from asyncio import Future
 from mypy_extensions import VarArg, KwArg
 from collections import MutableMapping
 
@@ -31,12 +31,24 @@ class async_cache():
     ) -> None: ...
     def __call__(self, f: F) -> F: ...
 
-async def limit_gather(
-    fs: List[Awaitable[_T]], n: int, task_timeout: int=...,
-) -> List[Union[_T, BaseException]]: ...
+class PoolStats(NamedTuple('PoolStats', [
+    ('queued', int),
+    ('running', int),
+    ('completed', int),
+    ('wait_time', float),
+    ('run_time', float)
+])): ...
 
-async def process_queue_with_limit(
-    queue: Queue[Awaitable[_T]], n: int,
-    done_queue: Queue[Union[_T, BaseException]],
-    task_timeout: int=...,
-) -> None: ...
+class WorkerPool():
+    n = ...  # type: int
+    def __init__(self, n: int) -> None: ...
+    @property
+    def queued(self) -> int: ...
+    @property
+    def running(self) -> int: ...
+    def stats(self) -> PoolStats: ...
+    def submit(self, aw: Awaitable[_T]) -> Future[_T]: ...
+    async def gather(
+        self, fs: List[Awaitable[_T]],
+    ) -> List[Union[_T, BaseException]]: ...
+    def cancel(self) -> None: ...
@@ -0,0 +1,217 @@
+"""Token bucket bandwidth shaping for chunk uploads and downloads"""
+import asyncio
+from typing import Dict  # noqa
+from typing import List
+from typing import Optional
+from typing import Tuple  # noqa
+from typing import Union
+
+from syncr_backend.constants import BANDWIDTH_BURST_TIME
+from syncr_backend.constants import BANDWIDTH_QUANTUM
+from syncr_backend.util import crypto_util
+from syncr_backend.util.log_util import get_logger
+from syncr_backend.util.network_util import FrameReader
+
+
+logger = get_logger(__name__)
+
+UPLOAD = 'upload'  #: Direction of bytes sent to peers
+DOWNLOAD = 'download'  #: Direction of bytes received from peers
+
+
+class TokenBucket(object):
+    """Limits a byte rate.  Taking bytes first takes them from the bucket,
+    which refills at rate bytes per second up to a small burst, then sleeps
+    for however long it takes to pay back any shortfall.  Callers take up to
+    BANDWIDTH_QUANTUM at a time, so the rate is kept smoothly rather than in
+    large bursts, and since each caller waits its own shortfall, waiters are
+    served in order
+
+    :param rate: bytes per second, or 0 for no limit
+    """
+
+    def __init__(self, rate: int=0) -> None:
+        self._tokens = 0.0
+        self._last = 0.0
+        self.rate = 0
+        self.set_rate(rate)
+
+    def set_rate(self, rate: int) -> None:
+        """Change the rate
+
+        :param rate: bytes per second, or 0 for no limit
+        """
+        self.rate = max(0, rate)
+        self._tokens = self.burst
+        self._last = asyncio.get_event_loop().time()
+
+    @property
+    def burst(self) -> float:
+        """
+        :return: the most bytes that can be taken without waiting
+        """
+        return max(BANDWIDTH_QUANTUM, self.rate * BANDWIDTH_BURST_TIME)
+
+    async def take(self, n: int) -> None:
+        """Take n bytes, waiting if they go over the rate
+
+        :param n: bytes
+        """
+        if not self.rate:
+            return
+        now = asyncio.get_event_loop().time()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._last) * self.rate,
+        )
+        self._last = now
+        self._tokens -= n
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+class BandwidthShaper(object):
+    """A global and a per drop TokenBucket for each direction"""
+
+    def __init__(self) -> None:
+        self._global = {
+            UPLOAD: TokenBucket(), DOWNLOAD: TokenBucket(),
+        }  # type: Dict[str, TokenBucket]
+        self._per_drop = {}  # type: Dict[Tuple[str, bytes], TokenBucket]
+
+    def set_limit(
+        self, direction: str, rate: int, drop_id: Optional[bytes]=None,
+    ) -> None:
+        """Set a limit
+
+        :param direction: UPLOAD or DOWNLOAD
+        :param rate: bytes per second, or 0 to remove the limit
+        :param drop_id: the drop to limit, or None for the global limit
+        """
+        logger.info(
+            "setting %s limit to %s bytes/s (drop %s)", direction, rate,
+            drop_id,
+        )
+        if drop_id is None:
+            self._global[direction].set_rate(rate)
+        elif rate:
+            bucket = self._per_drop.setdefault(
+                (direction, drop_id), TokenBucket(),
+            )
+            bucket.set_rate(rate)
+        else:
+            self._per_drop.pop((direction, drop_id), None)
+
+    def get_limits(self) -> Dict[str, Dict[str, int]]:
+        """
+        :return: {direction: {'global': rate, b64 drop id: rate}}, with \
+                limits that aren't set left out
+        """
+        limits = {
+            UPLOAD: {}, DOWNLOAD: {},
+        }  # type: Dict[str, Dict[str, int]]
+        for direction, bucket in self._global.items():
+            if bucket.rate:
+                limits[direction]['global'] = bucket.rate
+        for (direction, drop_id), bucket in self._per_drop.items():
+            encoded_id = crypto_util.b64encode(drop_id).decode('utf-8')
+            limits[direction][encoded_id] = bucket.rate
+        return limits
+
+    def _buckets(
+        self, direction: str, drop_id: Optional[bytes],
+    ) -> List[TokenBucket]:
+        buckets = []
+        if drop_id is not None:
+            bucket = self._per_drop.get((direction, drop_id))
+            if bucket is not None:
+                buckets.append(bucket)
+        if self._global[direction].rate:
+            buckets.append(self._global[direction])
+        return buckets
+
+    def is_limited(
+        self, direction: str, drop_id: Optional[bytes]=None,
+    ) -> bool:
+        """
+        :param direction: UPLOAD or DOWNLOAD
+        :param drop_id: the drop the bytes are for
+        :return: whether bytes for drop_id need to go through `take`
+        """
+        return bool(self._buckets(direction, drop_id))
+
+    async def take(
+        self, direction: str, n: int, drop_id: Optional[bytes]=None,
+    ) -> None:
+        """Take n bytes from the drop's bucket, then the global one
+
+        :param direction: UPLOAD or DOWNLOAD
+        :param n: bytes.  More than BANDWIDTH_QUANTUM is taken a quantum at a \
+                time, so it isn't let through in one burst
+        :param drop_id: the drop the bytes are for
+        """
+        buckets = self._buckets(direction, drop_id)
+        for start in range(0, n, BANDWIDTH_QUANTUM):
+            quantum = min(BANDWIDTH_QUANTUM, n - start)
+            for bucket in buckets:
+                await bucket.take(quantum)
+
+    def reader(
+        self, reader: FrameReader, drop_id: Optional[bytes]=None,
+    ) -> 'ByteReader':
+        """Shape reads from reader as downloads, if they are limited
+
+        :param reader: the StreamReader to read from
+        :param drop_id: the drop the bytes are for
+        :return: reader, or a ShapedReader wrapping it
+        """
+        if not self.is_limited(DOWNLOAD, drop_id):
+            return reader
+        return ShapedReader(reader, self, drop_id)
+
+
+class ShapedReader(object):
+    """Wraps a StreamReader so read() is limited by a BandwidthShaper
+
+    :param reader: the StreamReader to read from
+    :param shaper: the shaper
+    :param drop_id: the drop the bytes are for
+    """
+
+    def __init__(
+        self, reader: FrameReader, shaper: BandwidthShaper,
+        drop_id: Optional[bytes],
+    ) -> None:
+        self._reader = reader
+        self._shaper = shaper
+        self._drop_id = drop_id
+
+    async def read(self, n: int=-1) -> bytes:
+        """Read up to n bytes, and at most BANDWIDTH_QUANTUM
+
+        :param n: most bytes to read
+        :return: the bytes read, empty at EOF
+        """
+        if n < 0 or n > BANDWIDTH_QUANTUM:
+            n = BANDWIDTH_QUANTUM
+        data = await self._reader.read(n)
+        await self._shaper.take(DOWNLOAD, len(data), self._drop_id)
+        return data
+
+
+#: Something chunk data can be read from with read(n)
+ByteReader = Union[FrameReader, ShapedReader]
+
+
+_shaper_instance = None  # type: Optional[BandwidthShaper]
+
+
+def get_bandwidth_shaper() -> BandwidthShaper:
+    """
+    Get the bandwidth shaper shared by uploads and downloads
+
+    :return: The BandwidthShaper
+    """
+    global _shaper_instance
+    if _shaper_instance is None:
+        _shaper_instance = BandwidthShaper()
+    return _shaper_instance
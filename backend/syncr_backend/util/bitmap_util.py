@@ -0,0 +1,313 @@
+"""A compact set of chunk indexes, backed by a bitmap"""
+from typing import Any
+from typing import Iterable
+from typing import Iterator
+from typing import List  # noqa
+from typing import MutableSet
+from typing import Optional
+from typing import Tuple
+
+from syncr_backend.constants import RAREST_FIRST_MAX_COUNT
+
+
+class ChunkBitmap(MutableSet[int]):
+    """A set of chunk indexes stored as the bits of an int, so that a file
+    with millions of chunks takes a few hundred kilobytes rather than tens of
+    megabytes, and set operations between two bitmaps are single big int
+    operations.  Behaves like a ``Set[int]``
+
+    >>> from syncr_backend.util.bitmap_util import ChunkBitmap
+    >>> b = ChunkBitmap([0, 2, 9])
+    >>> b
+    ChunkBitmap([0, 2, 9])
+    >>> 2 in b, 3 in b, len(b)
+    (True, False, 3)
+    >>> ChunkBitmap.full(4) - b
+    ChunkBitmap([1, 3])
+    >>> b.to_bytes()
+    b'\\x05\\x02'
+    >>> ChunkBitmap.from_bytes(b'\\x05\\x02') == b
+    True
+
+    :param chunks: chunk indexes to start with
+    """
+
+    __slots__ = ('_bits',)
+
+    def __init__(self, chunks: Optional[Iterable[int]]=None) -> None:
+        self._bits = 0
+        if isinstance(chunks, ChunkBitmap):
+            self._bits = chunks._bits
+        elif chunks is not None:
+            for chunk in chunks:
+                self.add(chunk)
+
+    @classmethod
+    def _from_int(cls, bits: int) -> 'ChunkBitmap':
+        bitmap = cls()
+        bitmap._bits = bits
+        return bitmap
+
+    @classmethod
+    def full(cls, num_chunks: int) -> 'ChunkBitmap':
+        """Make a bitmap of every chunk in range(num_chunks)
+
+        :param num_chunks: how many chunks
+        :return: the bitmap
+        """
+        return cls._from_int((1 << num_chunks) - 1)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'ChunkBitmap':
+        """Decode a bitmap made by to_bytes
+
+        :param data: the encoded bitmap
+        :return: the bitmap
+        """
+        return cls._from_int(int.from_bytes(data, 'little'))
+
+    def to_bytes(self) -> bytes:
+        """Encode as bytes, where chunk i is bit i % 8 of byte i // 8
+
+        :return: the bitmap, just long enough to hold the largest index
+        """
+        length = (self._bits.bit_length() + 7) // 8
+        return self._bits.to_bytes(length, 'little')
+
+    def copy(self) -> 'ChunkBitmap':
+        """
+        :return: a copy of this bitmap
+        """
+        return self._from_int(self._bits)
+
+    def add(self, chunk: int) -> None:
+        """Add a chunk
+
+        :param chunk: the chunk index
+        """
+        if chunk < 0:
+            raise ValueError("chunk index must not be negative")
+        self._bits |= 1 << chunk
+
+    def discard(self, chunk: int) -> None:
+        """Remove a chunk if it is present
+
+        :param chunk: the chunk index
+        """
+        if chunk >= 0:
+            self._bits &= ~(1 << chunk)
+
+    def __contains__(self, chunk: object) -> bool:
+        if not isinstance(chunk, int) or chunk < 0:
+            return False
+        return bool(self._bits >> chunk & 1)
+
+    def __len__(self) -> int:
+        return bin(self._bits).count('1')
+
+    def __bool__(self) -> bool:
+        return bool(self._bits)
+
+    def __iter__(self) -> Iterator[int]:
+        for byte_idx, byte in enumerate(self.to_bytes()):
+            if not byte:
+                continue
+            base = byte_idx << 3
+            for bit in range(8):
+                if byte >> bit & 1:
+                    yield base + bit
+
+    def __repr__(self) -> str:
+        return '%s(%s)' % (self.__class__.__name__, list(self))
+
+    @staticmethod
+    def _bits_of(other: Any) -> Optional[int]:
+        if isinstance(other, ChunkBitmap):
+            return other._bits
+        if isinstance(other, (set, frozenset)):
+            return ChunkBitmap(other)._bits
+        return None
+
+    def __eq__(self, other: object) -> bool:
+        bits = self._bits_of(other)
+        if bits is None:
+            return super().__eq__(other)
+        return self._bits == bits
+
+    def __and__(self, other: Any) -> Any:
+        bits = self._bits_of(other)
+        if bits is None:
+            return super().__and__(other)
+        return self._from_int(self._bits & bits)
+
+    def __or__(self, other: Any) -> Any:
+        bits = self._bits_of(other)
+        if bits is None:
+            return super().__or__(other)
+        return self._from_int(self._bits | bits)
+
+    def __sub__(self, other: Any) -> Any:
+        bits = self._bits_of(other)
+        if bits is None:
+            return super().__sub__(other)
+        return self._from_int(self._bits & ~bits)
+
+    def __xor__(self, other: Any) -> Any:
+        bits = self._bits_of(other)
+        if bits is None:
+            return super().__xor__(other)
+        return self._from_int(self._bits ^ bits)
+
+    __rand__ = __and__
+    __ror__ = __or__
+    __rxor__ = __xor__
+
+    def __iand__(self, other: Any) -> Any:
+        bits = self._bits_of(other)
+        if bits is None:
+            return super().__iand__(other)
+        self._bits &= bits
+        return self
+
+    def __ior__(self, other: Any) -> Any:
+        bits = self._bits_of(other)
+        if bits is None:
+            return super().__ior__(other)
+        self._bits |= bits
+        return self
+
+    def __isub__(self, other: Any) -> Any:
+        bits = self._bits_of(other)
+        if bits is None:
+            return super().__isub__(other)
+        self._bits &= ~bits
+        return self
+
+    def __ixor__(self, other: Any) -> Any:
+        bits = self._bits_of(other)
+        if bits is None:
+            return super().__ixor__(other)
+        self._bits ^= bits
+        return self
+
+    def first(self, n: int, start: int=0) -> 'ChunkBitmap':
+        """Get the n lowest chunks, counting from start and wrapping around
+        to the lowest chunks after the highest
+
+        >>> from syncr_backend.util.bitmap_util import ChunkBitmap
+        >>> ChunkBitmap([1, 2, 5, 6]).first(3, start=4)
+        ChunkBitmap([1, 5, 6])
+
+        :param n: how many chunks
+        :param start: the chunk to count from
+        :return: a new bitmap with at most n chunks
+        """
+        from_start = self._bits >> start << start
+        bitmap = ChunkBitmap()
+        for bits in (from_start, self._bits ^ from_start):
+            for chunk in ChunkBitmap._from_int(bits):
+                if n <= 0:
+                    return bitmap
+                bitmap.add(chunk)
+                n -= 1
+        return bitmap
+
+    def runs(self, max_length: int=0) -> Iterator[Tuple[int, int]]:
+        """Group the chunks into runs of consecutive indexes
+
+        >>> from syncr_backend.util.bitmap_util import ChunkBitmap
+        >>> list(ChunkBitmap([1, 2, 3, 7, 9, 10]).runs())
+        [(1, 3), (7, 1), (9, 2)]
+        >>> list(ChunkBitmap([1, 2, 3]).runs(max_length=2))
+        [(1, 2), (3, 1)]
+
+        :param max_length: split runs longer than this, if greater than 0
+        :return: an iterator of (first chunk, number of chunks) pairs
+        """
+        start = count = 0
+        for chunk in self:
+            if count and chunk == start + count and count != max_length:
+                count += 1
+                continue
+            if count:
+                yield (start, count)
+            start, count = chunk, 1
+        if count:
+            yield (start, count)
+
+
+class ChunkAvailability(object):
+    """Counts how many peers have each chunk.  The counts are bit sliced: for
+    each count there is a bitmap of the chunks at least that many peers have,
+    so adding a peer is a few big int operations however many chunks the
+    file has
+
+    >>> from syncr_backend.util.bitmap_util import ChunkAvailability
+    >>> from syncr_backend.util.bitmap_util import ChunkBitmap
+    >>> a = ChunkAvailability()
+    >>> a.add(ChunkBitmap([0, 1, 2]))
+    >>> a.add(ChunkBitmap([1, 2]))
+    >>> a.add(ChunkBitmap([2, 3]))
+    >>> list(a.rarest_first(ChunkBitmap.full(5)))
+    [ChunkBitmap([0, 3]), ChunkBitmap([1]), ChunkBitmap([2]), ChunkBitmap([4])]
+    >>> a.pick(ChunkBitmap([1, 2, 3]), 2)
+    ChunkBitmap([1, 3])
+
+    :param max_count: chunks more peers than this have are all treated as \
+            equally common
+    """
+
+    def __init__(self, max_count: int=RAREST_FIRST_MAX_COUNT) -> None:
+        self.max_count = max_count
+        #: _at_least[i] has the chunks at least i + 1 peers have
+        self._at_least = []  # type: List[int]
+
+    def add(self, chunks: ChunkBitmap) -> None:
+        """Count a peer's chunks
+
+        :param chunks: the chunks the peer has
+        """
+        levels = self._at_least
+        if len(levels) < self.max_count:
+            levels.append(0)
+        for i in range(len(levels) - 1, 0, -1):
+            levels[i] |= levels[i - 1] & chunks._bits
+        levels[0] |= chunks._bits
+
+    def rarest_first(self, chunks: ChunkBitmap) -> Iterator[ChunkBitmap]:
+        """Split chunks up by how many peers have them
+
+        :param chunks: the chunks to split up
+        :return: an iterator of bitmaps of the chunks one peer has, then two \
+                peers, and so on up to max_count or more, then the chunks no \
+                peer has.  Empty bitmaps are left out
+        """
+        levels = self._at_least
+        for i, bits in enumerate(levels):
+            more = levels[i + 1] if i + 1 < len(levels) else 0
+            tier = chunks._bits & bits & ~more
+            if tier:
+                yield ChunkBitmap._from_int(tier)
+        nobody = chunks._bits & ~levels[0] if levels else chunks._bits
+        if nobody:
+            yield ChunkBitmap._from_int(nobody)
+
+    def pick(
+        self, chunks: ChunkBitmap, n: int, start: int=0,
+    ) -> ChunkBitmap:
+        """Get the n rarest chunks.  Equally rare chunks are taken in order,
+        counting from start (see ChunkBitmap.first)
+
+        :param chunks: the chunks to pick from
+        :param n: how many chunks
+        :param start: the chunk to count from
+        :return: a new bitmap with at most n chunks
+        """
+        picked = ChunkBitmap()
+        for tier in self.rarest_first(chunks):
+            if n <= 0:
+                break
+            taken = tier.first(n, start)
+            picked |= taken
+            n -= len(taken)
+        return picked
@@ -8,6 +8,7 @@ from typing import Dict
 from typing import List
 from typing import Optional
 from typing import Tuple
+from typing import Union
 
 import bencode  # type: ignore
 from cryptography.exceptions import InvalidSignature  # type: ignore
@@ -30,7 +31,7 @@ class VerificationException(Exception):
     pass
 
 
-async def hash(b: bytes) -> bytes:
+async def hash(b: Union[bytes, memoryview]) -> bytes:
     """Default hash function
 
     >>> from syncr_backend.util.crypto_util import hash, b64encode
@@ -47,7 +48,7 @@ async def hash(b: bytes) -> bytes:
     return await loop.run_in_executor(None, _hash, b)
 
 
-def _hash(b: bytes) -> bytes:
+def _hash(b: Union[bytes, memoryview]) -> bytes:
     return hashlib.sha256(b).digest()
 
 
@@ -2,26 +2,35 @@ import asyncio
 import os
 import shutil
 from collections import defaultdict
+from random import randrange
 from random import shuffle
-from typing import AsyncIterator
-from typing import Awaitable  # noqa
 from typing import cast
 from typing import Dict  # noqa
 from typing import List
+from typing import MutableMapping  # noqa
 from typing import NamedTuple
 from typing import Optional
 from typing import Set
 from typing import Tuple
 from typing import TypeVar
-from typing import Union  # noqa
 
 from cachetools import TTLCache  # type: ignore
 
+from syncr_backend.constants import BUSY_PEER_TTL
+from syncr_backend.constants import BUSY_RETRY_DELAY
 from syncr_backend.constants import DEFAULT_DROP_METADATA_LOCATION
 from syncr_backend.constants import DEFAULT_FILE_METADATA_LOCATION
+from syncr_backend.constants import DEFAULT_INCOMPLETE_EXT
+from syncr_backend.constants import DROP_CHUNK_BITMAPS_TIMEOUT
+from syncr_backend.constants import ENDGAME_DELAY
+from syncr_backend.constants import ENDGAME_CHUNKS
+from syncr_backend.constants import ENDGAME_PEERS_PER_CHUNK
+from syncr_backend.constants import HEDGE_REQUEST_DELAY
 from syncr_backend.constants import MAX_CHUNKS_PER_PEER
-from syncr_backend.constants import MAX_CONCURRENT_CHUNK_DOWNLOADS
+from syncr_backend.constants import MAX_CHUNKS_PER_RANGE
+from syncr_backend.constants import MAX_CONCURRENT_DROP_SYNCS
 from syncr_backend.constants import MAX_CONCURRENT_FILE_DOWNLOADS
+from syncr_backend.constants import SYNC_PRIORITY_BACKGROUND
 from syncr_backend.constants import TRACKER_DROP_AVAILABILITY_TTL
 from syncr_backend.external_interface import drop_peer_store
 from syncr_backend.init import drop_init
@@ -32,20 +41,41 @@ from syncr_backend.metadata.drop_metadata import DropVersion
 from syncr_backend.metadata.drop_metadata import get_drop_location
 from syncr_backend.metadata.drop_metadata import list_drops
 from syncr_backend.metadata.drop_metadata import save_drop_location
+from syncr_backend.metadata.file_metadata import chunk_journal_path
 from syncr_backend.metadata.file_metadata import FileMetadata
-from syncr_backend.metadata.file_metadata import get_file_metadata_from_drop_id
-from syncr_backend.metadata.file_metadata import make_file_metadata
+from syncr_backend.metadata.file_metadata import make_files_metadata
 from syncr_backend.network import send_requests
+from syncr_backend.network.peer_scores import get_peer_scoreboard
+from syncr_backend.network.transfer_scheduler import get_transfer_scheduler
 from syncr_backend.util import async_util
 from syncr_backend.util import crypto_util
 from syncr_backend.util import fileio_util
+from syncr_backend.util import network_util
+from syncr_backend.util.bitmap_util import ChunkAvailability
+from syncr_backend.util.bitmap_util import ChunkBitmap
 from syncr_backend.util.crypto_util import VerificationException
+from syncr_backend.util.hash_cache_util import get_hash_cache
 from syncr_backend.util.log_util import get_logger
+from syncr_backend.util.sync_job_util import get_sync_job_table
+from syncr_backend.util.sync_job_util import SyncJob
+from syncr_backend.util.sync_job_util import SyncJobTable
 
 
 logger = get_logger(__name__)
 
 
+#: Peers that recently answered that they had no upload slots free
+busy_peers = TTLCache(
+    maxsize=1024, ttl=BUSY_PEER_TTL,
+)  # type: MutableMapping[Tuple[str, int], bool]
+
+#: Peers that recently didn't answer a drop chunk bitmaps request in time.
+#: Older peers never answer it, so they're asked for per-file chunk lists
+#: instead rather than making every file wait out the timeout again
+slow_bitmap_peers = TTLCache(
+    maxsize=1024, ttl=TRACKER_DROP_AVAILABILITY_TTL,
+)  # type: MutableMapping[Tuple[str, int], bool]
+
 #: Put a lock around syncing each drop, so sync_drop can be called multiple
 #: times per drop_id, and only one will run at a time
 sync_locks = defaultdict(asyncio.Lock)  # type: Dict[bytes, asyncio.Lock]
@@ -65,29 +95,52 @@ async def sync_drop(
     """
     lock = sync_locks[drop_id]
     await lock.acquire()
-
-    drop_peers = await get_drop_peers(drop_id)
-    await start_drop_from_id(drop_id, save_dir)
-    drop_metadata = await get_drop_metadata(
-        drop_id, drop_peers, save_dir, version,
-    )
-
-    file_results = await async_util.limit_gather(
-        fs=[
-            sync_and_finish_file(
-                drop_id=drop_id,
-                file_name=file_name,
-                file_id=file_id,
-                # callrotate(drop_peers) so each file starts with a new peer
-                peers=rotate(drop_peers),
-                save_dir=save_dir,
-            ) for file_name, file_id in drop_metadata.files.items()
-        ],
-        n=MAX_CONCURRENT_FILE_DOWNLOADS,
-        task_timeout=1,
-    )
-
-    lock.release()
+    try:
+        drop_peers = await get_drop_peers(drop_id)
+        await start_drop_from_id(drop_id, save_dir)
+        # what is on disk now, which may be an older version
+        local_metadata = await DropMetadata.read_file(
+            id=drop_id,
+            metadata_location=os.path.join(
+                save_dir, DEFAULT_DROP_METADATA_LOCATION,
+            ),
+        )
+        drop_metadata = await get_drop_metadata(
+            drop_id, drop_peers, save_dir, version,
+        )
+        chunk_index = {}  # type: Dict[bytes, List[LocalChunk]]
+        if local_metadata is not None:
+            local_files = await move_local_files(
+                local_metadata.files, drop_metadata.files, save_dir,
+            )
+            chunk_index = await make_local_chunk_index(local_files, save_dir)
+
+        # files with the same contents are downloaded once, then copied
+        file_names = defaultdict(list)  # type: Dict[bytes, List[str]]
+        for file_name, file_id in drop_metadata.files.items():
+            file_names[file_id].append(file_name)
+        # Ask each peer for every file's chunks up front, so get_chunk_list
+        # doesn't need a round trip per file per peer
+        await asyncio.gather(*[
+            get_drop_chunk_lists(ip, port, drop_id) for ip, port in drop_peers
+        ])
+
+        pool = async_util.WorkerPool(MAX_CONCURRENT_FILE_DOWNLOADS)
+        file_results = await pool.gather(
+            fs=[
+                sync_and_copy_files(
+                    drop_id=drop_id,
+                    file_names=names,
+                    file_id=file_id,
+                    # rotate(drop_peers) so each file starts with a new peer
+                    peers=rotate(drop_peers),
+                    save_dir=save_dir,
+                    chunk_index=chunk_index,
+                ) for file_id, names in file_names.items()
+            ],
+        )
+    finally:
+        lock.release()
 
     no_exceptions = True
     for result in file_results:
@@ -127,6 +180,7 @@ def rotate(l: List[T]) -> List[T]:
 async def sync_and_finish_file(
     drop_id: bytes, file_name: str, file_id: bytes,
     peers: List[Tuple[str, int]], save_dir: str,
+    chunk_index: Optional[Dict[bytes, List['LocalChunk']]]=None,
 ) -> bool:
     """
     Sync a file from peers, returning whether it finished. If finished, mark it
@@ -138,6 +192,8 @@ async def sync_and_finish_file(
     :param file_id: The file ID
     :param peers: Peers to ownload from
     :param save_dir: The top level directory of the drop
+    :param chunk_index: Where chunks already on disk are, from \
+            `make_local_chunk_index`
     :return: True if the file is finished, false otherwise
     """
     remaining_chunks = await sync_file_contents(
@@ -146,6 +202,7 @@ async def sync_and_finish_file(
         file_id=file_id,
         peers=peers,
         save_dir=save_dir,
+        chunk_index=chunk_index,
     )
     if not remaining_chunks:
         full_file_name = os.path.join(save_dir, file_name)
@@ -154,6 +211,45 @@ async def sync_and_finish_file(
     return False
 
 
+async def sync_and_copy_files(
+    drop_id: bytes, file_names: List[str], file_id: bytes,
+    peers: List[Tuple[str, int]], save_dir: str,
+    chunk_index: Optional[Dict[bytes, List['LocalChunk']]]=None,
+) -> bool:
+    """
+    Sync files that have the same contents.  The first one is synced from
+    peers, then copied to the others once it is finished
+
+    :param drop_id: Drop ID
+    :param file_names: The names the file has in the drop
+    :param file_id: The file ID
+    :param peers: Peers to download from
+    :param save_dir: The top level directory of the drop
+    :param chunk_index: Where chunks already on disk are, from \
+            `make_local_chunk_index`
+    :return: True if all the files are finished, false otherwise
+    """
+    first_done = await sync_and_finish_file(
+        drop_id, file_names[0], file_id, peers, save_dir, chunk_index,
+    )
+    all_done = first_done
+    loop = asyncio.get_event_loop()
+    for file_name in file_names[1:]:
+        if first_done:
+            try:
+                await loop.run_in_executor(
+                    None, _move_local_file, save_dir, file_id,
+                    file_names[0], file_name, True,
+                )
+            except OSError as e:
+                logger.warning("could not copy to %s: %s", file_name, e)
+        done = await sync_and_finish_file(
+            drop_id, file_name, file_id, peers, save_dir, chunk_index,
+        )
+        all_done = all_done and done
+    return all_done
+
+
 class PermissionError(Exception):
     """Raised if update drop tries to modify a drop it doesn't own"""
     pass
@@ -192,6 +288,7 @@ async def check_for_update(
         request_fun=send_requests.send_drop_metadata_request,
         peers=peers,
         fun_args=args,
+        hedge_after=HEDGE_REQUEST_DELAY,
     )
     new_v = metadata.version
 
@@ -214,57 +311,78 @@ async def check_for_update(
     return (metadata, False)
 
 
-_sync_in_queue = asyncio.Queue()  # type: asyncio.Queue[Awaitable[Tuple[bool, bytes]]]  # noqa
-
-
 async def queue_sync(
     drop_id: bytes, save_dir: str, version: Optional[DropVersion]=None,
+    priority: int=SYNC_PRIORITY_BACKGROUND,
 ) -> None:
     """
-    Queue a drop to be synced.  This will just put it in the sync queue that is
-    run by ``process_sync_queue``
+    Queue a drop to be synced.  This will just add a job for it to the sync
+    job table that is run by ``process_sync_queue``
 
     :param drop_id: The drop id
     :param save_dir: The drop's save directory
     :param version: Optional version, to download that version
+    :param priority: Lower priorities run first, like SYNC_PRIORITY_USER
     """
-    global _sync_in_queue
-
-    coro = sync_drop(drop_id, save_dir, version)
-    await _sync_in_queue.put(coro)
+    await get_sync_job_table().add(drop_id, save_dir, version, priority)
 
 
 async def process_sync_queue() -> None:
     """
-    Loop to process the sync queue.  Starts a ``process_queue_with_limit``
-    coroutine, checks the out queue, and re-runs unfinished out queue items
+    Loop to process the sync job table.  Loads the jobs saved before the last
+    restart, then runs up to MAX_CONCURRENT_DROP_SYNCS due jobs at a time, by
+    priority.  Jobs that don't finish are retried with exponential backoff,
+    so drops that can't be synced right now don't crowd out the others
     """
-    global _sync_in_queue
-
-    sync_out_queue = asyncio.Queue()  # type: asyncio.Queue[Union[Tuple[bool, bytes], BaseException]]  # noqa
-
-    processor = asyncio.ensure_future(
-        async_util.process_queue_with_limit(
-            _sync_in_queue, 4, sync_out_queue,
-        ),
-    )
+    table = get_sync_job_table()
+    await table.load()
+    pool = async_util.WorkerPool(MAX_CONCURRENT_DROP_SYNCS)
+    running = {}  # type: Dict[bytes, asyncio.Future]
     try:
         while True:
-            out = await sync_out_queue.get()
-            if isinstance(out, BaseException):
-                logger.error("Faied to sync a drop, can't try again", out)
-                continue
+            table.changed.clear()
+            # jobs are only given to the pool once it can run them, so the
+            # next one is picked by priority when a worker frees up
+            while pool.running + pool.queued < pool.n:
+                job = table.next_job(running)
+                if job is None:
+                    break
+                running[job.drop_id] = pool.submit(_run_sync_job(table, job))
+
+            changed = asyncio.ensure_future(table.changed.wait())
+            try:
+                await asyncio.wait(
+                    list(running.values()) + [changed],
+                    timeout=table.next_run_delay(running),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+            finally:
+                changed.cancel()
+            for drop_id, future in list(running.items()):
+                if future.done():
+                    del running[drop_id]
+                    logger.debug("drop sync pool: %s", pool.stats())
+    except asyncio.CancelledError:
+        # the jobs are still in the table, for after a restart
+        pool.cancel()
+        return
 
-            done, drop_id = out
 
-            if not done:
-                # TODO: add exponential backoff for failures
-                drop_directory = await get_drop_location(drop_id)
-                coro = sync_drop(drop_id, drop_directory)
-                await _sync_in_queue.put(coro)
+async def _run_sync_job(table: SyncJobTable, job: SyncJob) -> None:
+    revision = job.revision
+    try:
+        done, _ = await sync_drop(job.drop_id, job.save_dir, job.version)
     except asyncio.CancelledError:
-        processor.cancel()
-        return
+        raise
+    except Exception as e:
+        logger.error(
+            "failed to sync %s: %s", crypto_util.b64encode(job.drop_id), e,
+        )
+        done = False
+    if done:
+        await table.finish(job, revision)
+    else:
+        await table.retry(job, revision)
 
 
 async def make_new_version(
@@ -281,6 +399,8 @@ async def make_new_version(
     :raises PermissionError: If this node id is not an owner
     """
     drop_directory = await get_drop_location(drop_id)
+    # files may have been replaced since they were opened to send chunks
+    fileio_util.get_file_handle_cache().clear()
     old_drop_m = await DropMetadata.read_file(
         id=drop_id,
         metadata_location=os.path.join(
@@ -303,6 +423,7 @@ async def make_new_version(
         owner=old_drop_m.owner,
         other_owners=old_drop_m.other_owners,
         drop_id=old_drop_m.id,
+        hash_cache=get_hash_cache(),
         # TODO: ignore?
     )
 
@@ -381,6 +502,7 @@ async def do_metadata_request(
         request_fun=send_requests.send_drop_metadata_request,
         peers=peers,
         fun_args=args,
+        hedge_after=HEDGE_REQUEST_DELAY,
     )
     return metadata
 
@@ -395,6 +517,8 @@ async def get_drop_metadata(
     :param drop_id: the drop id
     :param peers: where to look on the network for data
     :param save_dir: where the drop is saved
+    :param version: the version to get, otherwise the latest one on disk, or \
+            on the network if there is none on disk
     :return: A drop metadata object
     """
     logger.info("getting drop metadata for %s", crypto_util.b64encode(drop_id))
@@ -404,7 +528,7 @@ async def get_drop_metadata(
     logger.debug("save_dir is %s", save_dir)
     metadata_dir = os.path.join(save_dir, DEFAULT_DROP_METADATA_LOCATION)
     metadata = await DropMetadata.read_file(
-        id=drop_id, metadata_location=metadata_dir,
+        id=drop_id, metadata_location=metadata_dir, version=version,
     )
 
     if metadata is None:
@@ -416,6 +540,7 @@ async def get_drop_metadata(
         await metadata.write_file(
             is_latest=True, metadata_location=metadata_dir,
         )
+        DropMetadata.read_file.cache_clear()  # type: ignore
 
     return metadata
 
@@ -543,6 +668,7 @@ async def get_file_metadata(
             request_fun=send_requests.send_file_metadata_request,
             peers=peers,
             fun_args={'drop_id': drop_id, 'file_id': file_id},
+            hedge_after=HEDGE_REQUEST_DELAY,
         )
 
         if metadata is None:
@@ -554,11 +680,120 @@ async def get_file_metadata(
 
 
 class FileUpdateStatus(NamedTuple):
-    """Four sets for keeping track of which files are in what status"""
+    """Four sets for keeping track of which files are in what status, and the
+    added or changed files whose contents were already there under another
+    name (new name -> old name)"""
     added: Set[str]
     removed: Set[str]
     changed: Set[str]
     unchanged: Set[str]
+    moved: Dict[str, str]
+
+
+def match_moved_files(
+    old_files: Dict[str, bytes], new_files: Dict[str, bytes],
+) -> Dict[str, str]:
+    """Match file ids across two versions of a drop's files, to find the
+    files of the new one whose contents the old one has under another name,
+    because they were renamed, moved or copied.  Old names the new version
+    doesn't keep the contents under are picked first
+
+    :param old_files: file name -> file id, like `DropMetadata.files`
+    :param new_files: file name -> file id of the new version
+    :return: new name -> old name
+    """
+    old_names = defaultdict(list)  # type: Dict[bytes, List[str]]
+    for name, file_id in sorted(old_files.items()):
+        old_names[file_id].append(name)
+
+    moved = {}  # type: Dict[str, str]
+    for name, file_id in new_files.items():
+        if old_files.get(name) == file_id or file_id not in old_names:
+            continue
+        moved[name] = min(
+            old_names[file_id],
+            key=lambda old_name: new_files.get(old_name) == file_id,
+        )
+    return moved
+
+
+def _move_local_file(
+    save_dir: str, file_id: bytes, old_name: str, new_name: str,
+    keep_old: bool,
+) -> bool:
+    """Rename or copy a file in a drop, along with its chunk journal.  Does
+    nothing if the old file is gone, or if something is already at the new
+    name, since that may be an old file whose chunks are still needed
+
+    :return: Whether the file was moved
+    """
+    old_path = os.path.join(save_dir, old_name)
+    new_path = os.path.join(save_dir, new_name)
+    try:
+        ext = '' if fileio_util.is_complete(old_path) else \
+            DEFAULT_INCOMPLETE_EXT
+    except FileNotFoundError:
+        return False
+    if (
+        os.path.lexists(new_path) or
+        os.path.lexists(new_path + DEFAULT_INCOMPLETE_EXT)
+    ):
+        return False
+
+    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+    # copy2 keeps the modification time, so the journal still matches
+    move = shutil.copy2 if keep_old else os.rename
+    move(old_path + ext, new_path + ext)
+    old_journal = chunk_journal_path(save_dir, file_id, old_name)
+    if os.path.exists(old_journal):
+        move(old_journal, chunk_journal_path(save_dir, file_id, new_name))
+    return True
+
+
+async def move_local_files(
+    old_files: Dict[str, bytes], new_files: Dict[str, bytes], save_dir: str,
+) -> Dict[str, bytes]:
+    """Rename, move or copy the files of the version of a drop on disk to
+    where a new version has their contents, so they aren't downloaded again.
+    A file is only copied if the new version keeps it at its old name too
+
+    :param old_files: file name -> file id of the version on disk
+    :param new_files: file name -> file id of the new version
+    :param save_dir: where the drop is saved
+    :return: file name -> file id of the files on disk afterwards
+    """
+    on_disk = dict(old_files)
+    loop = asyncio.get_event_loop()
+    moved = match_moved_files(old_files, new_files)
+    for new_name, old_name in sorted(moved.items()):
+        file_id = new_files[new_name]
+        if on_disk.get(old_name) != file_id:
+            # an earlier file was moved away from old_name already
+            old_name = next(
+                name for name, id in on_disk.items() if id == file_id
+            )
+        keep_old = new_files.get(old_name) == file_id
+        try:
+            done = await loop.run_in_executor(
+                None, _move_local_file, save_dir, file_id, old_name,
+                new_name, keep_old,
+            )
+        except OSError as e:
+            logger.warning("could not move %s: %s", old_name, e)
+            continue
+        if not done:
+            continue
+        logger.info(
+            "%s %s to %s", "copied" if keep_old else "moved", old_name,
+            new_name,
+        )
+        on_disk[new_name] = file_id
+        if not keep_old:
+            fileio_util.get_file_handle_cache().invalidate(
+                os.path.join(save_dir, old_name),
+            )
+            del on_disk[old_name]
+    return on_disk
 
 
 async def find_changes_in_new_version(
@@ -611,6 +846,7 @@ async def find_changes_in_new_version(
         removed=removed_files,
         changed=changed_files,
         unchanged=unchanged_files,
+        moved=match_moved_files(drop_metadata.files, new_metadata.files),
     )
 
 
@@ -634,15 +870,23 @@ async def check_for_changes(drop_id: bytes) -> Optional[FileUpdateStatus]:
     if drop_metadata is None:
         return None
 
-    files = {}
-    for (dirpath, filename) in fileio_util.walk_with_ignore(
-        drop_location, [],
-    ):
-        full_name = os.path.join(dirpath, filename)
-        rel_name = os.path.relpath(full_name, drop_location)
-        files[rel_name] = await make_file_metadata(
-            full_name, drop_id,
+    full_names = [
+        os.path.join(dirpath, filename)
+        for (dirpath, filename) in fileio_util.walk_with_ignore(
+            drop_location, [],
         )
+    ]
+    # only files that changed since they were last hashed are hashed again
+    hash_cache = get_hash_cache()
+    await hash_cache.load()
+    hash_cache.prune(drop_location, full_names)
+    files_metadata = await make_files_metadata(
+        full_names, drop_id, hash_cache=hash_cache,
+    )
+    files = {
+        os.path.relpath(name, drop_location): m.file_id
+        for (name, m) in files_metadata.items()
+    }
 
     changed_files = set()
     removed_files = set()
@@ -651,10 +895,7 @@ async def check_for_changes(drop_id: bytes) -> Optional[FileUpdateStatus]:
 
     for (name, id) in drop_metadata.files.items():
         if name in starting_files:
-            temp_metadata = await get_file_metadata_from_drop_id(
-                drop_id, id,
-            )
-            if temp_metadata == files[name]:
+            if files[name] == id:
                 unchanged_files.add(name)
             else:
                 changed_files.add(name)
@@ -667,19 +908,24 @@ async def check_for_changes(drop_id: bytes) -> Optional[FileUpdateStatus]:
         removed=removed_files,
         changed=changed_files,
         unchanged=unchanged_files,
+        moved=match_moved_files(drop_metadata.files, files),
     )
 
 
 async def sync_file_contents(
     drop_id: bytes, file_id: bytes, file_name: str,
     peers: List[Tuple[str, int]], save_dir: str,
-) -> Set[int]:
-    """Download as much of a file as possible
+    chunk_index: Optional[Dict[bytes, List['LocalChunk']]]=None,
+) -> ChunkBitmap:
+    """Download as much of a file as possible.  Chunks already somewhere on
+    disk are copied from there instead of downloaded
 
     :param drop_id: the drop the file is in
     :param file_id: the file to download
     :param save_dir: where the drop is saved
     :param peers: where to look for chunks
+    :param chunk_index: Where chunks already on disk are, from \
+            `make_local_chunk_index`
     :return: A set of chunk ids NOT downloaded
     """
     logger.info("syncing contents of file %s", file_name)
@@ -689,7 +935,7 @@ async def sync_file_contents(
     )
     file_metadata.file_name = file_name
     full_path = os.path.join(save_dir, file_name)
-    needed_chunks = None  # type: Optional[Set[int]]
+    needed_chunks = None  # type: Optional[ChunkBitmap]
     try:
         needed_chunks = await file_metadata.needed_chunks
     except FileNotFoundError:
@@ -702,79 +948,434 @@ async def sync_file_contents(
             await fileio_util.create_file(full_path, file_metadata.file_length)
         return needed_chunks
 
-    await fileio_util.create_file(full_path, file_metadata.file_length)
+    # chunks to copy may be in this file itself, past its new end, so it is
+    # only shrunk once they are copied
+    size = file_metadata.file_length
+    if chunk_index:
+        size = max(size, _current_size(full_path))
+    await fileio_util.create_file(full_path, size)
 
-    if needed_chunks is None:
-        needed_chunks = await file_metadata.needed_chunks
+    try:
+        if needed_chunks is None:
+            needed_chunks = await file_metadata.needed_chunks
 
-    process_queue = asyncio.Queue()  # type: asyncio.Queue[Awaitable[Optional[int]]] # noqa
-    result_queue = asyncio.Queue()  # type: asyncio.Queue[Union[Optional[int], BaseException]] # noqa
+        if chunk_index:
+            needed_chunks = await copy_local_chunks(
+                file_metadata, full_path, needed_chunks, chunk_index,
+            )
+            if size != file_metadata.file_length:
+                await fileio_util.create_file(
+                    full_path, file_metadata.file_length,
+                )
 
-    processor = asyncio.ensure_future(
-        async_util.process_queue_with_limit(
-            process_queue, MAX_CONCURRENT_CHUNK_DOWNLOADS, result_queue, 1,
-        ),
-    )
+        while needed_chunks:
+            assigned = await download_file_chunks(
+                drop_id, file_id, needed_chunks, peers, file_metadata,
+                full_path,
+            )
+            downloaded = needed_chunks & await file_metadata.downloaded_chunks
+            needed_chunks -= downloaded
+            if not assigned:
+                break
+            if not downloaded and any(peer in busy_peers for peer in peers):
+                # give busy peers a moment before asking them again
+                await asyncio.sleep(BUSY_RETRY_DELAY)
+            peers = await get_drop_peers(drop_id)
+    finally:
+        # the journal was last saved when a chunk finished, and chunks cut
+        # short may have been written to since
+        await file_metadata.save_journal()
 
-    while needed_chunks:
-        added = 0
-        async for (ip, port), chunks_to_download in peers_and_chunks(
-            peers, needed_chunks, drop_id, file_id, MAX_CHUNKS_PER_PEER,
-        ):
-            for cid in chunks_to_download:
-                await process_queue.put(
-                    download_chunk_from_peer(
-                        ip=ip,
-                        port=port,
-                        drop_id=drop_id,
-                        file_id=file_id,
-                        file_index=cid,
-                        file_metadata=file_metadata,
-                        full_path=full_path,
-                    ),
+    return needed_chunks
+
+
+def _current_size(full_path: str) -> int:
+    """
+    :param full_path: The path of a drop file, without the extension
+    :return: The size of the file or its incomplete file, or 0 if neither \
+            exists
+    """
+    try:
+        if not fileio_util.is_complete(full_path):
+            full_path += DEFAULT_INCOMPLETE_EXT
+        return os.path.getsize(full_path)
+    except FileNotFoundError:
+        return 0
+
+
+class LocalChunk(NamedTuple):
+    """Where a copy of a chunk might be found on disk"""
+    file_path: str
+    position: int
+    chunk_size: int
+
+
+async def make_local_chunk_index(
+    files: Dict[str, bytes], save_dir: str,
+) -> Dict[bytes, List[LocalChunk]]:
+    """Map the hash of every chunk in some files of a drop to where it is in
+    them, so chunks a new version still has (even if they moved to another
+    file) can be copied on disk instead of downloaded again
+
+    Files without metadata on disk are left out.  The chunks aren't checked,
+    so anything read from the index needs its hash checked
+
+    :param files: file name -> file id, like `DropMetadata.files`
+    :param save_dir: where the drop is saved
+    :return: chunk hash -> the places it might be
+    """
+    metadata_dir = os.path.join(save_dir, DEFAULT_FILE_METADATA_LOCATION)
+    chunk_index = defaultdict(list)  # type: Dict[bytes, List[LocalChunk]]
+    for file_name, file_id in files.items():
+        file_metadata = await FileMetadata.read_file(
+            file_id=file_id, metadata_location=metadata_dir,
+            file_name=file_name,
+        )
+        if file_metadata is None:
+            continue
+        file_path = os.path.join(save_dir, file_name)
+        for position, chunk_hash in enumerate(file_metadata.hashes):
+            chunk_index[chunk_hash].append(
+                LocalChunk(file_path, position, file_metadata.chunk_size),
+            )
+    return chunk_index
+
+
+async def copy_local_chunks(
+    file_metadata: FileMetadata, full_path: str, needed_chunks: ChunkBitmap,
+    chunk_index: Dict[bytes, List[LocalChunk]],
+) -> ChunkBitmap:
+    """Copy the needed chunks of a file that are already on disk into it.
+    Each copy has its hash checked as it is written, since the file it is in
+    may have changed (or be getting overwritten by the new version) since it
+    was indexed.  Copies are read into memory rather than viewed through a
+    memory map, as another sync may shrink the file they are in meanwhile
+
+    :param file_metadata: The file being synced
+    :param full_path: Where the file is being synced to
+    :param needed_chunks: The chunks it needs
+    :param chunk_index: Where chunks already on disk are, from \
+            `make_local_chunk_index`
+    :return: The chunks that are still needed
+    """
+    copied = ChunkBitmap()
+    for chunk_id in needed_chunks:
+        chunk_hash = file_metadata.hashes[chunk_id]
+        for source in chunk_index.get(chunk_hash, []):
+            try:
+                contents = await fileio_util.read_chunk_bytes(
+                    filepath=source.file_path,
+                    position=source.position,
+                    chunk_size=source.chunk_size,
+                )
+                await fileio_util.write_chunk(
+                    full_path, chunk_id, contents, chunk_hash,
+                    file_metadata.chunk_size,
                 )
-                added += 1
-
-        await process_queue.join()
-        while not result_queue.empty():
-            result = await result_queue.get()
-            if isinstance(result, BaseException):
-                logger.error("Failed to download a chunk: %s", result)
-            elif result is not None:
-                needed_chunks.remove(result)
-            result_queue.task_done()
-        if not added:
+            except (OSError, VerificationException):
+                continue
+            await file_metadata.finish_chunk(chunk_id)
+            copied.add(chunk_id)
             break
-        peers = await get_drop_peers(drop_id)
 
-    processor.cancel()
-    return needed_chunks
+    if copied:
+        logger.info(
+            "copied %d chunks of %s from disk", len(copied), full_path,
+        )
+    return needed_chunks - copied
 
 
-async def peers_and_chunks(
-    peers: List[Tuple[str, int]], needed_chunks: Set[int],
-    drop_id: bytes, file_id: bytes, chunks_per_peer: int,
-) -> AsyncIterator[Tuple[Tuple[str, int], Set[int]]]:
-    """
-    For each peer, figure out what chunks it has, then yield the first
-    chunks_per_peer chunks that haven't been reserved for another peer
+async def download_file_chunks(
+    drop_id: bytes, file_id: bytes, needed_chunks: ChunkBitmap,
+    peers: List[Tuple[str, int]], file_metadata: FileMetadata,
+    full_path: str,
+) -> bool:
+    """Download the needed chunks of a file in a continuous pipeline.  Each
+    peer with some of them gets a worker, which takes the rarest chunks the
+    peer has that nobody else is downloading as soon as the node's
+    TransferScheduler lets it, so fast peers don't wait on slow ones.  A
+    peer is given about MAX_CHUNKS_PER_PEER chunks at a time, scaled by how
+    fast it is compared to the others.  Equally rare chunks are taken
+    counting from a random chunk, so nodes syncing the same file at once
+    don't all ask for the same chunks.
+
+    Chunks that fail go straight back to be taken by any other peer.  A
+    worker stops once there is nothing left it can take, or if its peer
+    fails.  If only a few needed chunks are left and none has finished for a
+    while, they are also fetched with `endgame_chunks`
 
+    :param drop_id: Drop ID
+    :param file_id: File ID
+    :param needed_chunks: The chunks to download
     :param peers: Peer list
-    :param needed_chunks: Needed chunks
+    :param file_metadata: The file metadata
+    :param full_path: The path of the file
+    :return: Whether any of the chunks were found on a peer
+    """
+    scoreboard = get_peer_scoreboard()
+    # sorted is stable, so this only moves busy peers to the back
+    peers = sorted(
+        scoreboard.by_throughput(peers), key=lambda peer: peer in busy_peers,
+    )
+    chunk_lists = await asyncio.gather(*[
+        _try_get_chunk_list(ip, port, drop_id, file_id) for ip, port in peers
+    ])
+    availability = ChunkAvailability()
+    for avail_chunks in chunk_lists:
+        if avail_chunks is not None:
+            availability.add(avail_chunks & needed_chunks)
+
+    pending = needed_chunks.copy()
+    start = randrange(file_metadata.num_chunks)
+    scheduler = get_transfer_scheduler()
+    changed = asyncio.Condition()
+    in_flight = 0
+
+    async def work(peer: Tuple[str, int], avail_chunks: ChunkBitmap) -> None:
+        nonlocal pending, in_flight
+        failed = ChunkBitmap()
+        while (avail_chunks & pending) - failed:
+            count = min(
+                len((avail_chunks & pending) - failed),
+                max(1, round(
+                    MAX_CHUNKS_PER_PEER * scoreboard.chunk_share(peer, peers),
+                )),
+            )
+            nbytes = count * file_metadata.chunk_size
+            await scheduler.acquire(drop_id, file_id, nbytes)
+            try:
+                # other workers may have taken chunks while this one waited
+                chunks = availability.pick(
+                    (avail_chunks & pending) - failed, count, start,
+                )
+                pending -= chunks
+                in_flight += 1
+                try:
+                    ok = await download_from_peer(
+                        peer, drop_id, file_id, chunks, file_metadata,
+                        full_path,
+                    )
+                finally:
+                    in_flight -= 1
+            finally:
+                scheduler.release(nbytes)
+            returned = chunks - await file_metadata.downloaded_chunks
+            pending |= returned
+            failed |= returned
+            async with changed:
+                changed.notify_all()
+                if not ok:
+                    return
+                # wait for chunks that this peer has to come back, until
+                # nothing else is running that could give any back
+                while in_flight and not (avail_chunks & pending) - failed:
+                    await changed.wait()
+
+    workers = [
+        asyncio.ensure_future(work(peer, avail_chunks))
+        for peer, avail_chunks in zip(peers, chunk_lists)
+        if avail_chunks is not None and avail_chunks & needed_chunks
+    ]  # type: List[asyncio.Future]
+    loop = asyncio.get_event_loop()
+    last_finished = loop.time()
+    left = needed_chunks - await file_metadata.downloaded_chunks
+    endgame = None  # type: Optional[asyncio.Future]
+    try:
+        while left:
+            running = [worker for worker in workers if not worker.done()]
+            if endgame is not None and not endgame.done():
+                running.append(endgame)
+            if not running:
+                break
+            await asyncio.wait(
+                running, timeout=ENDGAME_DELAY,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            now_left = needed_chunks - await file_metadata.downloaded_chunks
+            if len(now_left) < len(left):
+                last_finished = loop.time()
+            left = now_left
+            if (
+                endgame is None and 0 < len(left) <= ENDGAME_CHUNKS and
+                loop.time() - last_finished >= ENDGAME_DELAY
+            ):
+                logger.info(
+                    "%s chunks of %s left, starting endgame", len(left),
+                    file_metadata.file_name,
+                )
+                endgame = asyncio.ensure_future(endgame_chunks(
+                    drop_id, file_id, left, peers, file_metadata, full_path,
+                ))
+    finally:
+        # once every chunk is done, downloads still running are stragglers
+        for task in workers + ([endgame] if endgame is not None else []):
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is not None:
+                logger.error("Failed to download chunks: %s", task.exception())
+    return bool(workers)
+
+
+async def download_from_peer(
+    peer: Tuple[str, int], drop_id: bytes, file_id: bytes,
+    chunks: ChunkBitmap, file_metadata: FileMetadata, full_path: str,
+) -> bool:
+    """Download chunks from a peer all at once: chunks that are partly
+    downloaded block by block, and the rest in runs
+
+    :param peer: The peer
     :param drop_id: Drop ID
     :param file_id: File ID
-    :param chunks_per_peer: How many chunks each peer gets assigned
-    :return: Async Iterator over peers and sets of chunk indexes
-    """
-    needed_chunks = needed_chunks.copy()
-    for ip, port in peers:
-        avail_chunks = await get_chunk_list(ip, port, drop_id, file_id)
-        can_get_from_peer = avail_chunks & needed_chunks
-        chunks_for_peer = set(list(can_get_from_peer)[:chunks_per_peer])
-        needed_chunks -= chunks_for_peer
-        yield ((ip, port), chunks_for_peer)
-        if not needed_chunks:
-            break
+    :param chunks: The chunks
+    :param file_metadata: The file metadata
+    :param full_path: The path of the file
+    :return: False if any download from the peer failed
+    """
+    ip, port = peer
+    partial = chunks & file_metadata.partial_chunks
+    downloads = [
+        download_chunks_from_peer(
+            ip=ip,
+            port=port,
+            drop_id=drop_id,
+            file_id=file_id,
+            start=start,
+            count=count,
+            file_metadata=file_metadata,
+            full_path=full_path,
+        )
+        for start, count in (chunks - partial).runs(
+            max_length=MAX_CHUNKS_PER_RANGE,
+        )
+    ] + [
+        download_blocks_from_peer(
+            ip=ip,
+            port=port,
+            drop_id=drop_id,
+            file_id=file_id,
+            file_index=cid,
+            file_metadata=file_metadata,
+            full_path=full_path,
+        )
+        for cid in partial
+    ]
+    ok = True
+    for result in await asyncio.gather(*downloads, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error(
+                "Failed to download chunks from %s:%s: %s", ip, port, result,
+            )
+            ok = False
+    return ok
+
+
+async def endgame_chunks(
+    drop_id: bytes, file_id: bytes, chunks: ChunkBitmap,
+    peers: List[Tuple[str, int]], file_metadata: FileMetadata,
+    full_path: str,
+) -> ChunkBitmap:
+    """Fetch each of the last few chunks of a file from several peers at
+    once, keep the first copy of each that is verified, and cancel the rest.
+    The copies are fetched whole into memory, so nothing is written until
+    one is verified; the chunk is then taken over through the file's write
+    guard, so downloads of it still streaming stop writing to it.  The
+    copies don't wait for the TransferScheduler, whose transfers are held by
+    the very downloads they race; there are at most ENDGAME_CHUNKS *
+    ENDGAME_PEERS_PER_CHUNK of them.  Each goes on a connection of its own,
+    rather than behind the straggling download on the pooled one, and the
+    losers' connections are closed instead of being read to the end
+
+    :param drop_id: Drop ID
+    :param file_id: File ID
+    :param chunks: The chunks left
+    :param peers: Peer list
+    :param file_metadata: The file metadata
+    :param full_path: The path of the file
+    :return: The chunks that were downloaded
+    """
+    peers = get_peer_scoreboard().by_throughput(peers)
+    chunk_lists = await asyncio.gather(*[
+        _try_get_chunk_list(ip, port, drop_id, file_id) for ip, port in peers
+    ])
+
+    async def fetch(ip: str, port: int, index: int) -> bytes:
+        chunk = await send_requests.send_chunk_request(
+            ip=ip,
+            port=port,
+            drop_id=drop_id,
+            file_id=file_id,
+            file_index=index,
+            dedicated=True,
+        )
+        if await crypto_util.hash(chunk) != file_metadata.hashes[index]:
+            raise VerificationException(
+                "chunk %s from %s failed verification" % (index, ip),
+            )
+        return chunk
+
+    tasks = {}  # type: Dict[asyncio.Future, int]
+    for index in chunks:
+        holders = [
+            peer for peer, avail_chunks in zip(peers, chunk_lists)
+            if avail_chunks is not None and index in avail_chunks
+        ]
+        for ip, port in holders[:ENDGAME_PEERS_PER_CHUNK]:
+            tasks[asyncio.ensure_future(fetch(ip, port, index))] = index
+
+    done = ChunkBitmap()
+    guard = file_metadata.write_guard
+    try:
+        while tasks:
+            finished, _ = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in finished:
+                index = tasks.pop(task)
+                if task.cancelled() or index in done:
+                    continue
+                if task.exception() is not None:
+                    logger.info(
+                        "endgame copy of chunk %s failed: %s", index,
+                        task.exception(),
+                    )
+                    continue
+                if index not in await file_metadata.downloaded_chunks:
+                    if not await guard.take(index):
+                        continue
+                    try:
+                        await fileio_util.write_chunk(
+                            filepath=full_path,
+                            position=index,
+                            contents=task.result(),
+                            chunk_hash=file_metadata.hashes[index],
+                            chunk_size=file_metadata.chunk_size,
+                        )
+                    except OSError as e:
+                        logger.warning(
+                            "could not write chunk %s: %s", index, e,
+                        )
+                        guard.release(index)
+                        continue
+                    await file_metadata.finish_chunk(index)
+                    done.add(index)
+                for other, other_index in tasks.items():
+                    if other_index == index:
+                        other.cancel()
+    finally:
+        for task in tasks:
+            task.cancel()
+    logger.debug("endgame downloaded chunks %s", list(done))
+    return done
+
+
+async def _try_get_chunk_list(
+    ip: str, port: int, drop_id: bytes, file_id: bytes,
+) -> Optional[ChunkBitmap]:
+    try:
+        return await get_chunk_list(ip, port, drop_id, file_id)
+    except (OSError, network_util.SyncrNetworkException) as e:
+        logger.info("could not get chunk list from %s:%s: %s", ip, port, e)
+        return None
 
 
 @async_util.async_cache(
@@ -782,7 +1383,7 @@ async def peers_and_chunks(
 )
 async def get_chunk_list(
     ip: str, port: int, drop_id: bytes, file_id: bytes,
-) -> Set[int]:
+) -> ChunkBitmap:
     """
     Get the list of chunks (ip, port) has.  This function exists so the result
     can be cached.
@@ -791,22 +1392,153 @@ async def get_chunk_list(
     :param port: Port to connect to
     :param drop_id: Drop ID
     :param file_id: File ID to get chunks for
-    :return: Set of chunk indexes
+    :return: ChunkBitmap of chunk indexes
     """
-    return set(await send_requests.send_chunk_list_request(
+    drop_chunk_lists = await get_drop_chunk_lists(ip, port, drop_id)
+    if drop_chunk_lists is not None:
+        return drop_chunk_lists.get(file_id, ChunkBitmap())
+    return await send_requests.send_chunk_list_request(
         ip=ip,
         port=port,
         drop_id=drop_id,
         file_id=file_id,
-    ))
+    )
 
 
-async def download_chunk_from_peer(
+async def get_drop_chunk_lists(
+    ip: str, port: int, drop_id: bytes,
+) -> Optional[Dict[bytes, ChunkBitmap]]:
+    """
+    Get the chunks (ip, port) has of every file in a drop in one request
+
+    :param ip: IP to connect to
+    :param port: Port to connect to
+    :param drop_id: Drop ID
+    :return: Dict of file ID to ChunkBitmap, or None if the peer \
+            couldn't answer
+    """
+    if (ip, port) in slow_bitmap_peers:
+        return None
+    try:
+        return await _get_drop_chunk_lists(ip, port, drop_id)
+    except (asyncio.TimeoutError, network_util.PeerTimeoutException):
+        logger.debug(
+            "drop chunk bitmaps request to %s:%s timed out", ip, port,
+        )
+        slow_bitmap_peers[(ip, port)] = True
+        return None
+    except Exception as e:
+        logger.debug(
+            "drop chunk bitmaps request to %s:%s failed: %s", ip, port, e,
+        )
+        return None
+
+
+@async_util.async_cache(
+    maxsize=1024, cache_obj=TTLCache, ttl=TRACKER_DROP_AVAILABILITY_TTL,
+    cache_none=True,
+)
+async def _get_drop_chunk_lists(
+    ip: str, port: int, drop_id: bytes,
+) -> Optional[Dict[bytes, ChunkBitmap]]:
+    """
+    Like get_drop_chunk_lists, but only returns None if the peer doesn't
+    support the request, which is cached so it isn't asked again.  Other
+    failures (a timeout, a broken connection) raise, and aren't cached here
+    """
+    try:
+        return await asyncio.wait_for(
+            send_requests.send_drop_chunk_bitmaps_request(
+                ip=ip,
+                port=port,
+                drop_id=drop_id,
+            ),
+            DROP_CHUNK_BITMAPS_TIMEOUT,
+        )
+    except (
+        network_util.IncompatibleProtocolVersionException,
+        network_util.InvalidInputException,
+    ):
+        # older peers answer unknown request types with ERR_INVINPUT
+        logger.debug("%s:%s can't send drop chunk bitmaps", ip, port)
+        return None
+
+
+async def download_chunks_from_peer(
+    ip: str, port: int, drop_id: bytes, file_id: bytes, start: int,
+    count: int, file_metadata: FileMetadata, full_path: str,
+) -> ChunkBitmap:
+    """Download a run of consecutive chunks from a peer in one request, and
+    mark the ones that succeed done in the File Metadata.  If the transfer
+    breaks part way through a chunk, the blocks of it that were written are
+    kept so it can be resumed with `download_blocks_from_peer`
+
+    :param ip: Peer ip
+    :param port: Peer port
+    :param drop_id: Drop ID
+    :param file_id: File ID
+    :param start: First chunk index
+    :param count: Number of chunks
+    :param file_metadata: The file metadata
+    :param full_path: The path of the file
+    :return: The chunks that were downloaded
+    """
+    scoreboard = get_peer_scoreboard()
+    loop = asyncio.get_event_loop()
+    # time the transfer from its first bytes, so time spent queued behind
+    # other requests to the peer doesn't count against it
+    first_progress = []  # type: List[Tuple[float, int]]
+
+    def progress(index: int, length: int) -> None:
+        if not first_progress:
+            first_progress.append((loop.time(), length))
+        file_metadata.finish_chunk_prefix(index, length)
+
+    try:
+        done = await send_requests.send_raw_chunk_range_request(
+            ip=ip,
+            port=port,
+            drop_id=drop_id,
+            file_id=file_id,
+            start=start,
+            count=count,
+            filepath=full_path,
+            hashes=file_metadata.hashes,
+            chunk_size=file_metadata.chunk_size,
+            progress=progress,
+            chunk_done=file_metadata.finish_chunk,
+            guard=file_metadata.write_guard,
+        )
+    except network_util.BusyException:
+        busy_peers[(ip, port)] = True
+        raise
+    except (OSError, network_util.SyncrNetworkException):
+        scoreboard.record_failure((ip, port))
+        raise
+    if first_progress and done:
+        started, first_length = first_progress[0]
+        scoreboard.record_transfer(
+            (ip, port),
+            sum(map(file_metadata.chunk_length, done)) - first_length,
+            loop.time() - started,
+        )
+    for file_index in range(start, start + count):
+        if file_index in done:
+            continue
+        if not file_metadata.needed_blocks(file_index):
+            # all of it arrived, but it failed verification
+            file_metadata.discard_blocks(file_index)
+    return done
+
+
+async def download_blocks_from_peer(
     ip: str, port: int, drop_id: bytes, file_id: bytes, file_index: int,
     file_metadata: FileMetadata, full_path: str,
-) -> Optional[int]:
-    """Download a chunk from a peer, and if it succeeds mark that chunk done
-    in the File Metadata
+) -> ChunkBitmap:
+    """Download the blocks of a chunk that haven't been written yet from a
+    peer, then verify the whole chunk and mark it done in the File Metadata.
+    Falls back to downloading the whole chunk from peers that can't send
+    blocks
 
     :param ip: Peer ip
     :param port: Peer port
@@ -815,30 +1547,84 @@ async def download_chunk_from_peer(
     :param file_index: Chunk index
     :param file_metadata: The file metadata
     :param full_path: The path of the file
-    :return: The chunk id if success, otherwise None
+    :return: The chunk, if it is now done
     """
-    chunk = await send_requests.send_chunk_request(
-        ip=ip,
-        port=port,
-        drop_id=drop_id,
-        file_id=file_id,
-        file_index=file_index,
+    chunk_length = file_metadata.chunk_length(file_index)
+
+    scoreboard = get_peer_scoreboard()
+    loop = asyncio.get_event_loop()
+
+    async def download_block(block: int) -> None:
+        offset = block * file_metadata.block_size
+        length = min(file_metadata.block_size, chunk_length - offset)
+        started = loop.time()
+        try:
+            await send_requests.send_raw_block_request(
+                ip=ip,
+                port=port,
+                drop_id=drop_id,
+                file_id=file_id,
+                file_index=file_index,
+                offset=offset,
+                length=length,
+                filepath=full_path,
+                chunk_size=file_metadata.chunk_size,
+                guard=file_metadata.write_guard,
+            )
+        except (
+            network_util.BusyException,
+            network_util.FramingNotSupportedException,
+        ):
+            raise
+        except (OSError, network_util.SyncrNetworkException):
+            scoreboard.record_failure((ip, port))
+            raise
+        scoreboard.record_transfer((ip, port), length, loop.time() - started)
+        file_metadata.finish_blocks(file_index, [block])
+
+    results = await asyncio.gather(
+        *[
+            download_block(block)
+            for block in file_metadata.needed_blocks(file_index)
+        ],
+        return_exceptions=True,
     )
-    try:
-        await fileio_util.write_chunk(
-            filepath=full_path,
-            position=file_index,
-            contents=chunk,
-            chunk_hash=file_metadata.hashes[file_index],
-        )
-        await file_metadata.finish_chunk(file_index)
-        return file_index
-    except crypto_util.VerificationException as e:
+    for result in results:
+        if isinstance(result, network_util.BusyException):
+            busy_peers[(ip, port)] = True
+        if isinstance(result, network_util.FramingNotSupportedException):
+            file_metadata.discard_blocks(file_index)
+            return await download_chunks_from_peer(
+                ip=ip,
+                port=port,
+                drop_id=drop_id,
+                file_id=file_id,
+                start=file_index,
+                count=1,
+                file_metadata=file_metadata,
+                full_path=full_path,
+            )
+        elif isinstance(result, Exception):
+            logger.warning(
+                "failed to download block of chunk %s from %s: %s",
+                file_index, ip, result,
+            )
+
+    if file_metadata.needed_blocks(file_index):
+        return ChunkBitmap()
+    _, h = await fileio_util.read_chunk(
+        filepath=full_path,
+        position=file_index,
+        chunk_size=file_metadata.chunk_size,
+    )
+    if h != file_metadata.hashes[file_index]:
         logger.warning(
-            "verification exception (%s) from peer %s, skipping",
-            e, ip,
+            "chunk %s assembled from blocks failed verification", file_index,
         )
-        return None
+        file_metadata.discard_blocks(file_index)
+        return ChunkBitmap()
+    await file_metadata.finish_chunk(file_index)
+    return ChunkBitmap([file_index])
 
 
 class PeerStoreError(Exception):
@@ -1,15 +1,21 @@
 """Helper functions for reading from and writing to the filesystem"""
 import asyncio
 import fnmatch
+import hashlib
 import json
+import mmap
 import os
-from collections import defaultdict
+from collections import OrderedDict
 from typing import Any
+from typing import BinaryIO
+from typing import Callable
 from typing import Dict  # noqa
 from typing import Iterator
 from typing import List
 from typing import Optional
 from typing import Tuple
+from typing import TypeVar
+from typing import Union
 
 import aiofiles  # type: ignore
 
@@ -17,17 +23,262 @@ from syncr_backend.constants import DEFAULT_CHUNK_SIZE
 from syncr_backend.constants import DEFAULT_DPS_CONFIG_FILE
 from syncr_backend.constants import DEFAULT_IGNORE
 from syncr_backend.constants import DEFAULT_INCOMPLETE_EXT
+from syncr_backend.constants import MAX_OPEN_FILES
+from syncr_backend.constants import STREAM_BLOCK_SIZE
+from syncr_backend.constants import USE_MMAP
 from syncr_backend.external_interface.store_exceptions import \
     MissingConfigError
 from syncr_backend.init.node_init import get_full_init_directory
 from syncr_backend.util import crypto_util
+from syncr_backend.util.bandwidth_util import ByteReader
+from syncr_backend.util.bitmap_util import ChunkBitmap
 from syncr_backend.util.log_util import get_logger
 
 
 logger = get_logger(__name__)
 
 
-write_locks = defaultdict(asyncio.Lock)  # type: Dict[str, asyncio.Lock]
+R = TypeVar('R')
+
+
+class ChunkWriteGuard(object):
+    """Lets chunks of a file that are being streamed into it be taken over
+    by another writer.  Streams write each block under the lock, and write
+    nothing more to a chunk once it has been taken"""
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.taken = ChunkBitmap()
+
+    async def take(self, position: int) -> bool:
+        """Take a chunk over.  Waits for any block being written to it, so
+        once this returns nothing else writes to the chunk
+
+        :param position: the chunk index
+        :return: False if the chunk was already taken
+        """
+        async with self.lock:
+            if position in self.taken:
+                return False
+            self.taken.add(position)
+            return True
+
+    def release(self, position: int) -> None:
+        """Let streams write to a chunk that was taken again, when taking it
+        over failed
+
+        :param position: the chunk index
+        """
+        self.taken.discard(position)
+
+
+class OpenFile(object):
+    """A drop file held open by a FileHandleCache
+
+    :param fd: The file descriptor
+    :param complete: Whether the file is complete, so it was opened read \
+            only, rather than its incomplete file for reading and writing
+    :param mapping: A read only memory map of the file, if it is mapped
+    """
+
+    def __init__(
+        self, fd: int, complete: bool, mapping: Optional[mmap.mmap]=None,
+    ) -> None:
+        self.fd = fd
+        self.complete = complete
+        self.mapping = mapping
+        #: How many callers are using the descriptor
+        self.users = 0
+        #: Set once it is no longer cached, so it is closed when unused
+        self.dropped = False
+
+
+class FileHandleCache(object):
+    """Keeps the most recently used drop files open, so reading or writing a
+    chunk is one positional read or write in the executor instead of an
+    open, seek, read or write and close.
+
+    Files are cached by their path without the incomplete extension.  A
+    cached descriptor keeps pointing at the file it opened, so anything that
+    renames, replaces or deletes a drop file must `invalidate` it.  A
+    descriptor that is dropped while in use is closed once it is released.
+
+    With use_mmap, the files are also memory mapped as they are opened, so
+    `view` hands out slices of the mapping.  The mappings are bounded along
+    with the descriptors, and a dropped one is unmapped once the last view
+    of it is gone
+
+    :param max_files: Most files to keep open
+    :param use_mmap: Whether to memory map the files
+    """
+
+    def __init__(
+        self, max_files: int=MAX_OPEN_FILES, use_mmap: bool=USE_MMAP,
+    ) -> None:
+        self.max_files = max_files
+        self.use_mmap = use_mmap
+        self._files = OrderedDict()  # type: OrderedDict[str, OpenFile]
+        # bumped whenever files are invalidated, so a file that was being
+        # opened at the time isn't cached
+        self._generation = 0
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    async def acquire(self, filepath: str) -> OpenFile:
+        """Get a drop file's descriptor, opening the file if it isn't cached.
+        Must be given back with `release`
+
+        :param filepath: The path of the file, without the extension
+        :raises FileNotFoundError: If neither the file nor .part file is found
+        :return: The open file
+        """
+        handle = self._files.get(filepath)
+        if handle is None:
+            generation = self._generation
+            opening = asyncio.get_event_loop().run_in_executor(
+                None, _open_drop_file, filepath, self.use_mmap,
+            )
+            try:
+                handle = await asyncio.shield(opening)
+            except asyncio.CancelledError:
+                opening.add_done_callback(_close_opened)
+                raise
+            cached = self._files.get(filepath)
+            if cached is not None:
+                # opened by someone else meanwhile
+                _close(handle)
+                handle = cached
+            elif generation != self._generation:
+                handle.dropped = True
+            else:
+                self._files[filepath] = handle
+                self._evict()
+        if not handle.dropped:
+            self._files.move_to_end(filepath)
+        handle.users += 1
+        return handle
+
+    def release(self, handle: OpenFile) -> None:
+        """Give back a descriptor from `acquire`
+
+        :param handle: The open file
+        """
+        handle.users -= 1
+        if handle.dropped and not handle.users:
+            _close(handle)
+
+    async def read(self, filepath: str, offset: int, size: int) -> bytes:
+        """Read up to size bytes of a drop file, or of its incomplete file if
+        it isn't complete
+
+        :param filepath: The path of the file, without the extension
+        :param offset: Where to read from
+        :param size: How many bytes to read
+        :return: The bytes read
+        """
+        handle = await self.acquire(filepath)
+        try:
+            return await _run_to_end(os.pread, handle.fd, size, offset)
+        finally:
+            self.release(handle)
+
+    async def view(self, filepath: str, offset: int, size: int) -> memoryview:
+        """Like `read`, but if the file is mapped, returns a slice of the
+        mapping rather than copying the bytes out of it.  The slice shows
+        whatever is written to that part of the file later on
+
+        :param filepath: The path of the file, without the extension
+        :param offset: Where to read from
+        :param size: How many bytes to read
+        :return: A view of the bytes read
+        """
+        handle = await self.acquire(filepath)
+        try:
+            mapping = handle.mapping
+            # past the end of the mapping, the file may have grown since
+            if mapping is not None and offset + size <= len(mapping):
+                return memoryview(mapping)[offset:offset + size]
+            return memoryview(
+                await _run_to_end(os.pread, handle.fd, size, offset),
+            )
+        finally:
+            self.release(handle)
+
+    def invalidate(self, filepath: str) -> None:
+        """Stop using the cached descriptor of a drop file, once it is
+        renamed, replaced or deleted
+
+        :param filepath: The path of the file, without the extension
+        """
+        self._generation += 1
+        handle = self._files.pop(filepath, None)
+        if handle is not None:
+            self._drop(handle)
+
+    def clear(self) -> None:
+        """Stop using every cached descriptor"""
+        self._generation += 1
+        while self._files:
+            _, handle = self._files.popitem()
+            self._drop(handle)
+
+    def _evict(self) -> None:
+        while len(self._files) > self.max_files:
+            _, handle = self._files.popitem(last=False)
+            self._drop(handle)
+
+    def _drop(self, handle: OpenFile) -> None:
+        handle.dropped = True
+        if not handle.users:
+            _close(handle)
+
+
+def _open_drop_file(filepath: str, use_mmap: bool) -> OpenFile:
+    flags = getattr(os, 'O_BINARY', 0)
+    try:
+        fd = os.open(filepath + DEFAULT_INCOMPLETE_EXT, os.O_RDWR | flags)
+        handle = OpenFile(fd, complete=False)
+    except FileNotFoundError:
+        fd = os.open(filepath, os.O_RDONLY | flags)
+        handle = OpenFile(fd, complete=True)
+    if use_mmap:
+        try:
+            handle.mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError, OverflowError) as e:
+            # empty files can't be mapped; those are read without it
+            logger.debug("not mapping %s: %s", filepath, e)
+    return handle
+
+
+def _close(handle: OpenFile) -> None:
+    if handle.mapping is not None:
+        try:
+            handle.mapping.close()
+        except BufferError:
+            # views of it are still around; it is unmapped once they're gone
+            pass
+    os.close(handle.fd)
+
+
+def _close_opened(opening: asyncio.Future) -> None:
+    if not opening.cancelled() and opening.exception() is None:
+        _close(opening.result())
+
+
+_cache_instance = None  # type: Optional[FileHandleCache]
+
+
+def get_file_handle_cache() -> FileHandleCache:
+    """
+    Get the cache every chunk read and write goes through
+
+    :return: The FileHandleCache
+    """
+    global _cache_instance
+    if _cache_instance is None:
+        _cache_instance = FileHandleCache()
+    return _cache_instance
 
 
 async def load_config_file() -> Dict[str, Any]:
@@ -50,8 +301,55 @@ async def load_config_file() -> Dict[str, Any]:
     return config_file
 
 
+class AtomicFile(object):
+    """A small file of node state that is always read and written whole.
+    Writes go to a temporary file that then replaces it, so it is never left
+    half written, and are done one at a time in the order they were asked
+    for, so an older save can't replace a newer one
+
+    :param path: Where the file is
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = asyncio.Lock()
+
+    async def read(self) -> bytes:
+        """Read the file
+
+        :raises OSError: If it can't be read, ie it doesn't exist yet
+        :return: Its contents
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, _read_file, self.path)
+
+    async def write(self, data: bytes) -> None:
+        """Replace the file, creating its directory if needed
+
+        :param data: Its new contents
+        :raises OSError: If it can't be written
+        """
+        loop = asyncio.get_event_loop()
+        async with self._lock:
+            await loop.run_in_executor(None, _replace_file, self.path, data)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _replace_file(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + DEFAULT_INCOMPLETE_EXT
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
 async def write_chunk(
-    filepath: str, position: int, contents: bytes, chunk_hash: bytes,
+    filepath: str, position: int, contents: Union[bytes, memoryview],
+    chunk_hash: bytes,
     chunk_size: int=DEFAULT_CHUNK_SIZE,
 ) -> None:
     """
@@ -72,41 +370,237 @@ async def write_chunk(
             bytes does not match the provided hash
     :return: None
     """
-    if is_complete(filepath):
-        logger.info("file %s already done, not writing", filepath)
-        return
+    cache = get_file_handle_cache()
+    handle = await cache.acquire(filepath)
+    try:
+        if handle.complete:
+            logger.info("file %s already done, not writing", filepath)
+            return
+
+        computed_hash = await crypto_util.hash(contents)
+        if computed_hash != chunk_hash:
+            raise crypto_util.VerificationException(
+                "Computed: %s, expected: %s" % (
+                    crypto_util.b64encode(computed_hash).decode('utf-8'),
+                    crypto_util.b64encode(chunk_hash).decode('utf-8'),
+                ),
+            )
+        logger.debug(
+            "writing chunk with filepath %s and hash %s", filepath,
+            crypto_util.b64encode(chunk_hash),
+        )
+        await _run_to_end(
+            _write_all, handle.fd, contents, position * chunk_size,
+        )
+    finally:
+        cache.release(handle)
+
 
-    filepath += DEFAULT_INCOMPLETE_EXT
-    computed_hash = await crypto_util.hash(contents)
+async def write_chunk_from_stream(
+    filepath: str, position: int, reader: ByteReader, length: int,
+    chunk_hash: bytes, chunk_size: int=DEFAULT_CHUNK_SIZE,
+    progress: Optional[Callable[[int], None]]=None,
+    guard: Optional[ChunkWriteGuard]=None,
+) -> bool:
+    """
+    Like write_chunk, but reads the chunk's length bytes off reader and writes
+    them to the file as they arrive, up to STREAM_BLOCK_SIZE at a time, while
+    keeping a running hash.  The hash can only be checked after the whole
+    chunk is written, so a chunk that fails verification leaves garbage in its
+    (still needed) place in the file.
+
+    Always reads exactly length bytes off reader, even if writing fails, so
+    the stream is left at the end of the chunk.
+
+    If the file extension indicates the file is complete, or the chunk is
+    taken over through guard, the rest of the bytes are read and discarded.
+
+    :param filepath: the path of the file to write to
+    :param position: the chunk index to write to
+    :param reader: where to read the chunk bytes from
+    :param length: how many bytes the chunk is
+    :param chunk_hash: the expected hash of the chunk
+    :param chunk_size: (optional) override the chunk size, used to calculate \
+    the position in the file
+    :param progress: (optional) called with the number of bytes written so \
+    far after every write, so a transfer that breaks part way can be resumed
+    :param guard: (optional) the guard of the file, so the chunk can be taken \
+    over by another writer
+    :raises ValueError: If length is larger than chunk_size.  Nothing is read
+    :raises asyncio.IncompleteReadError: If reader ends before length bytes
+    :raises crypto_util.VerificationException: When the hash of the bytes \
+            read does not match the provided hash
+    :return: False if the chunk was taken over, so it wasn't written or \
+            verified
+    """
+    if length > chunk_size:
+        raise ValueError("chunk of %s bytes is too large" % length)
+
+    sha = hashlib.sha256()
+    written = await _write_from_stream(
+        filepath, position * chunk_size, reader, length, sha, progress,
+        guard, position,
+    )
+    if not written:
+        return guard is None or position not in guard.taken
+    computed_hash = sha.digest()
     if computed_hash != chunk_hash:
         raise crypto_util.VerificationException(
             "Computed: %s, expected: %s" % (
-                crypto_util.b64encode(computed_hash),
-                crypto_util.b64encode(chunk_hash),
+                crypto_util.b64encode(computed_hash).decode('utf-8'),
+                crypto_util.b64encode(chunk_hash).decode('utf-8'),
             ),
         )
     logger.debug(
-        "writing chunk with filepath %s and hash %s", filepath,
+        "streamed chunk with filepath %s and hash %s", filepath,
         crypto_util.b64encode(chunk_hash),
     )
+    return True
+
+
+async def write_block_from_stream(
+    filepath: str, position: int, offset: int, reader: ByteReader,
+    length: int, chunk_size: int=DEFAULT_CHUNK_SIZE,
+    guard: Optional[ChunkWriteGuard]=None,
+) -> None:
+    """
+    Like write_chunk_from_stream, but for a block of length bytes at offset
+    within a chunk.  Blocks can't be verified on their own; once all of a
+    chunk's blocks are written, check it with read_chunk
+
+    :param filepath: the path of the file to write to
+    :param position: the chunk index the block is in
+    :param offset: where the block starts within the chunk
+    :param reader: where to read the block bytes from
+    :param length: how many bytes the block is
+    :param chunk_size: (optional) override the chunk size, used to calculate \
+    the position in the file
+    :param guard: (optional) the guard of the file, so the chunk can be taken \
+    over by another writer
+    :raises ValueError: If the block doesn't fit in the chunk.  Nothing is read
+    :raises asyncio.IncompleteReadError: If reader ends before length bytes
+    :return: None
+    """
+    if offset < 0 or offset + length > chunk_size:
+        raise ValueError(
+            "block of %s bytes at %s is outside the chunk" % (length, offset),
+        )
+    await _write_from_stream(
+        filepath, position * chunk_size + offset, reader, length,
+        guard=guard, position=position,
+    )
+
+
+async def _write_from_stream(
+    filepath: str, offset: int, reader: ByteReader, length: int,
+    sha: Optional['hashlib._Hash']=None,
+    progress: Optional[Callable[[int], None]]=None,
+    guard: Optional[ChunkWriteGuard]=None, position: int=0,
+) -> bool:
+    """
+    Read length bytes off reader and write them to the incomplete file at
+    offset, updating sha with them.  Stops writing once chunk position is
+    taken over through guard
+
+    :return: False if the file was already complete or the chunk was taken \
+            over, so not everything was written
+    """
+    cache = get_file_handle_cache()
+    handle = None  # type: Optional[OpenFile]
+    error = None  # type: Optional[OSError]
+    skipped = False
+    try:
+        handle = await cache.acquire(filepath)
+        if handle.complete:
+            logger.info("file %s already done, not writing", filepath)
+            skipped = True
+            cache.release(handle)
+            handle = None
+    except OSError as e:
+        error = e
+
+    remaining = length
+    try:
+        while remaining:
+            block = await reader.read(min(remaining, STREAM_BLOCK_SIZE))
+            if not block:
+                raise asyncio.IncompleteReadError(b'', remaining)
+            remaining -= len(block)
+            if handle is None:
+                continue
+            try:
+                if guard is None:
+                    await _run_to_end(
+                        _write_and_hash, handle.fd, block, offset, sha,
+                    )
+                else:
+                    async with guard.lock:
+                        skipped = position in guard.taken
+                        if not skipped:
+                            await _run_to_end(
+                                _write_and_hash, handle.fd, block, offset,
+                                sha,
+                            )
+            except OSError as e:
+                error = e
+                cache.release(handle)
+                handle = None
+                continue
+            if skipped:
+                cache.release(handle)
+                handle = None
+                continue
+            offset += len(block)
+            if progress is not None:
+                progress(length - remaining)
+    finally:
+        if handle is not None:
+            cache.release(handle)
+
+    if error is not None:
+        raise error
+    return not skipped
+
+
+async def _run_to_end(func: Callable[..., R], *args: Any) -> R:
+    """Run func in the executor.  If cancelled, waits for it to finish before
+    passing the cancellation on, so nothing is read or written once this
+    returns (or a ChunkWriteGuard's lock is released), and the descriptor it
+    used can be closed"""
+    running = asyncio.get_event_loop().run_in_executor(None, func, *args)
+    try:
+        return await asyncio.shield(running)
+    except asyncio.CancelledError:
+        await asyncio.wait([running])
+        raise
 
-    await write_locks[filepath].acquire()
-    async with aiofiles.open(filepath, 'r+b') as f:
-        pos_bytes = position * chunk_size
-        await f.seek(pos_bytes)
-        await f.write(contents)
-        await f.flush()
-    write_locks[filepath].release()
+
+def _write_all(fd: int, data: Union[bytes, memoryview], offset: int) -> None:
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _write_and_hash(
+    fd: int, block: bytes, offset: int, sha: Optional['hashlib._Hash'],
+) -> None:
+    _write_all(fd, block, offset)
+    if sha is not None:
+        sha.update(block)
 
 
 async def read_chunk(
     filepath: str, position: int, file_hash: Optional[bytes]=None,
     chunk_size: int=DEFAULT_CHUNK_SIZE,
-) -> Tuple[bytes, bytes]:
+) -> Tuple[memoryview, bytes]:
     """Reads a chunk for a file, returning the contents and its hash.  May
     raise relevant IO exceptions
 
-    If file_hash is provided, will check the chunk that is read
+    If file_hash is provided, will check the chunk that is read.  If the file
+    is memory mapped, the contents are a view of the mapping, so they are
+    hashed without being copied
 
     :param filepath: the path of the file to read from
     :param position: where to read from
@@ -114,17 +608,12 @@ async def read_chunk(
     :param chunk_size: (optional) override the chunk size
     :raises crypto_util.VerificationException: If the hash of the bytes read \
             does not match the provided hash
-    :return: a double of (contents, hash), both bytes
+    :return: a double of (contents, hash)
     """
-    if not is_complete(filepath):
-        logger.debug("file %s not done, adding extention", filepath)
-        filepath += DEFAULT_INCOMPLETE_EXT
-
-    async with aiofiles.open(filepath, 'rb') as f:
-        logger.debug("async reading %s", filepath)
-        pos_bytes = position * chunk_size
-        await f.seek(pos_bytes)
-        data = await f.read(chunk_size)
+    logger.debug("async reading %s", filepath)
+    data = await get_file_handle_cache().view(
+        filepath, position * chunk_size, chunk_size,
+    )
 
     h = await crypto_util.hash(data)
     logger.debug("async read hash: %s", crypto_util.b64encode(h))
@@ -135,6 +624,47 @@ async def read_chunk(
     return (data, h)
 
 
+async def read_chunk_bytes(
+    filepath: str, position: int, chunk_size: int=DEFAULT_CHUNK_SIZE,
+) -> bytes:
+    """Reads a chunk for a file without hashing it, for when nothing is going
+    to check the hash.  May raise relevant IO exceptions
+
+    :param filepath: the path of the file to read from
+    :param position: where to read from
+    :param chunk_size: (optional) override the chunk size
+    :return: the contents of the chunk
+    """
+    logger.debug("async reading %s", filepath)
+    return await get_file_handle_cache().read(
+        filepath, position * chunk_size, chunk_size,
+    )
+
+
+async def open_chunk(
+    filepath: str, position: int, chunk_size: int=DEFAULT_CHUNK_SIZE,
+) -> Tuple[BinaryIO, int, int]:
+    """Open the file a chunk is in, for sending it without reading it into
+    memory (ie, with sendfile).  The caller must close the file.  May raise
+    relevant IO exceptions
+
+    :param filepath: the path of the file the chunk is in
+    :param position: the chunk index
+    :param chunk_size: (optional) override the chunk size
+    :return: a triple of (open file, chunk offset, chunk length)
+    """
+    if not is_complete(filepath):
+        logger.debug("file %s not done, adding extention", filepath)
+        filepath += DEFAULT_INCOMPLETE_EXT
+
+    loop = asyncio.get_event_loop()
+    f = await loop.run_in_executor(None, open, filepath, 'rb')
+    offset = position * chunk_size
+    size = os.fstat(f.fileno()).st_size
+    length = max(0, min(chunk_size, size - offset))
+    return (f, offset, length)
+
+
 async def create_file(
     filepath: str, size_bytes: int,
 ) -> None:
@@ -142,12 +672,15 @@ async def create_file(
     exceptions
 
     If filepath exists, calling this indicates there are updates, and filepath
-    gets moved to filepath + incomplete_ext
+    gets moved to filepath + incomplete_ext.  An incomplete file that already
+    exists keeps its contents, so the chunks in it that are already
+    downloaded aren't lost, and is only resized
 
     :param filepath: where to create the file
     :param size: the size to allocate
     :return: None
     """
+    get_file_handle_cache().invalidate(filepath)
     new_path = filepath + DEFAULT_INCOMPLETE_EXT
     try:
         if is_complete(filepath):
@@ -160,7 +693,8 @@ async def create_file(
     dirname = os.path.dirname(filepath)
     if not os.path.exists(dirname):
         os.makedirs(dirname, exist_ok=True)
-    async with aiofiles.open(filepath, 'wb') as f:
+    mode = 'r+b' if os.path.exists(filepath) else 'wb'
+    async with aiofiles.open(filepath, mode) as f:
         logger.debug("truncating %s ot %s bytes", filepath, size_bytes)
         await f.truncate(size_bytes)
 
@@ -181,6 +715,7 @@ def mark_file_complete(filepath: str) -> None:
 
     old_file = filepath + DEFAULT_INCOMPLETE_EXT
     os.rename(old_file, filepath)
+    get_file_handle_cache().invalidate(filepath)
 
 
 def is_complete(filepath: str) -> bool:
@@ -0,0 +1,200 @@
+"""A persistent cache of file hashes, so files that haven't changed aren't
+hashed again"""
+import hashlib
+import os
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+import bencode  # type: ignore
+
+from syncr_backend.constants import DEFAULT_CHUNK_SIZE
+from syncr_backend.constants import DEFAULT_HASH_CACHE_FILE
+from syncr_backend.init import node_init
+from syncr_backend.util.fileio_util import AtomicFile
+from syncr_backend.util.log_util import get_logger
+
+
+logger = get_logger(__name__)
+
+_HASH_SIZE = hashlib.sha256().digest_size
+
+
+def stat_signature(stat: os.stat_result) -> Tuple[int, int, int]:
+    """What a file's hashes are cached under, along with its path.  The file
+    is assumed to have changed if any of it changes
+
+    :param stat: The file's stat
+    :return: A tuple of its inode, size and modification time in ns
+    """
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class HashCacheEntry(NamedTuple):
+    """The hashes of a file, and the `stat_signature` it had when hashed"""
+    signature: Tuple[int, int, int]
+    chunk_size: int
+    hashes: List[bytes]
+    file_id: bytes
+
+
+class HashCache(object):
+    """The chunk hashes and file ids of files that were hashed, keyed by
+    their absolute path and `stat_signature`, and saved to disk so they are
+    kept across restarts
+
+    :param path: Where to save the cache, otherwise DEFAULT_HASH_CACHE_FILE \
+            in the init dir
+    """
+
+    def __init__(self, path: Optional[str]=None) -> None:
+        if path is None:
+            path = os.path.join(
+                node_init.get_full_init_directory(), DEFAULT_HASH_CACHE_FILE,
+            )
+        self.path = path
+        self._file = AtomicFile(path)
+        self._entries = {}  # type: Dict[str, HashCacheEntry]
+        self._loaded = False
+        self._dirty = False
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def load(self) -> None:
+        """Read the cache saved on disk, if there is one and it hasn't been
+        read yet"""
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            data = await self._file.read()
+        except OSError:
+            return
+        try:
+            entries = {
+                path: _decode_entry(entry)
+                for path, entry in bencode.decode(data).items()
+            }
+        except Exception as e:
+            logger.warning("unreadable hash cache %s: %s", self.path, e)
+            return
+        # files hashed since the cache was made are newer than the saved ones
+        for path, entry in entries.items():
+            self._entries.setdefault(path, entry)
+        logger.info("loaded %d cached file hashes", len(entries))
+
+    async def save(self) -> None:
+        """Write the cache to disk, if it changed since it was last written"""
+        if not self._dirty:
+            return
+        self._dirty = False
+        try:
+            data = bencode.encode({
+                path: _encode_entry(entry)
+                for path, entry in self._entries.items()
+            })
+        except Exception as e:
+            logger.warning("could not encode hash cache: %s", e)
+            return
+        try:
+            await self._file.write(data)
+        except OSError as e:
+            logger.warning("could not save hash cache: %s", e)
+
+    def get(
+        self, path: str, stat: os.stat_result,
+        chunk_size: int=DEFAULT_CHUNK_SIZE,
+    ) -> Optional[Tuple[List[bytes], bytes]]:
+        """
+        :param path: The file
+        :param stat: The file's stat now
+        :param chunk_size: The chunk size it is hashed with
+        :return: A tuple of the chunk hashes and the file id, or None if \
+                they aren't cached or the file has changed since
+        """
+        entry = self._entries.get(os.path.abspath(path))
+        if (
+            entry is None or entry.signature != stat_signature(stat) or
+            entry.chunk_size != chunk_size
+        ):
+            return None
+        return (list(entry.hashes), entry.file_id)
+
+    def put(
+        self, path: str, stat: os.stat_result, hashes: List[bytes],
+        file_id: bytes, chunk_size: int=DEFAULT_CHUNK_SIZE,
+    ) -> None:
+        """Cache a file's hashes.  Call `save` to write them to disk
+
+        :param path: The file
+        :param stat: The file's stat from before it was hashed
+        :param hashes: The chunk hashes
+        :param file_id: The file id
+        :param chunk_size: The chunk size it was hashed with
+        """
+        self._entries[os.path.abspath(path)] = HashCacheEntry(
+            stat_signature(stat), chunk_size, list(hashes), file_id,
+        )
+        self._dirty = True
+
+    def prune(self, directory: str, keep: Iterable[str]) -> None:
+        """Forget the files in a directory that aren't in keep, ie because
+        they were deleted
+
+        :param directory: The directory
+        :param keep: Files in it to keep
+        """
+        prefix = os.path.join(os.path.abspath(directory), '')
+        keep = {os.path.abspath(path) for path in keep}
+        for path in list(self._entries):
+            if path.startswith(prefix) and path not in keep:
+                del self._entries[path]
+                self._dirty = True
+
+
+def _to_bytes(b: Union[bytes, str]) -> bytes:
+    # bencode decodes byte strings that happen to be utf-8 to str
+    return b.encode('utf-8') if isinstance(b, str) else b
+
+
+def _encode_entry(entry: HashCacheEntry) -> Dict[str, Any]:
+    return {
+        'stat': list(entry.signature),
+        'chunk_size': entry.chunk_size,
+        'hashes': b''.join(entry.hashes),
+        'file_id': entry.file_id,
+    }
+
+
+def _decode_entry(d: Dict[str, Any]) -> HashCacheEntry:
+    hashes = _to_bytes(d['hashes'])
+    ino, size, mtime = d['stat']
+    return HashCacheEntry(
+        signature=(ino, size, mtime), chunk_size=d['chunk_size'],
+        hashes=[
+            hashes[i:i + _HASH_SIZE]
+            for i in range(0, len(hashes), _HASH_SIZE)
+        ],
+        file_id=_to_bytes(d['file_id']),
+    )
+
+
+_cache_instance = None  # type: Optional[HashCache]
+
+
+def get_hash_cache() -> HashCache:
+    """
+    Get the node's hash cache
+
+    :return: The HashCache
+    """
+    global _cache_instance
+    if _cache_instance is None:
+        _cache_instance = HashCache()
+    return _cache_instance
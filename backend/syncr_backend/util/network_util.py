@@ -1,34 +1,334 @@
 """Helper functions for communicating with other peers"""
 import asyncio
 import socket
+import struct
 from socket import SHUT_WR
 from typing import Any
+from typing import Awaitable
+from typing import BinaryIO
+from typing import Callable
 from typing import Dict
+from typing import Optional
+from typing import Union
 
 import bencode  # type: ignore
 
+from syncr_backend.constants import BANDWIDTH_QUANTUM
+from syncr_backend.constants import ERR_BUSY
 from syncr_backend.constants import ERR_EXCEPTION
 from syncr_backend.constants import ERR_INCOMPAT
+from syncr_backend.constants import ERR_INVINPUT
 from syncr_backend.constants import ERR_NEXIST
+from syncr_backend.constants import MAX_FRAME_SIZE
+from syncr_backend.constants import REQUEST_TYPE_RAW_BLOCK
+from syncr_backend.constants import REQUEST_TYPE_RAW_CHUNK
+from syncr_backend.constants import REQUEST_TYPE_RAW_CHUNK_RANGE
+from syncr_backend.constants import STREAM_BLOCK_SIZE
 from syncr_backend.util.log_util import get_logger
 
 
 logger = get_logger(__name__)
 
+#: Header of a length framed message: a 4 byte big endian payload length
+FRAME_HEADER = struct.Struct('!I')
+
+
+class FramedWriter(object):
+    """Wraps the StreamWriter of a framed connection, so responses are sent as
+    a single frame and the connection is left open for the next request"""
+
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.writer = writer
+
+    async def write_frame(self, payload: bytes) -> None:
+        """Write a frame and wait for it to be flushed
+
+        :param payload: The bytes to frame and send
+        """
+        self.writer.write(encode_frame(payload))
+        await self.writer.drain()
+
+
+#: Anything a request handler can send a response to
+ResponseWriter = Union[asyncio.StreamWriter, FramedWriter]
+
+#: Called with a number of bytes before they are sent, to limit the send rate
+Throttle = Callable[[int], Awaitable[None]]
+
+
+def encode_frame(payload: bytes) -> bytes:
+    """Prefix a payload with its length
+
+    >>> from syncr_backend.util.network_util import encode_frame
+    >>> encode_frame(b'de')
+    b'\\x00\\x00\\x00\\x02de'
+
+    :param payload: The bytes to frame
+    :return: The framed bytes
+    """
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class ResponseStream(object):
+    """Reads one response off a framed connection, keeping track of how much
+    of it has been read, so that whatever is left can be skipped if the
+    request is cancelled part way through.
+
+    Responses are a frame, except for raw requests: REQUEST_TYPE_RAW_CHUNK
+    and REQUEST_TYPE_RAW_BLOCK responses are a header frame followed by
+    ``length`` raw bytes if the status is ok, and REQUEST_TYPE_RAW_CHUNK_RANGE
+    responses are a header frame followed by ``response`` of those if the
+    status is ok
+
+    :param reader: The StreamReader of the connection
+    :param request_type: The type of the request being answered
+    :param stall_timeout: Seconds a read may wait with nothing arriving, or \
+    None to wait as long as it takes
+    """
+
+    def __init__(
+        self, reader: asyncio.StreamReader, request_type: Optional[int]=None,
+        stall_timeout: Optional[float]=None,
+    ) -> None:
+        self._reader = reader
+        self._stall_timeout = stall_timeout
+        if request_type == REQUEST_TYPE_RAW_CHUNK_RANGE:
+            self._kind = 'range'
+        elif request_type in (REQUEST_TYPE_RAW_CHUNK, REQUEST_TYPE_RAW_BLOCK):
+            self._kind = 'raw'
+        else:
+            self._kind = 'frame'
+        #: Set once the whole response has been read
+        self.done = False
+        # what is being read ('size', 'frame' or 'raw'), how many more bytes
+        # of it are needed, and the bytes of a header being read
+        self._state = 'size'
+        self._need = FRAME_HEADER.size
+        self._buffer = bytearray()
+        # responses left in a range, once its header has been read
+        self._ranged = None  # type: Optional[int]
+
+    async def read(self, n: int=-1) -> bytes:
+        """Read up to n bytes, like StreamReader.read
+
+        :param n: Most bytes to read
+        :raises PeerTimeoutException: If nothing arrives for stall_timeout \
+        seconds
+        :return: The bytes read, empty at EOF
+        """
+        if self._stall_timeout is None:
+            data = await self._reader.read(n)
+        else:
+            try:
+                data = await asyncio.wait_for(
+                    self._reader.read(n), self._stall_timeout,
+                )
+            except asyncio.TimeoutError as e:
+                raise PeerTimeoutException() from e
+        self._feed(data)
+        return data
+
+    async def readexactly(self, n: int) -> bytes:
+        """Read exactly n bytes, like StreamReader.readexactly
+
+        :param n: How many bytes to read
+        :raises asyncio.IncompleteReadError: If the stream ends first
+        :return: The bytes read
+        """
+        data = b''
+        while len(data) < n:
+            block = await self.read(n - len(data))
+            if not block:
+                raise asyncio.IncompleteReadError(data, n)
+            data += block
+        return data
+
+    async def skip(self) -> None:
+        """Read and throw away the rest of the response
+
+        :raises asyncio.IncompleteReadError: If the stream ends first
+        """
+        while not self.done:
+            block = await self.read(min(self._need, STREAM_BLOCK_SIZE))
+            if not block:
+                raise asyncio.IncompleteReadError(b'', self._need)
+
+    def _feed(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view and not self.done:
+            n = min(len(view), self._need)
+            # only headers need to be looked at
+            if self._state == 'size' or (
+                self._state == 'frame' and self._kind != 'frame'
+            ):
+                self._buffer += view[:n]
+            view = view[n:]
+            self._need -= n
+            while not self._need and not self.done:
+                self._advance()
+
+    def _advance(self) -> None:
+        if self._state == 'size':
+            (self._need,) = FRAME_HEADER.unpack(bytes(self._buffer))
+            self._buffer.clear()
+            self._state = 'frame'
+        elif self._state == 'frame':
+            if self._kind == 'frame':
+                self.done = True
+                return
+            header = bencode.decode(bytes(self._buffer))
+            self._buffer.clear()
+            ok = header.get('status') == 'ok'
+            if self._kind == 'range' and self._ranged is None:
+                self._ranged = header['response'] if ok else 0
+                self._next_response()
+            elif ok and header.get('length'):
+                self._state = 'raw'
+                self._need = header['length']
+            else:
+                self._next_response()
+        else:
+            self._next_response()
+
+    def _next_response(self) -> None:
+        if not self._ranged:
+            self.done = True
+            return
+        self._ranged -= 1
+        self._state = 'size'
+        self._need = FRAME_HEADER.size
+
+
+#: Something frames can be read from
+FrameReader = Union[asyncio.StreamReader, ResponseStream]
+
+
+async def read_frame(reader: FrameReader) -> bytes:
+    """Read one length framed message from reader
+
+    :param reader: The StreamReader to read from
+    :raises asyncio.IncompleteReadError: If the stream ends mid frame
+    :raises ConnectionClosedException: If the frame is larger than \
+            MAX_FRAME_SIZE
+    :return: The payload of the frame
+    """
+    header = await reader.readexactly(FRAME_HEADER.size)
+    (length,) = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ConnectionClosedException(
+            "frame of %s bytes is too large" % length,
+        )
+    return await reader.readexactly(length)
+
 
 async def send_response(
-    writer: asyncio.StreamWriter, response: Dict[Any, Any],
+    writer: ResponseWriter, response: Dict[Any, Any],
+    throttle: Optional[Throttle]=None,
 ) -> None:
     """
-    Sends a response to a connection and then closes writing to that connection
+    Sends a response to a connection and then closes writing to that
+    connection.  Responses on framed connections are sent as one frame and the
+    connection stays open
 
-    :param writer: StreamWriter to write to
+    :param writer: StreamWriter or FramedWriter to write to
     :param response: Dict[Any, Any] response
+    :param throttle: if given, the response is sent BANDWIDTH_QUANTUM bytes \
+            at a time, awaiting throttle before each
+    :return: None
+    """
+    if isinstance(writer, FramedWriter):
+        if throttle is None:
+            await writer.write_frame(bencode.encode(response))
+            return
+        stream = writer.writer
+        data = encode_frame(bencode.encode(response))
+    else:
+        stream = writer
+        data = bencode.encode(response)
+    if throttle is None:
+        stream.write(data)
+    else:
+        view = memoryview(data)
+        for start in range(0, len(data), BANDWIDTH_QUANTUM):
+            piece = view[start:start + BANDWIDTH_QUANTUM]
+            await throttle(len(piece))
+            stream.write(piece)
+            await stream.drain()
+    if not isinstance(writer, FramedWriter):
+        stream.write_eof()
+    await stream.drain()
+
+
+async def send_raw_response(
+    writer: FramedWriter, payload: bytes, throttle: Optional[Throttle]=None,
+) -> None:
+    """
+    Sends an ok header frame with the length of payload, followed by the
+    unframed payload itself
+
+    :param writer: FramedWriter to write to
+    :param payload: the raw bytes to send
+    :param throttle: if given, the payload is sent BANDWIDTH_QUANTUM bytes \
+            at a time, awaiting throttle before each
+    :return: None
+    """
+    header = {'status': 'ok', 'length': len(payload)}
+    writer.writer.write(encode_frame(bencode.encode(header)))
+    if throttle is None:
+        writer.writer.write(payload)
+        await writer.writer.drain()
+        return
+    await writer.writer.drain()
+    view = memoryview(payload)
+    for start in range(0, len(payload), BANDWIDTH_QUANTUM):
+        piece = view[start:start + BANDWIDTH_QUANTUM]
+        await throttle(len(piece))
+        writer.writer.write(piece)
+        await writer.writer.drain()
+
+
+async def send_raw_file_response(
+    writer: FramedWriter, f: BinaryIO, offset: int, length: int,
+    throttle: Optional[Throttle]=None,
+) -> None:
+    """
+    Like send_raw_response, but the payload is length bytes of f starting at
+    offset, sent with ``loop.sendfile`` so it never passes through Python.
+    Requires Python 3.7 or later.
+
+    If f turns out to have fewer than length bytes, the connection is closed,
+    since the other end would otherwise read the next response as part of
+    this one
+
+    :param writer: FramedWriter to write to
+    :param f: a file open in binary mode
+    :param offset: where in f the payload starts
+    :param length: how many bytes to send
+    :param throttle: if given, the payload is sent BANDWIDTH_QUANTUM bytes \
+            at a time, awaiting throttle before each
     :return: None
     """
-    writer.write(bencode.encode(response))
-    writer.write_eof()
-    await writer.drain()
+    header = {'status': 'ok', 'length': length}
+    writer.writer.write(encode_frame(bencode.encode(header)))
+    await writer.writer.drain()
+    if not length:
+        return
+    loop = asyncio.get_event_loop()
+    step = length if throttle is None else BANDWIDTH_QUANTUM
+    sent = 0
+    while sent < length:
+        count = min(step, length - sent)
+        if throttle is not None:
+            await throttle(count)
+        piece = await loop.sendfile(  # type: ignore
+            writer.writer.transport, f, offset + sent, count,
+        )
+        sent += piece
+        if piece != count:
+            break
+    if sent != length:
+        logger.error("only sent %s of %s bytes, closing", sent, length)
+        writer.writer.close()
 
 
 def sync_send_response(conn: socket.socket, response: Dict[Any, Any]) -> None:
@@ -58,16 +358,41 @@ class IncompatibleProtocolVersionException(SyncrNetworkException):
     pass
 
 
+class InvalidInputException(SyncrNetworkException):
+    """Other end could not understand the request"""
+    pass
+
+
 class UnhandledExceptionException(SyncrNetworkException):
     """Other end experienced an unhandled exception"""
     pass
 
 
+class BusyException(SyncrNetworkException):
+    """Other end has no upload slots free"""
+    pass
+
+
+class PeerTimeoutException(SyncrNetworkException):
+    """Other end did not connect or respond in time"""
+    pass
+
+
 class NoPeersException(SyncrNetworkException):
     """No peers found or provided to a request function"""
     pass
 
 
+class ConnectionClosedException(SyncrNetworkException):
+    """The connection to a peer was closed or broken mid request"""
+    pass
+
+
+class FramingNotSupportedException(SyncrNetworkException):
+    """The peer only supports one-shot requests"""
+    pass
+
+
 def raise_network_error(
     errno: int,
 ) -> None:
@@ -76,7 +401,9 @@ def raise_network_error(
     exceptionmap = {
         ERR_NEXIST: NotExistException,
         ERR_INCOMPAT: IncompatibleProtocolVersionException,
+        ERR_INVINPUT: InvalidInputException,
         ERR_EXCEPTION: UnhandledExceptionException,
+        ERR_BUSY: BusyException,
     }
     raise exceptionmap[errno]
 
@@ -0,0 +1,269 @@
+"""A persistent table of drops waiting to be synced"""
+import asyncio
+import os
+import random
+import time
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+
+import bencode  # type: ignore
+
+from syncr_backend.constants import DEFAULT_SYNC_JOBS_FILE
+from syncr_backend.constants import SYNC_PRIORITY_BACKGROUND
+from syncr_backend.constants import SYNC_RETRY_BASE_DELAY
+from syncr_backend.constants import SYNC_RETRY_JITTER
+from syncr_backend.constants import SYNC_RETRY_MAX_DELAY
+from syncr_backend.init import node_init
+from syncr_backend.metadata.drop_metadata import DropVersion
+from syncr_backend.util import crypto_util
+from syncr_backend.util.fileio_util import AtomicFile
+from syncr_backend.util.log_util import get_logger
+
+
+logger = get_logger(__name__)
+
+
+def retry_delay(attempts: int) -> float:
+    """How long to wait before retrying a sync.  Doubles with each attempt,
+    up to SYNC_RETRY_MAX_DELAY, with SYNC_RETRY_JITTER of it random
+
+    :param attempts: How many times the sync has been tried
+    :return: Seconds to wait
+    """
+    delay = min(
+        SYNC_RETRY_MAX_DELAY, SYNC_RETRY_BASE_DELAY * 2 ** (attempts - 1),
+    )
+    return delay * random.uniform(1 - SYNC_RETRY_JITTER, 1)
+
+
+class SyncJob(object):
+    """A drop waiting to be synced
+
+    :param drop_id: The drop to sync
+    :param save_dir: Where the drop is saved
+    :param version: The version to sync, otherwise the one on disk or the \
+            newest one
+    :param priority: Lower priorities run first
+    :param attempts: How many times the sync has been tried
+    :param next_run: When to run it next, in seconds since the epoch
+    """
+
+    def __init__(
+        self, drop_id: bytes, save_dir: str,
+        version: Optional[DropVersion]=None,
+        priority: int=SYNC_PRIORITY_BACKGROUND, attempts: int=0,
+        next_run: float=0,
+    ) -> None:
+        self.drop_id = drop_id
+        self.save_dir = save_dir
+        self.version = version
+        self.priority = priority
+        self.attempts = attempts
+        self.next_run = next_run
+        #: Bumped whenever the job is changed, to tell if it was changed
+        #: while it ran
+        self.revision = 0
+
+    def encode(self) -> Dict[str, Any]:
+        """Make a bencodable dict of this job
+
+        :return: A dict, for `decode`
+        """
+        d = {
+            'save_dir': self.save_dir,
+            'priority': self.priority,
+            'attempts': self.attempts,
+            # bencode has no floats
+            'next_run': int(self.next_run),
+        }  # type: Dict[str, Any]
+        if self.version is not None:
+            d['version'] = dict(self.version)
+        return d
+
+    @staticmethod
+    def decode(drop_id: bytes, d: Dict[str, Any]) -> 'SyncJob':
+        """Make a job from a dict made by `encode`
+
+        :param drop_id: The drop to sync
+        :param d: The dict
+        :return: A SyncJob
+        """
+        version = None
+        if 'version' in d:
+            version = DropVersion(**d['version'])
+        return SyncJob(
+            drop_id=drop_id, save_dir=d['save_dir'], version=version,
+            priority=d['priority'], attempts=d['attempts'],
+            next_run=d['next_run'],
+        )
+
+
+class SyncJobTable(object):
+    """The drops waiting to be synced, at most one job per drop, saved to
+    disk whenever it changes so they are picked up again after a restart
+
+    :param path: Where to save the table, otherwise DEFAULT_SYNC_JOBS_FILE \
+            in the init dir
+    """
+
+    def __init__(self, path: Optional[str]=None) -> None:
+        if path is None:
+            path = os.path.join(
+                node_init.get_full_init_directory(), DEFAULT_SYNC_JOBS_FILE,
+            )
+        self.path = path
+        self._file = AtomicFile(path)
+        self._jobs = {}  # type: Dict[bytes, SyncJob]
+        #: Set whenever a job is added
+        self.changed = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def get(self, drop_id: bytes) -> Optional[SyncJob]:
+        """
+        :param drop_id: The drop
+        :return: The drop's job, or None if there isn't one
+        """
+        return self._jobs.get(drop_id)
+
+    async def load(self) -> None:
+        """Read the table saved on disk, if there is one"""
+        try:
+            data = await self._file.read()
+        except OSError:
+            return
+        try:
+            jobs = {}  # type: Dict[bytes, SyncJob]
+            for encoded_id, job in bencode.decode(data).items():
+                drop_id = crypto_util.b64decode(encoded_id.encode('utf-8'))
+                jobs[drop_id] = SyncJob.decode(drop_id, job)
+        except Exception as e:
+            logger.warning("unreadable sync job table %s: %s", self.path, e)
+            return
+        # jobs added since the table was made are newer than the saved ones
+        for drop_id, job in jobs.items():
+            self._jobs.setdefault(drop_id, job)
+        logger.info("loaded %d sync jobs", len(jobs))
+        self.changed.set()
+
+    async def save(self) -> None:
+        """Write the table to disk"""
+        jobs = {
+            crypto_util.b64encode(drop_id).decode('utf-8'): job.encode()
+            for drop_id, job in self._jobs.items()
+        }
+        try:
+            await self._file.write(bencode.encode(jobs))
+        except OSError as e:
+            logger.warning("could not save sync job table: %s", e)
+
+    async def add(
+        self, drop_id: bytes, save_dir: str,
+        version: Optional[DropVersion]=None,
+        priority: int=SYNC_PRIORITY_BACKGROUND,
+    ) -> SyncJob:
+        """Add a job to sync a drop, to run now.  If the drop already has one,
+        it is run now instead, with the newer version and the lower priority.
+        A version of None syncs the newest one
+
+        :param drop_id: The drop to sync
+        :param save_dir: Where the drop is saved
+        :param version: The version to sync
+        :param priority: Lower priorities run first
+        :return: The drop's job
+        """
+        job = self._jobs.get(drop_id)
+        if job is None:
+            job = SyncJob(drop_id, save_dir, version, priority)
+            self._jobs[drop_id] = job
+        else:
+            job.save_dir = save_dir
+            # None means the newest version, which beats any other
+            if version is None or job.version is None:
+                job.version = None
+            elif job.version < version:
+                job.version = version
+            job.priority = min(job.priority, priority)
+            job.attempts = 0
+        job.next_run = time.time()
+        job.revision += 1
+        await self.save()
+        self.changed.set()
+        return job
+
+    def next_job(self, running: Iterable[bytes]=()) -> Optional[SyncJob]:
+        """The job to run next, by priority then by when it was due
+
+        :param running: Drops that are already being synced
+        :return: A job that is due, or None if none are
+        """
+        now = time.time()
+        running = set(running)
+        due = [
+            job for job in self._jobs.values()
+            if job.next_run <= now and job.drop_id not in running
+        ]
+        if not due:
+            return None
+        return min(due, key=lambda job: (job.priority, job.next_run))
+
+    def next_run_delay(self, running: Iterable[bytes]=()) -> Optional[float]:
+        """
+        :param running: Drops that are already being synced
+        :return: Seconds until a job is due, or None if there are none
+        """
+        running = set(running)
+        next_runs = [
+            job.next_run for job in self._jobs.values()
+            if job.drop_id not in running
+        ]
+        if not next_runs:
+            return None
+        return max(0, min(next_runs) - time.time())
+
+    async def finish(self, job: SyncJob, revision: int) -> None:
+        """Remove a job that finished, unless it was changed while it ran
+
+        :param job: The job
+        :param revision: The job's revision when it started
+        """
+        if job.revision != revision or self._jobs.get(job.drop_id) is not job:
+            return
+        del self._jobs[job.drop_id]
+        await self.save()
+
+    async def retry(self, job: SyncJob, revision: int) -> None:
+        """Put off a job that didn't finish until its next retry, unless it
+        was changed while it ran
+
+        :param job: The job
+        :param revision: The job's revision when it started
+        """
+        if job.revision != revision or self._jobs.get(job.drop_id) is not job:
+            return
+        job.attempts += 1
+        delay = retry_delay(job.attempts)
+        job.next_run = time.time() + delay
+        logger.info(
+            "retrying sync of %s in %.0f seconds",
+            crypto_util.b64encode(job.drop_id), delay,
+        )
+        await self.save()
+
+
+_table_instance = None  # type: Optional[SyncJobTable]
+
+
+def get_sync_job_table() -> SyncJobTable:
+    """
+    Get the node's sync job table
+
+    :return: The SyncJobTable
+    """
+    global _table_instance
+    if _table_instance is None:
+        _table_instance = SyncJobTable()
+    return _table_instance
@@ -0,0 +1,67 @@
+import asyncio
+from typing import Awaitable
+from typing import List  # noqa
+from typing import TypeVar
+
+import pytest  # type: ignore
+
+from syncr_backend.util.async_util import WorkerPool
+
+
+R = TypeVar('R')
+
+
+def run_coro(f: Awaitable[R]) -> R:
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(f)
+
+
+def test_worker_pool_limit() -> None:
+    pool = WorkerPool(2)
+    most_running = 0
+
+    async def work(n: int) -> int:
+        nonlocal most_running
+        most_running = max(most_running, pool.running)
+        await asyncio.sleep(0.01)
+        if n == 3:
+            raise ValueError(n)
+        return n
+
+    results = run_coro(pool.gather([work(n) for n in range(6)]))
+
+    assert results[:3] == [0, 1, 2] and results[4:] == [4, 5]
+    assert isinstance(results[3], ValueError)
+    assert most_running == 2
+    stats = pool.stats()
+    # nothing is kept once it's done
+    assert (stats.queued, stats.running, stats.completed) == (0, 0, 6)
+    assert stats.wait_time > 0 and stats.run_time > 0
+
+
+def test_worker_pool_cancel() -> None:
+    pool = WorkerPool(1)
+    started = []  # type: List[int]
+
+    async def work(n: int) -> None:
+        started.append(n)
+        await asyncio.sleep(1)
+
+    async def run_all() -> None:
+        first = pool.submit(work(0))
+        second = pool.submit(work(1))
+        third = pool.submit(work(2))
+        await asyncio.sleep(0)
+        # cancelling the result cancels the running task, and a cancelled
+        # one that hasn't started never does
+        second.cancel()
+        first.cancel()
+        await asyncio.sleep(0.01)
+        assert pool.running == 1 and pool.queued == 0
+        pool.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await third
+
+    run_coro(run_all())
+    assert started == [0, 2]
+    assert pool.running == 0
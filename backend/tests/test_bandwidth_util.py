@@ -0,0 +1,93 @@
+import asyncio
+from typing import Awaitable
+from typing import List  # noqa
+from typing import TypeVar
+from unittest import mock
+
+from syncr_backend.constants import BANDWIDTH_QUANTUM
+from syncr_backend.util.bandwidth_util import BandwidthShaper
+from syncr_backend.util.bandwidth_util import DOWNLOAD
+from syncr_backend.util.bandwidth_util import ShapedReader
+from syncr_backend.util.bandwidth_util import TokenBucket
+from syncr_backend.util.bandwidth_util import UPLOAD
+
+
+R = TypeVar('R')
+
+
+def run_coro(f: Awaitable[R]) -> R:
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(f)
+
+
+def test_token_bucket_rate() -> None:
+    rate = BANDWIDTH_QUANTUM * 20
+    bucket = TokenBucket(rate)
+
+    async def take_all() -> float:
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        # the first quantum is the burst, the other four are paid for
+        for _ in range(5):
+            await bucket.take(BANDWIDTH_QUANTUM)
+        return loop.time() - start
+
+    assert 0.15 < run_coro(take_all()) < 0.5
+
+    unlimited = TokenBucket()
+    run_coro(unlimited.take(10 * 2**30))
+
+
+def test_bandwidth_shaper_limits() -> None:
+    shaper = BandwidthShaper()
+    assert not shaper.is_limited(UPLOAD)
+
+    shaper.set_limit(UPLOAD, 1000, b'drop')
+    assert shaper.is_limited(UPLOAD, b'drop')
+    assert not shaper.is_limited(UPLOAD, b'other')
+    assert not shaper.is_limited(DOWNLOAD, b'drop')
+
+    shaper.set_limit(DOWNLOAD, 2000)
+    assert shaper.is_limited(DOWNLOAD, b'other')
+    assert shaper.get_limits() == {
+        UPLOAD: {'ZHJvcA==': 1000},
+        DOWNLOAD: {'global': 2000},
+    }
+
+    shaper.set_limit(UPLOAD, 0, b'drop')
+    shaper.set_limit(DOWNLOAD, 0)
+    assert shaper.get_limits() == {UPLOAD: {}, DOWNLOAD: {}}
+
+
+def test_bandwidth_shaper_take_quanta() -> None:
+    shaper = BandwidthShaper()
+    shaper.set_limit(UPLOAD, 10 * 2**30)
+    taken = []  # type: List[int]
+
+    async def take(n: int) -> None:
+        taken.append(n)
+
+    with mock.patch.object(shaper._global[UPLOAD], 'take', take):
+        run_coro(shaper.take(UPLOAD, 2 * BANDWIDTH_QUANTUM + 10))
+
+    assert taken == [BANDWIDTH_QUANTUM, BANDWIDTH_QUANTUM, 10]
+
+
+def test_shaped_reader() -> None:
+    shaper = BandwidthShaper()
+    shaper.set_limit(DOWNLOAD, 10 * 2**30)
+    reader = asyncio.StreamReader()
+    reader.feed_data(b'x' * (BANDWIDTH_QUANTUM + 10))
+    reader.feed_eof()
+
+    shaped = shaper.reader(reader)
+    assert isinstance(shaped, ShapedReader)
+
+    async def read_all() -> bytes:
+        data = await shaped.read(2 * BANDWIDTH_QUANTUM)
+        assert len(data) == BANDWIDTH_QUANTUM
+        return data + await shaped.read(2 * BANDWIDTH_QUANTUM)
+
+    assert len(run_coro(read_all())) == BANDWIDTH_QUANTUM + 10
+    assert run_coro(shaped.read(10)) == b''
+    assert BandwidthShaper().reader(reader) is reader
@@ -0,0 +1,51 @@
+from syncr_backend.util.bitmap_util import ChunkAvailability
+from syncr_backend.util.bitmap_util import ChunkBitmap
+
+
+def test_chunk_bitmap_set_ops() -> None:
+    a = ChunkBitmap([1, 3, 5, 100])
+    b = ChunkBitmap([3, 4, 100])
+
+    assert a & b == {3, 100}
+    assert a | b == {1, 3, 4, 5, 100}
+    assert a - b == {1, 5}
+    assert a ^ b == {1, 4, 5}
+    assert a - {1, 2} == {3, 5, 100}
+    assert {1, 2} - a == {2}
+    assert len(a) == 4
+    assert list(a) == [1, 3, 5, 100]
+    assert a.first(2) == {1, 3}
+
+    c = a.copy()
+    c.remove(100)
+    c -= b
+    assert c == {1, 5}
+    assert a == {1, 3, 5, 100}
+    assert not ChunkBitmap()
+    assert ChunkBitmap.full(3) == {0, 1, 2}
+
+
+def test_chunk_bitmap_bytes_round_trip() -> None:
+    chunks = ChunkBitmap([0, 7, 8, 1000])
+    assert ChunkBitmap.from_bytes(chunks.to_bytes()) == chunks
+    assert ChunkBitmap().to_bytes() == b''
+    assert ChunkBitmap.from_bytes(b'') == set()
+
+
+def test_chunk_availability_rarest_first() -> None:
+    availability = ChunkAvailability(max_count=2)
+    seed = ChunkBitmap.full(10)
+    availability.add(seed)
+    availability.add(ChunkBitmap([0, 1, 2, 3]))
+    availability.add(ChunkBitmap([2, 3, 4]))
+
+    # 5-9 only the seed has, and 2 and 3 are past max_count so count the
+    # same as 0, 1 and 4
+    assert list(availability.rarest_first(seed)) == [
+        {5, 6, 7, 8, 9}, {0, 1, 2, 3, 4},
+    ]
+    assert availability.pick(seed, 3) == {5, 6, 7}
+    assert availability.pick(seed, 7, start=8) == {8, 9, 5, 6, 7, 0, 1}
+    # chunks no peer has come last
+    assert availability.pick(ChunkBitmap([3, 11]), 1) == {3}
+    assert ChunkAvailability().pick(seed, 2, start=9) == {9, 0}
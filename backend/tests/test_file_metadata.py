@@ -1,5 +1,20 @@
+import asyncio
+import hashlib
+import os
+from typing import Any
+from typing import List  # noqa
+from typing import Tuple  # noqa
+from unittest import mock
+
+from syncr_backend.constants import DEFAULT_INCOMPLETE_EXT
+from syncr_backend.metadata.file_metadata import _hash_file_contents
+from syncr_backend.metadata.file_metadata import _read_chunk_journal
+from syncr_backend.metadata.file_metadata import _write_chunk_journal
 from syncr_backend.metadata.file_metadata import DEFAULT_CHUNK_SIZE
 from syncr_backend.metadata.file_metadata import FileMetadata
+from syncr_backend.metadata.file_metadata import make_files_metadata
+from syncr_backend.util.bitmap_util import ChunkBitmap
+from syncr_backend.util.hash_cache_util import HashCache
 
 
 def test_file_metadata_decode() -> None:
@@ -20,3 +35,130 @@ def test_file_metadata_encode() -> None:
     f = FileMetadata([b'0123', b'1234'], b'0000', 100, b'foo')
 
     assert f.encode() == i
+
+
+def test_file_metadata_blocks() -> None:
+    f = FileMetadata(
+        [b'0123', b'1234'], b'0000', 25, b'foo', chunk_size=16,
+    )
+    f.block_size = 4
+
+    assert f.chunk_length(1) == 9
+    assert f.needed_blocks(1) == {0, 1, 2}
+
+    f.finish_chunk_prefix(0, 11)
+    assert f.partial_chunks == {0}
+    assert f.needed_blocks(0) == {2, 3}
+
+    f.finish_chunk_prefix(1, 9)
+    f.finish_blocks(0, [2])
+    assert not f.needed_blocks(1)
+    assert f.needed_blocks(0) == {3}
+
+    f.discard_blocks(0)
+    assert f.partial_chunks == {1}
+    assert f.needed_blocks(0) == {0, 1, 2, 3}
+
+
+def test_chunk_journal(tmpdir: Any) -> None:
+    path = str(tmpdir.join('f'))
+    journal_path = str(tmpdir.join('journal', 'f'))
+    with open(path + DEFAULT_INCOMPLETE_EXT, 'wb') as f:
+        f.truncate(10)
+    os.utime(path + DEFAULT_INCOMPLETE_EXT, ns=(10**9, 10**9))
+
+    assert _read_chunk_journal(journal_path, path, 10) is None
+    _write_chunk_journal(journal_path, path, ChunkBitmap([0, 2]))
+    assert _read_chunk_journal(journal_path, path, 10) == ({0, 2}, True)
+    # the wrong length for the file metadata
+    assert _read_chunk_journal(journal_path, path, 11) is None
+
+    # still valid once the file is marked complete
+    os.rename(path + DEFAULT_INCOMPLETE_EXT, path)
+    assert _read_chunk_journal(journal_path, path, 10) == ({0, 2}, True)
+
+    # written to since, so the chunks need checking
+    os.utime(path, ns=(2 * 10**9, 2 * 10**9))
+    assert _read_chunk_journal(journal_path, path, 10) == ({0, 2}, False)
+
+    with open(path, 'ab') as f:
+        f.write(b'x')
+    assert _read_chunk_journal(journal_path, path, 11) is None
+
+
+def test_make_files_metadata(tmpdir: Any) -> None:
+    contents = {
+        'a': os.urandom(DEFAULT_CHUNK_SIZE + 10),
+        'b': b'',
+        'c': b'foo',
+    }
+    names = [str(tmpdir.join(name)) for name in ['c', 'a', 'b']]
+    for name, data in contents.items():
+        tmpdir.join(name).write_binary(data)
+    calls = []  # type: List[Tuple[int, int]]
+
+    files = asyncio.get_event_loop().run_until_complete(make_files_metadata(
+        names, b'drop', workers=2,
+        progress=lambda done, total: calls.append((done, total)),
+    ))
+
+    assert list(files) == names
+    for name in names:
+        data = contents[os.path.basename(name)]
+        metadata = files[name]
+        assert metadata.file_id == hashlib.sha256(data).digest()
+        assert metadata.hashes == [
+            hashlib.sha256(data[i:i + DEFAULT_CHUNK_SIZE]).digest()
+            for i in range(0, len(data), DEFAULT_CHUNK_SIZE)
+        ]
+        assert metadata.file_length == len(data)
+        assert metadata.drop_id == b'drop'
+    total = DEFAULT_CHUNK_SIZE + 13
+    assert calls[-1] == (total, total)
+
+
+def test_make_files_metadata_hash_cache(tmpdir: Any) -> None:
+    names = [str(tmpdir.join(name)) for name in 'abc']
+    for name in names:
+        tmpdir.join(os.path.basename(name)).write_binary(b'foo')
+    # old enough to be cached, except c
+    for name in names[:2]:
+        os.utime(name, (0, 0))
+    cache = HashCache(str(tmpdir.join('hash_cache')))
+    loop = asyncio.get_event_loop()
+
+    loop.run_until_complete(make_files_metadata(
+        names, b'drop', hash_cache=cache,
+    ))
+    assert len(cache) == 2
+    tmpdir.join('b').write_binary(b'barbaz')
+    os.utime(names[1], (0, 0))
+    with mock.patch(
+        'syncr_backend.metadata.file_metadata._hash_file_contents',
+        side_effect=_hash_file_contents,
+    ) as hash_contents:
+        files = loop.run_until_complete(make_files_metadata(
+            names, b'drop', hash_cache=cache,
+        ))
+
+    # only the changed and the uncached file are hashed again
+    assert sorted(c[0][0] for c in hash_contents.call_args_list) == \
+        names[1:]
+    for name, data in zip(names, [b'foo', b'barbaz', b'foo']):
+        assert files[name].file_id == hashlib.sha256(data).digest()
+        assert files[name].hashes == [hashlib.sha256(data).digest()]
+
+
+def test_hash_file_contents(tmpdir: Any) -> None:
+    for length in [0, 9, 10, 25, 30]:
+        data = os.urandom(length)
+        tmpdir.join('f').write_binary(data)
+        # blocks that don't line up with the chunks
+        hashes, file_id = _hash_file_contents(
+            str(tmpdir.join('f')), chunk_size=10, block_size=4,
+        )
+        assert file_id == hashlib.sha256(data).digest()
+        assert hashes == [
+            hashlib.sha256(data[i:i + 10]).digest()
+            for i in range(0, length, 10)
+        ]
@@ -0,0 +1,45 @@
+import asyncio
+import os
+from typing import Any
+from typing import Awaitable
+from typing import TypeVar
+
+from syncr_backend.util.hash_cache_util import HashCache
+
+
+R = TypeVar('R')
+
+
+def run_coro(f: Awaitable[R]) -> R:
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(f)
+
+
+def test_hash_cache(tmpdir: Any) -> None:
+    path = str(tmpdir.join('hash_cache'))
+    drop = tmpdir.mkdir('drop')
+    names = [str(drop.join(name)) for name in 'ab']
+    for name in names:
+        with open(name, 'wb') as f:
+            f.write(b'foo')
+    # hashes that bencode would decode to str
+    hashes = [b'a' * 32, b'\xff' * 32]
+    cache = HashCache(path)
+    run_coro(cache.load())
+    for name in names:
+        cache.put(name, os.stat(name), hashes, b'id')
+    run_coro(cache.save())
+
+    # it's still there after a restart, until the file changes
+    loaded = HashCache(path)
+    run_coro(loaded.load())
+    assert loaded.get(names[0], os.stat(names[0])) == (hashes, b'id')
+    assert loaded.get(names[0], os.stat(names[0]), chunk_size=1) is None
+    with open(names[0], 'ab') as f:
+        f.write(b'bar')
+    assert loaded.get(names[0], os.stat(names[0])) is None
+
+    # deleted files are forgotten
+    loaded.prune(str(drop), names[1:])
+    assert len(loaded) == 1
+    assert loaded.get(names[1], os.stat(names[1])) == (hashes, b'id')
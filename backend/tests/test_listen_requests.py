@@ -0,0 +1,275 @@
+import asyncio
+import hashlib
+import io
+from typing import Any
+from typing import Awaitable
+from typing import Dict
+from typing import List  # noqa
+from typing import Optional
+from typing import Tuple
+from typing import TypeVar
+
+import bencode  # type: ignore
+import pytest  # type: ignore
+
+from syncr_backend.constants import BANDWIDTH_QUANTUM
+from syncr_backend.constants import DEFAULT_INCOMPLETE_EXT
+from syncr_backend.constants import ERR_BUSY
+from syncr_backend.constants import MAX_CHUNKS_PER_RANGE
+from syncr_backend.constants import REQUEST_TYPE_CHUNK
+from syncr_backend.constants import REQUEST_TYPE_RAW_CHUNK
+from syncr_backend.network import listen_requests
+from syncr_backend.network.connection_pool import get_connection_pool
+from syncr_backend.network.send_requests import send_drop_chunk_bitmaps_request
+from syncr_backend.network.send_requests import send_raw_chunk_range_request
+from syncr_backend.network.upload_limiter import UploadLimiter
+from syncr_backend.util import fileio_util
+from syncr_backend.util.bitmap_util import ChunkBitmap
+from syncr_backend.util.network_util import FramedWriter
+from syncr_backend.util.network_util import InvalidInputException
+
+
+R = TypeVar('R')
+
+
+def run_coro(f: Awaitable[R]) -> R:
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(f)
+
+
+class FakeWriter(object):
+
+    def __init__(self) -> None:
+        self.written = []  # type: List[bytes]
+        self.closed = False
+
+    def write(self, data: bytes) -> None:
+        self.written.append(data)
+
+    async def drain(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def get_extra_info(self, name: str) -> Any:
+        return ('peer', 1)
+
+
+def test_raw_chunk_send_error_closes(monkeypatch: Any) -> None:
+    async def find_chunk_file(request: dict) -> Optional[str]:
+        return 'file'
+
+    async def open_chunk(
+        file_path: str, index: int,
+    ) -> Tuple[io.BytesIO, int, int]:
+        return io.BytesIO(b'chunk'), 0, 5
+
+    async def send_raw_file_response(
+        writer: FramedWriter, f: io.BytesIO, offset: int, length: int,
+        throttle: Any=None,
+    ) -> None:
+        await writer.write_frame(bencode.encode(
+            {'status': 'ok', 'length': length},
+        ))
+        raise OSError()
+
+    monkeypatch.setattr(listen_requests, '_find_chunk_file', find_chunk_file)
+    monkeypatch.setattr(listen_requests, 'open_chunk', open_chunk)
+    monkeypatch.setattr(
+        listen_requests, 'send_raw_file_response', send_raw_file_response,
+    )
+    writer = FakeWriter()
+    request = {
+        'protocol_version': 1,
+        'request_type': REQUEST_TYPE_RAW_CHUNK,
+        'drop_id': b'drop',
+        'file_id': b'file',
+        'index': 0,
+    }
+
+    run_coro(listen_requests.request_dispatcher(
+        request, FramedWriter(writer),  # type: ignore
+    ))
+
+    # only the header went out, with no error response after it
+    assert len(writer.written) == 1
+    assert writer.closed
+
+
+def test_framed_upload_busy_at_once(monkeypatch: Any) -> None:
+    limiter = UploadLimiter(slots=0)
+    monkeypatch.setattr(
+        listen_requests, 'get_upload_limiter', lambda: limiter,
+    )
+    writer = FakeWriter()
+    request = {
+        'protocol_version': 1,
+        'request_type': REQUEST_TYPE_RAW_CHUNK,
+        'drop_id': b'drop',
+        'file_id': b'file',
+        'index': 0,
+    }
+
+    # the requests pipelined behind it mustn't wait for a slot
+    run_coro(asyncio.wait_for(listen_requests.request_dispatcher(
+        request, FramedWriter(writer),  # type: ignore
+    ), 0.1))
+
+    assert bencode.decode(writer.written[0][4:]) == {
+        'status': 'error', 'error': ERR_BUSY,
+    }
+    assert not limiter._waiters
+
+
+def test_chunk_upload_throttled(monkeypatch: Any) -> None:
+    taken = []  # type: List[int]
+
+    async def find_chunk_file(request: dict) -> Optional[str]:
+        return 'file'
+
+    async def read_chunk_bytes(file_path: str, index: int) -> bytes:
+        return b'x' * (2 * BANDWIDTH_QUANTUM)
+
+    async def throttle(n: int) -> None:
+        taken.append(n)
+
+    monkeypatch.setattr(listen_requests, '_find_chunk_file', find_chunk_file)
+    monkeypatch.setattr(listen_requests, 'read_chunk_bytes', read_chunk_bytes)
+    monkeypatch.setattr(
+        listen_requests, '_upload_throttle', lambda request: throttle,
+    )
+    writer = FakeWriter()
+    request = {
+        'protocol_version': 1,
+        'request_type': REQUEST_TYPE_CHUNK,
+        'drop_id': b'drop',
+        'file_id': b'file',
+        'index': 0,
+    }
+
+    run_coro(listen_requests.handle_request_chunk(
+        request, FramedWriter(writer),  # type: ignore
+    ))
+
+    # the response is sent a quantum at a time, each taken before it goes
+    assert len(taken) == 3
+    assert max(taken) == BANDWIDTH_QUANTUM
+    assert taken == [len(piece) for piece in writer.written]
+    response = bencode.decode(b''.join(writer.written)[4:])
+    assert len(response['response']) == 2 * BANDWIDTH_QUANTUM
+
+
+def test_raw_chunk_range_round_trip(tmpdir: Any, monkeypatch: Any) -> None:
+    contents = b'aaaabbbbcc'
+    chunks = [contents[i:i + 4] for i in range(0, len(contents), 4)]
+    hashes = [hashlib.sha256(chunk).digest() for chunk in chunks]
+    src = str(tmpdir.join('src'))
+    with open(src, 'wb') as out:
+        out.write(contents)
+    missing = []  # type: List[int]
+
+    async def find_chunk_file(request: dict) -> Optional[str]:
+        return src
+
+    async def open_chunk(file_path: str, index: int) -> Any:
+        if index in missing:
+            raise OSError()
+        return await fileio_util.open_chunk(file_path, index, chunk_size=4)
+
+    monkeypatch.setattr(listen_requests, '_find_chunk_file', find_chunk_file)
+    monkeypatch.setattr(listen_requests, 'open_chunk', open_chunk)
+
+    async def request_range(dst: str, count: int) -> ChunkBitmap:
+        await fileio_util.create_file(dst, len(contents))
+        server = await asyncio.start_server(
+            listen_requests.async_handle_request, '127.0.0.1', 0,
+        )
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await send_raw_chunk_range_request(
+                '127.0.0.1', port, b'drop', b'file', 0, count, dst, hashes,
+                chunk_size=4,
+            )
+        finally:
+            get_connection_pool().close()
+            server.close()
+            await server.wait_closed()
+
+    dst = str(tmpdir.join('full'))
+    done = run_coro(request_range(dst, len(chunks)))
+    assert sorted(done) == [0, 1, 2]
+    with open(dst + DEFAULT_INCOMPLETE_EXT, 'rb') as f:
+        assert f.read() == contents
+
+    # the missing chunk's error response takes its place, and the chunk
+    # after it still lines up
+    missing.append(1)
+    dst = str(tmpdir.join('missing'))
+    done = run_coro(request_range(dst, len(chunks)))
+    assert sorted(done) == [0, 2]
+    with open(dst + DEFAULT_INCOMPLETE_EXT, 'rb') as f:
+        data = f.read()
+    assert data[:4] == chunks[0] and data[8:] == chunks[2]
+
+    dst = str(tmpdir.join('invalid'))
+    with pytest.raises(InvalidInputException):
+        run_coro(request_range(dst, MAX_CHUNKS_PER_RANGE + 1))
+
+
+def test_drop_chunk_bitmaps_round_trip(monkeypatch: Any) -> None:
+    # one file id that bencode decodes to str, and one it can't
+    chunks = {
+        b'text': ChunkBitmap([0, 2]), b'\xff\x00': ChunkBitmap.full(3),
+    }
+
+    class FakeDropMetadata(object):
+        files = {'a': b'text', 'b': b'\xff\x00', 'c': b'gone'}
+
+        @classmethod
+        async def read_file(cls, *args: Any, **kwargs: Any) -> Any:
+            return cls()
+
+    class FakeFileMetadata(object):
+
+        def __init__(self, file_id: bytes) -> None:
+            self.file_id = file_id
+
+        @property
+        async def downloaded_chunks(self) -> ChunkBitmap:
+            return chunks[self.file_id]
+
+    async def get_drop_location(drop_id: bytes) -> str:
+        return 'drop'
+
+    async def get_file_metadata(
+        drop_id: bytes, file_id: bytes,
+    ) -> Optional[FakeFileMetadata]:
+        if file_id not in chunks:
+            return None
+        return FakeFileMetadata(file_id)
+
+    monkeypatch.setattr(listen_requests, 'DropMetadata', FakeDropMetadata)
+    monkeypatch.setattr(
+        listen_requests, 'get_drop_location', get_drop_location,
+    )
+    monkeypatch.setattr(
+        listen_requests, 'get_file_metadata_from_drop_id', get_file_metadata,
+    )
+
+    async def request_bitmaps() -> Dict[bytes, ChunkBitmap]:
+        server = await asyncio.start_server(
+            listen_requests.async_handle_request, '127.0.0.1', 0,
+        )
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await send_drop_chunk_bitmaps_request(
+                '127.0.0.1', port, b'drop',
+            )
+        finally:
+            get_connection_pool().close()
+            server.close()
+            await server.wait_closed()
+
+    # files this node has no metadata for are left out
+    assert run_coro(request_bitmaps()) == chunks
@@ -0,0 +1,282 @@
+import asyncio
+from typing import Any
+from typing import Awaitable
+from typing import List  # noqa
+from typing import Optional
+from typing import TypeVar
+from unittest import mock
+
+import bencode  # type: ignore
+import pytest  # type: ignore
+
+from syncr_backend.constants import MAX_FRAME_SIZE
+from syncr_backend.constants import REQUEST_TYPE_RAW_CHUNK
+from syncr_backend.constants import REQUEST_TYPE_RAW_CHUNK_RANGE
+from syncr_backend.network.connection_pool import ConnectionPool
+from syncr_backend.network.connection_pool import read_bencoded_frame
+from syncr_backend.network.connection_pool import PeerConnection
+from syncr_backend.network.send_requests import do_request
+from syncr_backend.util.network_util import ConnectionClosedException
+from syncr_backend.util.network_util import encode_frame
+from syncr_backend.util.network_util import FRAME_HEADER
+from syncr_backend.util.network_util import NotExistException
+from syncr_backend.util.network_util import PeerTimeoutException
+from syncr_backend.util.network_util import read_frame
+from syncr_backend.util.network_util import ResponseStream
+
+
+R = TypeVar('R')
+
+
+def run_coro(f: Awaitable[R]) -> R:
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(f)
+
+
+def test_frame_round_trip() -> None:
+    reader = asyncio.StreamReader()
+    reader.feed_data(encode_frame(b'first') + encode_frame(b''))
+    reader.feed_data(encode_frame(b'second'))
+    reader.feed_eof()
+
+    assert run_coro(read_frame(reader)) == b'first'
+    assert run_coro(read_frame(reader)) == b''
+    assert run_coro(read_frame(reader)) == b'second'
+    with pytest.raises(asyncio.IncompleteReadError):
+        run_coro(read_frame(reader))
+
+
+def test_frame_too_large() -> None:
+    reader = asyncio.StreamReader()
+    reader.feed_data(FRAME_HEADER.pack(MAX_FRAME_SIZE + 1))
+
+    with pytest.raises(ConnectionClosedException):
+        run_coro(read_frame(reader))
+
+
+def test_do_request_hedged() -> None:
+    started = []
+    cancelled = []
+
+    async def request(ip: str, port: int, delay: float) -> str:
+        started.append(ip)
+        if ip == 'missing':
+            raise NotExistException()
+        try:
+            await asyncio.sleep(delay if ip == 'slow' else 0.01)
+        except asyncio.CancelledError:
+            cancelled.append(ip)
+            raise
+        return ip
+
+    peers = [('missing', 1), ('slow', 1), ('fast', 1), ('unused', 1)]
+    result = run_coro(do_request(
+        request, peers, {'delay': 10}, hedge_after=0.05,
+    ))
+    assert result == 'fast'
+    assert started == ['missing', 'slow', 'fast']
+    run_coro(asyncio.sleep(0))
+    assert cancelled == ['slow']
+
+    # now the peers that answered quickest are asked first
+    started.clear()
+    result = run_coro(do_request(request, peers, {'delay': 10}))
+    assert started == ['fast']
+
+    # without hedging peers are asked one after another
+    started.clear()
+    peers = [('missing', 2), ('slow', 2), ('fast', 2)]
+    result = run_coro(do_request(request, peers, {'delay': 0.1}))
+    assert result == 'slow'
+    assert started == ['missing', 'slow']
+
+    with pytest.raises(NotExistException):
+        run_coro(do_request(request, [('missing', 1)], {'delay': 0}))
+
+
+class FakeWriter(object):
+
+    def __init__(self) -> None:
+        self.closed = False
+
+    def write(self, data: bytes) -> None:
+        pass
+
+    async def drain(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def test_peer_connection_cancelled_request() -> None:
+    reader = asyncio.StreamReader()
+    writer = FakeWriter()
+    conn = PeerConnection('ip', 1, reader, writer)  # type: ignore
+
+    async def cancel_waiting() -> dict:
+        first = asyncio.ensure_future(conn.request({'n': 1}))
+        second = asyncio.ensure_future(conn.request({'n': 2}))
+        await asyncio.sleep(0)
+        # second is waiting for first to be answered
+        second.cancel()
+        third = asyncio.ensure_future(conn.request({'n': 3}))
+        for n in (1, 2, 3):
+            reader.feed_data(encode_frame(bencode.encode({'n': n})))
+        assert await first == {'n': 1}
+        # second's response is still read, so the third lines up
+        return await third
+
+    assert run_coro(cancel_waiting()) == {'n': 3}
+    assert not writer.closed
+    assert not conn.pending
+
+
+def test_peer_connection_cancelled_mid_read() -> None:
+    reader = asyncio.StreamReader()
+    writer = FakeWriter()
+    conn = PeerConnection('ip', 1, reader, writer)  # type: ignore
+    written = []  # type: List[bytes]
+
+    async def read_raw(stream: ResponseStream) -> Any:
+        header = await read_bencoded_frame(stream)
+        while header['length']:
+            block = await stream.read(header['length'])
+            header['length'] -= len(block)
+            written.append(block)
+        return header
+
+    async def cancel_reading() -> dict:
+        first = asyncio.ensure_future(conn.request(
+            {'request_type': REQUEST_TYPE_RAW_CHUNK}, read_raw,
+        ))
+        second = asyncio.ensure_future(conn.request({'n': 2}))
+        reader.feed_data(encode_frame(bencode.encode({
+            'status': 'ok', 'length': 6,
+        })) + b'abc')
+        await asyncio.sleep(0.01)
+        # first has read half of its chunk
+        assert written == [b'abc']
+        first.cancel()
+        reader.feed_data(b'def')
+        reader.feed_data(encode_frame(bencode.encode({'n': 2})))
+        return await second
+
+    assert run_coro(cancel_reading()) == {'n': 2}
+    # the rest of the chunk was thrown away, not given to first's reader
+    assert written == [b'abc']
+    assert not writer.closed
+    assert not conn.pending
+
+
+def test_connection_pool_dedicated_cancelled() -> None:
+    pool = ConnectionPool()
+    reader = asyncio.StreamReader()
+    writer = FakeWriter()
+    conn = PeerConnection('ip', 1, reader, writer, False)  # type: ignore
+
+    async def open_connection(
+        ip: str, port: int, shared: bool,
+    ) -> PeerConnection:
+        assert not shared
+        return conn
+
+    async def cancel_reading() -> None:
+        request = asyncio.ensure_future(pool.request_dedicated(
+            'ip', 1, {'request_type': REQUEST_TYPE_RAW_CHUNK},
+        ))
+        reader.feed_data(b'ab')
+        await asyncio.sleep(0.01)
+        request.cancel()
+        await asyncio.wait([request])
+
+    with mock.patch.object(PeerConnection, 'open', open_connection):
+        run_coro(cancel_reading())
+    # the connection is closed rather than the response being read out
+    assert writer.closed
+    assert not conn.pending
+    assert not pool._connections
+
+
+def test_peer_connection_stalled_read() -> None:
+    reader = asyncio.StreamReader()
+    writer = FakeWriter()
+    conn = PeerConnection('ip', 1, reader, writer)  # type: ignore
+
+    async def read_raw(stream: ResponseStream) -> Any:
+        header = await read_bencoded_frame(stream)
+        return await stream.readexactly(header['length'])
+
+    reader.feed_data(encode_frame(bencode.encode({
+        'status': 'ok', 'length': 6,
+    })) + b'abc')
+    # the whole response may take longer than the stall timeout, as long
+    # as bytes keep arriving
+    asyncio.get_event_loop().call_later(0.03, reader.feed_data, b'de')
+
+    with pytest.raises(PeerTimeoutException):
+        run_coro(conn.request(
+            {'request_type': REQUEST_TYPE_RAW_CHUNK}, read_raw,
+            stall_timeout=0.05,
+        ))
+    assert writer.closed
+    assert not conn.pending
+
+
+def test_connection_pool_open_locks() -> None:
+    pool = ConnectionPool()
+    opened = []  # type: List[PeerConnection]
+
+    async def open_connection(ip: str, port: int) -> Optional[PeerConnection]:
+        await asyncio.sleep(0.01)
+        if port == 2:
+            # a peer that only speaks the one-shot protocol
+            return None
+        conn = PeerConnection(
+            ip, port, asyncio.StreamReader(), FakeWriter(),  # type: ignore
+        )
+        opened.append(conn)
+        return conn
+
+    async def get_connections() -> List[Optional[PeerConnection]]:
+        return await asyncio.gather(*[
+            pool.get_connection('ip', port) for port in (1, 1, 2, 2)
+        ])
+
+    with mock.patch.object(PeerConnection, 'open', open_connection):
+        conns = run_coro(get_connections())
+        # callers asking at once share one connection
+        assert conns == [opened[0], opened[0], None, None]
+        assert not pool._open_locks
+
+        # closed connections are reopened, and the locks still let go
+        opened[0].close()
+        assert run_coro(pool.get_connection('ip', 1)) is opened[1]
+        assert not pool._open_locks
+        assert not pool._open_lock_users
+
+        # chunk transfers get a connection of their own
+        assert run_coro(pool.get_connection('ip', 1, bulk=True)) is opened[2]
+        assert run_coro(pool.get_connection('ip', 1)) is opened[1]
+        assert run_coro(pool.get_connection('ip', 2, bulk=True)) is None
+
+
+def test_response_stream_skip_range() -> None:
+    reader = asyncio.StreamReader()
+    for header, body in [
+        ({'status': 'ok', 'response': 3}, b''),
+        ({'status': 'ok', 'length': 3}, b'abc'),
+        ({'status': 'error', 'error': 1}, b''),
+        ({'status': 'ok', 'length': 2}, b'de'),
+        ({'n': 'next'}, b''),
+    ]:
+        reader.feed_data(encode_frame(bencode.encode(header)) + body)
+    stream = ResponseStream(reader, REQUEST_TYPE_RAW_CHUNK_RANGE)
+
+    run_coro(read_bencoded_frame(stream))
+    run_coro(read_bencoded_frame(stream))
+    assert run_coro(stream.readexactly(1)) == b'a'
+    run_coro(stream.skip())
+
+    assert stream.done
+    assert run_coro(read_bencoded_frame(reader)) == {'n': 'next'}
@@ -0,0 +1,26 @@
+from syncr_backend.constants import MAX_PEER_CHUNK_SHARE
+from syncr_backend.constants import MIN_PEER_CHUNK_SHARE
+from syncr_backend.network.peer_scores import PeerScoreboard
+
+
+def test_peer_scoreboard_ordering() -> None:
+    scoreboard = PeerScoreboard()
+    slow, fast, flaky, new = ('slow', 1), ('fast', 1), ('flaky', 1), ('new', 1)
+
+    scoreboard.record_transfer(slow, 10**6, 1)
+    scoreboard.record_transfer(fast, 10**8, 1)
+    scoreboard.record_transfer(flaky, 10**8, 1)
+    for _ in range(5):
+        scoreboard.record_failure(flaky)
+    peers = [new, slow, flaky, fast]
+
+    # the new peer counts as average, and the flaky one is fast when it works
+    assert scoreboard.by_throughput(peers) == [fast, new, flaky, slow]
+    assert 1 < scoreboard.chunk_share(fast, peers) <= MAX_PEER_CHUNK_SHARE
+    assert scoreboard.chunk_share(slow, peers) == MIN_PEER_CHUNK_SHARE
+    assert PeerScoreboard().chunk_share(new, peers) == 1
+
+    scoreboard.record_response(slow, 0.01)
+    scoreboard.record_response(fast, 0.5)
+    # nothing is known about the others' latency, so they keep their order
+    assert scoreboard.by_latency(peers) == [slow, new, flaky, fast]
@@ -0,0 +1,86 @@
+import asyncio
+from typing import Any
+from typing import Awaitable
+from typing import TypeVar
+from unittest import mock
+
+from syncr_backend.constants import SYNC_PRIORITY_BACKGROUND
+from syncr_backend.constants import SYNC_PRIORITY_USER
+from syncr_backend.constants import SYNC_RETRY_BASE_DELAY
+from syncr_backend.constants import SYNC_RETRY_JITTER
+from syncr_backend.constants import SYNC_RETRY_MAX_DELAY
+from syncr_backend.metadata.drop_metadata import DropVersion
+from syncr_backend.util.sync_job_util import retry_delay
+from syncr_backend.util.sync_job_util import SyncJobTable
+
+
+R = TypeVar('R')
+
+
+def run_coro(f: Awaitable[R]) -> R:
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(f)
+
+
+def test_retry_delay() -> None:
+    for attempts, delay in [
+        (1, SYNC_RETRY_BASE_DELAY), (3, SYNC_RETRY_BASE_DELAY * 4),
+        (100, SYNC_RETRY_MAX_DELAY),
+    ]:
+        assert (1 - SYNC_RETRY_JITTER) * delay <= retry_delay(attempts) \
+            <= delay
+
+
+def test_sync_job_table(tmpdir: Any) -> None:
+    path = str(tmpdir.join('sync_jobs'))
+    table = SyncJobTable(path)
+    background = run_coro(table.add(b'a', '/a', version=DropVersion(1, 0)))
+    user = run_coro(table.add(b'b', '/b', priority=SYNC_PRIORITY_USER))
+
+    assert table.next_job() is user
+    assert table.next_job(running=[b'b']) is background
+    assert table.next_job(running=[b'a', b'b']) is None
+
+    # a drop that didn't finish waits, and doesn't hold up the others
+    with mock.patch(
+        'syncr_backend.util.sync_job_util.random.uniform', return_value=1,
+    ):
+        run_coro(table.retry(user, user.revision))
+    assert user.attempts == 1
+    assert table.next_job() is background
+    delay = table.next_run_delay(running=[b'a'])
+    assert delay is not None and 0 < delay <= SYNC_RETRY_BASE_DELAY
+
+    # the table is still there after a restart
+    loaded = SyncJobTable(path)
+    run_coro(loaded.load())
+    assert len(loaded) == 2
+    job = loaded.get(b'b')
+    assert job is not None
+    assert (job.save_dir, job.priority, job.attempts) == \
+        ('/b', SYNC_PRIORITY_USER, 1)
+
+    # a job that is queued again while it runs isn't removed when that run
+    # finishes, and runs again right away with the newer version
+    revision = background.revision
+    run_coro(table.add(b'a', '/a', version=DropVersion(2, 0)))
+    run_coro(table.finish(background, revision))
+    assert table.get(b'a') is background
+    assert background.version == DropVersion(2, 0)
+    assert background.priority == SYNC_PRIORITY_BACKGROUND
+    run_coro(table.finish(background, background.revision))
+    assert table.get(b'a') is None
+
+
+def test_sync_job_table_versions(tmpdir: Any) -> None:
+    table = SyncJobTable(str(tmpdir.join('sync_jobs')))
+    job = run_coro(table.add(b'a', '/a', version=DropVersion(2, 0)))
+
+    # an older version doesn't replace a newer one
+    run_coro(table.add(b'a', '/a', version=DropVersion(1, 0)))
+    assert job.version == DropVersion(2, 0)
+    # the newest version replaces any other, and stays
+    run_coro(table.add(b'a', '/a'))
+    assert job.version is None
+    run_coro(table.add(b'a', '/a', version=DropVersion(3, 0)))
+    assert job.version is None
@@ -0,0 +1,64 @@
+import asyncio
+from typing import Awaitable
+from typing import List  # noqa
+from typing import Tuple  # noqa
+from typing import TypeVar
+
+from syncr_backend.network.transfer_scheduler import TransferScheduler
+
+
+R = TypeVar('R')
+
+
+def run_coro(f: Awaitable[R]) -> R:
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(f)
+
+
+def test_transfer_scheduler_round_robin() -> None:
+    scheduler = TransferScheduler(max_transfers=1, max_bytes=100)
+    granted = []  # type: List[Tuple[bytes, bytes]]
+
+    async def transfer(drop_id: bytes, file_id: bytes) -> None:
+        await scheduler.acquire(drop_id, file_id, 10)
+        granted.append((drop_id, file_id))
+        await asyncio.sleep(0)
+        scheduler.release(10)
+
+    async def run_all() -> None:
+        await scheduler.acquire(b'x', b'x', 10)
+        waiting = [
+            asyncio.ensure_future(transfer(drop_id, file_id))
+            for drop_id, file_id in [
+                (b'a', b'1'), (b'a', b'1'), (b'a', b'2'), (b'b', b'3'),
+            ]
+        ]
+        await asyncio.sleep(0)
+        scheduler.release(10)
+        await asyncio.gather(*waiting)
+
+    run_coro(run_all())
+    # drops take turns, then files within a drop
+    assert granted == [(b'a', b'1'), (b'b', b'3'), (b'a', b'2'), (b'a', b'1')]
+    assert scheduler.transfers == 0 and scheduler.bytes == 0
+
+
+def test_transfer_scheduler_bytes() -> None:
+    scheduler = TransferScheduler(max_transfers=4, max_bytes=100)
+
+    async def run_all() -> None:
+        await scheduler.acquire(b'a', b'1', 60)
+        large = asyncio.ensure_future(scheduler.acquire(b'a', b'1', 60))
+        small = asyncio.ensure_future(scheduler.acquire(b'b', b'2', 10))
+        await asyncio.sleep(0)
+        # the large transfer doesn't fit, and holds up the small one
+        assert not large.done() and not small.done()
+        large.cancel()
+        await small
+        scheduler.release(60)
+        # too large on its own, but let through once nothing else runs
+        scheduler.release(10)
+        await scheduler.acquire(b'a', b'1', 200)
+
+    run_coro(run_all())
+    assert scheduler.transfers == 1 and scheduler.bytes == 200
@@ -0,0 +1,70 @@
+import asyncio
+from typing import Awaitable
+from typing import TypeVar
+
+from syncr_backend.network.upload_limiter import UploadLimiter
+
+
+R = TypeVar('R')
+
+
+def run_coro(f: Awaitable[R]) -> R:
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(f)
+
+
+def test_upload_limiter_slots() -> None:
+    limiter = UploadLimiter(slots=2, slots_per_peer=1, queue_size=1)
+
+    assert run_coro(limiter.acquire('a'))
+    # a has used its per peer slot, and nobody frees it in time
+    assert not run_coro(limiter.acquire('a', timeout=0.01))
+    assert run_coro(limiter.acquire('b'))
+    assert limiter.in_use == 2
+
+
+def test_upload_limiter_try_acquire() -> None:
+    limiter = UploadLimiter(slots=1, slots_per_peer=1, queue_size=1)
+
+    assert limiter.try_acquire('a')
+    assert not limiter.try_acquire('b')
+    assert not limiter._waiters
+    limiter.release('a')
+    assert limiter.try_acquire('b')
+    assert limiter.in_use == 1
+
+
+def test_upload_limiter_queue() -> None:
+    limiter = UploadLimiter(slots=1, slots_per_peer=1, queue_size=1)
+    assert run_coro(limiter.acquire('a'))
+
+    async def wait_then_release() -> bool:
+        waiter = asyncio.ensure_future(limiter.acquire('b'))
+        await asyncio.sleep(0)
+        # the queue is full, so this is turned away at once
+        assert not await limiter.acquire('c', timeout=10)
+        limiter.release('a')
+        return await waiter
+
+    assert run_coro(wait_then_release())
+    assert limiter.in_use == 1
+
+
+def test_upload_limiter_hand_off() -> None:
+    limiter = UploadLimiter(slots=1, slots_per_peer=1, queue_size=2)
+    assert run_coro(limiter.acquire('a'))
+
+    async def cancel_woken_waiter() -> bool:
+        first = asyncio.ensure_future(limiter.acquire('b'))
+        second = asyncio.ensure_future(limiter.acquire('c'))
+        await asyncio.sleep(0)
+        limiter.release('a')
+        # first is cancelled before it runs, and passes the slot on
+        first.cancel()
+        # the slot is always counted as taken, so a new caller can't take it
+        assert not await limiter.acquire('d', timeout=0)
+        return await second
+
+    assert run_coro(cancel_woken_waiter())
+    assert limiter.in_use == 1
+    assert not limiter._waiters
@@ -1,6 +1,51 @@
+import asyncio
+import hashlib
+import mmap
+import os
+from typing import Any
+from typing import Awaitable
+from typing import Dict  # noqa
+from typing import List  # noqa
+from typing import Tuple  # noqa
+from typing import TypeVar
 from unittest import mock
 
+import pytest  # type: ignore
+
+from syncr_backend.constants import DEFAULT_INCOMPLETE_EXT
+from syncr_backend.metadata.file_metadata import FileMetadata
+from syncr_backend.network.transfer_scheduler import TransferScheduler
+from syncr_backend.util.bitmap_util import ChunkBitmap
+from syncr_backend.constants import DEFAULT_FILE_METADATA_LOCATION
+from syncr_backend.util import crypto_util
+from syncr_backend.util import network_util
+from syncr_backend.util.crypto_util import VerificationException
+from syncr_backend.util.drop_util import copy_local_chunks
+from syncr_backend.util.drop_util import download_file_chunks
+from syncr_backend.util.drop_util import endgame_chunks
+from syncr_backend.util.drop_util import get_drop_chunk_lists
+from syncr_backend.util.drop_util import make_local_chunk_index
+from syncr_backend.util.drop_util import match_moved_files
+from syncr_backend.util.drop_util import move_local_files
+from syncr_backend.util.drop_util import sync_file_contents
+from syncr_backend.util.fileio_util import AtomicFile
+from syncr_backend.util.fileio_util import ChunkWriteGuard
+from syncr_backend.util.fileio_util import FileHandleCache
+from syncr_backend.util.fileio_util import mark_file_complete
+from syncr_backend.util.fileio_util import read_chunk
+from syncr_backend.util.fileio_util import read_chunk_bytes
 from syncr_backend.util.fileio_util import walk_with_ignore
+from syncr_backend.util.fileio_util import write_block_from_stream
+from syncr_backend.util.fileio_util import write_chunk
+from syncr_backend.util.fileio_util import write_chunk_from_stream
+
+
+R = TypeVar('R')
+
+
+def run_coro(f: Awaitable[R]) -> R:
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(f)
 
 
 @mock.patch('syncr_backend.util.fileio_util.os.path.relpath', autospec=True)
@@ -48,3 +93,373 @@ def test_walk_with_ignore(
     assert list(
         walk_with_ignore('/foo/bar/123', ignore=['wfoo', 'abc']),
     ) == [('foo', 'qux')]
+
+
+def test_write_chunk_from_stream(tmpdir: Any) -> None:
+    path = str(tmpdir.join('f'))
+    with open(path + DEFAULT_INCOMPLETE_EXT, 'wb') as f:
+        f.truncate(10)
+    good = b'abcd'
+    bad = b'efgh'
+    reader = asyncio.StreamReader()
+    reader.feed_data(good + bad + b'rest')
+    reader.feed_eof()
+
+    run_coro(write_chunk_from_stream(
+        path, 1, reader, len(good), hashlib.sha256(good).digest(), 4,
+    ))
+    with pytest.raises(VerificationException):
+        run_coro(write_chunk_from_stream(
+            path, 0, reader, len(bad), hashlib.sha256(good).digest(), 4,
+        ))
+
+    assert run_coro(reader.read()) == b'rest'
+    with open(path + DEFAULT_INCOMPLETE_EXT, 'rb') as f:
+        assert f.read() == bad + good + b'\0\0'
+
+
+def test_write_block_from_stream(tmpdir: Any) -> None:
+    path = str(tmpdir.join('f'))
+    with open(path + DEFAULT_INCOMPLETE_EXT, 'wb') as f:
+        f.truncate(8)
+    reader = asyncio.StreamReader()
+    reader.feed_data(b'abcdefg')
+    reader.feed_eof()
+    written = []  # type: List[int]
+
+    run_coro(write_block_from_stream(path, 1, 1, reader, 2, 4))
+    run_coro(write_chunk_from_stream(
+        path, 0, reader, 3, hashlib.sha256(b'cde').digest(), 4,
+        progress=written.append,
+    ))
+    with pytest.raises(ValueError):
+        run_coro(write_block_from_stream(path, 1, 3, reader, 2, 4))
+
+    assert written == [3]
+    assert run_coro(reader.read()) == b'fg'
+    with open(path + DEFAULT_INCOMPLETE_EXT, 'rb') as f:
+        assert f.read() == b'cde\0\0ab\0'
+
+
+def test_file_handle_cache(tmpdir: Any) -> None:
+    paths = [str(tmpdir.join(name)) for name in 'abc']
+    for path in paths:
+        with open(path + DEFAULT_INCOMPLETE_EXT, 'wb') as f:
+            f.write(b'\0' * 8)
+    cache = FileHandleCache(max_files=2)
+
+    with mock.patch(
+        'syncr_backend.util.fileio_util._cache_instance', cache,
+    ):
+        run_coro(write_chunk(
+            paths[0], 1, b'abcd', hashlib.sha256(b'abcd').digest(), 4,
+        ))
+        assert run_coro(read_chunk_bytes(paths[0], 1, 4)) == b'abcd'
+        assert len(cache) == 1
+
+        # the renamed file is opened again, read only
+        mark_file_complete(paths[0])
+        assert len(cache) == 0
+        run_coro(write_chunk(
+            paths[0], 0, b'efgh', hashlib.sha256(b'efgh').digest(), 4,
+        ))
+        assert run_coro(read_chunk_bytes(paths[0], 0, 4)) == b'\0' * 4
+
+        # the least recently used file is closed, unless it's in use
+        held = run_coro(cache.acquire(paths[1]))
+        run_coro(read_chunk_bytes(paths[2], 0, 4))
+        assert len(cache) == 2
+        run_coro(read_chunk_bytes(paths[0], 0, 4))
+        assert len(cache) == 2 and held.dropped
+        assert os.pread(held.fd, 4, 0) == b'\0' * 4
+        cache.release(held)
+        with pytest.raises(OSError):
+            os.fstat(held.fd)
+
+        with pytest.raises(FileNotFoundError):
+            run_coro(read_chunk_bytes(str(tmpdir.join('d')), 0, 4))
+        cache.clear()
+        assert len(cache) == 0
+
+
+def test_file_handle_cache_mmap(tmpdir: Any) -> None:
+    path = str(tmpdir.join('f'))
+    with open(path + DEFAULT_INCOMPLETE_EXT, 'wb') as f:
+        f.write(b'\0' * 6)
+    cache = FileHandleCache(use_mmap=True)
+
+    with mock.patch(
+        'syncr_backend.util.fileio_util._cache_instance', cache,
+    ):
+        view, h = run_coro(read_chunk(path, 0, chunk_size=4))
+        assert isinstance(view.obj, mmap.mmap)
+        assert h == hashlib.sha256(b'\0' * 4).digest()
+        # writes show up in the mapping
+        run_coro(write_chunk(
+            path, 0, b'abcd', hashlib.sha256(b'abcd').digest(), 4,
+        ))
+        assert view == b'abcd'
+        # the short last chunk is read past the mapping's end
+        assert run_coro(read_chunk(path, 1, chunk_size=4))[0] == b'\0\0'
+
+        # a mapping with views left is kept until they're gone
+        mark_file_complete(path)
+        assert view == b'abcd'
+        view.release()
+
+
+@mock.patch('syncr_backend.util.fileio_util.STREAM_BLOCK_SIZE', 2)
+def test_write_chunk_from_stream_taken_over(tmpdir: Any) -> None:
+    path = str(tmpdir.join('f'))
+    with open(path + DEFAULT_INCOMPLETE_EXT, 'wb') as f:
+        f.truncate(8)
+    reader = asyncio.StreamReader()
+    reader.feed_data(b'ab')
+    guard = ChunkWriteGuard()
+
+    async def take_over_part_way() -> bool:
+        stream = asyncio.ensure_future(write_chunk_from_stream(
+            path, 1, reader, 4, hashlib.sha256(b'abcd').digest(), 4,
+            guard=guard,
+        ))
+        while reader._buffer:  # type: ignore
+            await asyncio.sleep(0)
+        assert await guard.take(1)
+        assert not await guard.take(1)
+        reader.feed_data(b'cdrest')
+        return await stream
+
+    assert not run_coro(take_over_part_way())
+    assert run_coro(reader.read(4)) == b'rest'
+    with open(path + DEFAULT_INCOMPLETE_EXT, 'rb') as written:
+        assert written.read() == b'\0\0\0\0ab\0\0'
+
+
+def test_download_file_chunks_work_stealing() -> None:
+    fast, slow = ('127.0.0.1', 1), ('127.0.0.1', 2)
+    metadata = FileMetadata([b''] * 32, b'0000', 32, b'foo', chunk_size=1)
+    metadata._downloaded_chunks = ChunkBitmap()
+    assigned = {
+        fast: [], slow: [],
+    }  # type: Dict[Tuple[str, int], List[ChunkBitmap]]
+
+    async def get_chunk_list(*args: Any) -> ChunkBitmap:
+        return ChunkBitmap.full(32)
+
+    async def download(
+        peer: Tuple[str, int], drop_id: bytes, file_id: bytes,
+        chunks: ChunkBitmap, file_metadata: FileMetadata, full_path: str,
+    ) -> bool:
+        assigned[peer].append(chunks)
+        if peer == slow:
+            await asyncio.sleep(0.05)
+            return False
+        await asyncio.sleep(0.01)
+        for chunk in chunks:
+            await file_metadata.finish_chunk(chunk)
+        return True
+
+    with mock.patch(
+        'syncr_backend.util.drop_util._try_get_chunk_list', get_chunk_list,
+    ), mock.patch(
+        'syncr_backend.util.drop_util.download_from_peer', download,
+    ):
+        assert run_coro(download_file_chunks(
+            b'foo', b'0000', ChunkBitmap.full(32), [slow, fast], metadata,
+            'path',
+        ))
+
+    assert run_coro(metadata.downloaded_chunks) == ChunkBitmap.full(32)
+    # the fast peer kept taking chunks while the slow one was busy, then
+    # took back the chunks the slow one failed
+    assert len(assigned[slow]) == 1
+    assert len(assigned[fast]) > 2
+    assert all(
+        any(chunk in chunks for chunks in assigned[fast])
+        for chunk in assigned[slow][0]
+    )
+
+
+def test_get_drop_chunk_lists_caching() -> None:
+    bitmaps = {b'file': ChunkBitmap.full(2)}
+    errors = [
+        network_util.PeerTimeoutException(),
+        network_util.IncompatibleProtocolVersionException(),
+        network_util.ConnectionClosedException(), None,
+    ]  # type: List[Any]
+    sent = []  # type: List[int]
+
+    async def request(
+        ip: str, port: int, drop_id: bytes,
+    ) -> Dict[bytes, ChunkBitmap]:
+        sent.append(port)
+        error = errors.pop(0)
+        if error is not None:
+            raise error
+        return bitmaps
+
+    with mock.patch(
+        'syncr_backend.network.send_requests.send_drop_chunk_bitmaps_request',
+        request,
+    ):
+        # a peer that times out isn't asked again, for any drop
+        assert run_coro(get_drop_chunk_lists('ip', 1, b'drop')) is None
+        assert run_coro(get_drop_chunk_lists('ip', 1, b'drop')) is None
+        assert run_coro(get_drop_chunk_lists('ip', 1, b'other')) is None
+        # neither is a peer that doesn't support the request
+        assert run_coro(get_drop_chunk_lists('ip', 2, b'drop')) is None
+        assert run_coro(get_drop_chunk_lists('ip', 2, b'drop')) is None
+        # a broken connection isn't cached, so the peer is asked again
+        assert run_coro(get_drop_chunk_lists('ip', 3, b'drop')) is None
+        assert run_coro(get_drop_chunk_lists('ip', 3, b'drop')) == bitmaps
+        assert run_coro(get_drop_chunk_lists('ip', 3, b'drop')) == bitmaps
+
+    assert sent == [1, 2, 3, 3]
+
+
+def test_endgame_chunks_ignore_scheduler(tmpdir: Any) -> None:
+    contents = b'abcd'
+    metadata = FileMetadata(
+        [run_coro(crypto_util.hash(contents[i:i + 1])) for i in range(4)],
+        b'0000', 4, b'foo', chunk_size=1,
+    )
+    metadata._downloaded_chunks = ChunkBitmap([0, 1])
+    path = str(tmpdir.join('file'))
+    tmpdir.join('file' + DEFAULT_INCOMPLETE_EXT).write_binary(b'ab\0\0')
+    # the stragglers being raced hold every transfer
+    scheduler = TransferScheduler(max_transfers=1)
+    run_coro(scheduler.acquire(b'foo', b'0000', 2))
+
+    async def get_chunk_list(*args: Any) -> ChunkBitmap:
+        return ChunkBitmap.full(4)
+
+    async def send_chunk_request(file_index: int, **kwargs: Any) -> bytes:
+        assert kwargs['dedicated']
+        return contents[file_index:file_index + 1]
+
+    with mock.patch(
+        'syncr_backend.util.drop_util._try_get_chunk_list', get_chunk_list,
+    ), mock.patch(
+        'syncr_backend.util.drop_util.get_transfer_scheduler',
+        lambda: scheduler,
+    ), mock.patch(
+        'syncr_backend.network.send_requests.send_chunk_request',
+        send_chunk_request,
+    ):
+        done = run_coro(asyncio.wait_for(endgame_chunks(
+            b'foo', b'0000', ChunkBitmap([2, 3]), [('127.0.0.1', 1)],
+            metadata, path,
+        ), 1))
+
+    assert done == ChunkBitmap([2, 3])
+    assert tmpdir.join('file' + DEFAULT_INCOMPLETE_EXT).read_binary() == \
+        contents
+
+
+def test_copy_local_chunks(tmpdir: Any) -> None:
+    old = b'aaaabbbbcccc'
+    tmpdir.join('old').write_binary(old)
+    old_metadata = FileMetadata(
+        [run_coro(crypto_util.hash(old[i:i + 4])) for i in range(0, 12, 4)],
+        b'old', 12, b'foo', chunk_size=4,
+    )
+    run_coro(old_metadata.write_file(
+        str(tmpdir.join(DEFAULT_FILE_METADATA_LOCATION)),
+    ))
+    chunk_index = run_coro(make_local_chunk_index(
+        {'old': b'old', 'missing': b'missing'}, str(tmpdir),
+    ))
+    assert len(chunk_index) == 3
+
+    # the new version moved two chunks of old into another file, and has one
+    # that isn't on disk
+    new = b'ccccddddaaaa'
+    new_path = str(tmpdir.join('new'))
+    tmpdir.join('new' + DEFAULT_INCOMPLETE_EXT).write_binary(b'\0' * 12)
+    metadata = FileMetadata(
+        [run_coro(crypto_util.hash(new[i:i + 4])) for i in range(0, 12, 4)],
+        b'new', 12, b'foo', chunk_size=4,
+    )
+    metadata._downloaded_chunks = ChunkBitmap()
+    needed = run_coro(copy_local_chunks(
+        metadata, new_path, ChunkBitmap.full(3), chunk_index,
+    ))
+
+    assert needed == ChunkBitmap([1])
+    assert run_coro(metadata.downloaded_chunks) == ChunkBitmap([0, 2])
+    assert tmpdir.join('new' + DEFAULT_INCOMPLETE_EXT).read_binary() == \
+        b'cccc\0\0\0\0aaaa'
+
+
+def test_sync_file_contents_shrunk(tmpdir: Any) -> None:
+    old = b'aaaabbbbcccc'
+    tmpdir.join('f').write_binary(old)
+    old_metadata = FileMetadata(
+        [run_coro(crypto_util.hash(old[i:i + 4])) for i in range(0, 12, 4)],
+        b'old', 12, b'foo', chunk_size=4,
+    )
+    run_coro(old_metadata.write_file(
+        str(tmpdir.join(DEFAULT_FILE_METADATA_LOCATION)),
+    ))
+    chunk_index = run_coro(make_local_chunk_index({'f': b'old'}, str(tmpdir)))
+
+    # the new version only keeps the chunk that was at the end
+    new = b'cccc'
+    metadata = FileMetadata(
+        [run_coro(crypto_util.hash(new))], b'new', 4, b'foo', chunk_size=4,
+    )
+    metadata._downloaded_chunks = ChunkBitmap()
+
+    async def get_file_metadata(*args: Any) -> FileMetadata:
+        return metadata
+
+    with mock.patch(
+        'syncr_backend.util.drop_util.get_file_metadata', get_file_metadata,
+    ):
+        needed = run_coro(sync_file_contents(
+            b'foo', b'new', 'f', [], str(tmpdir), chunk_index,
+        ))
+
+    assert not needed
+    assert tmpdir.join('f' + DEFAULT_INCOMPLETE_EXT).read_binary() == new
+
+
+def test_atomic_file(tmpdir: Any) -> None:
+    atomic = AtomicFile(str(tmpdir.join('state', 'file')))
+    with pytest.raises(OSError):
+        run_coro(atomic.read())
+
+    async def save_twice() -> None:
+        await asyncio.gather(atomic.write(b'old'), atomic.write(b'new'))
+
+    run_coro(save_twice())
+    # the later save is the one kept, and no temporary file is left over
+    assert run_coro(atomic.read()) == b'new'
+    assert tmpdir.join('state').listdir() == [tmpdir.join('state', 'file')]
+
+
+def test_match_moved_files() -> None:
+    old = {'a': b'1', 'b': b'2', 'c': b'3', 'd': b'4'}
+    new = {'a': b'1', 'x/b': b'2', 'c': b'4', 'e': b'1', 'f': b'5'}
+    # b was moved, d was renamed over c, and a was copied to e
+    assert match_moved_files(old, new) == {'x/b': 'b', 'c': 'd', 'e': 'a'}
+
+
+def test_move_local_files(tmpdir: Any) -> None:
+    tmpdir.join('a').write_binary(b'a')
+    tmpdir.join('b' + DEFAULT_INCOMPLETE_EXT).write_binary(b'b')
+    tmpdir.join('c').write_binary(b'c')
+    old = {'a': b'1', 'b': b'2', 'c': b'3'}
+    new = {'a': b'1', 'x/b': b'2', 'c': b'4', 'd': b'1', 'e': b'1'}
+
+    on_disk = run_coro(move_local_files(old, new, str(tmpdir)))
+
+    assert on_disk == {'a': b'1', 'x/b': b'2', 'c': b'3', 'd': b'1', 'e': b'1'}
+    assert tmpdir.join('a').read_binary() == b'a'
+    assert tmpdir.join('d').read_binary() == b'a'
+    assert tmpdir.join('e').read_binary() == b'a'
+    assert not tmpdir.join('b' + DEFAULT_INCOMPLETE_EXT).exists()
+    assert tmpdir.join('x', 'b' + DEFAULT_INCOMPLETE_EXT).read_binary() == \
+        b'b'
+    # c changed, but its old contents may still be needed
+    assert tmpdir.join('c').read_binary() == b'c'